@@ -1,14 +1,41 @@
 import os
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g, abort, send_file,
+                   Response, stream_with_context, get_flashed_messages, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm, ResetPasswordForm
-from models import db, connect_db, User, Message, Like
+from models import (db, connect_db, User, UserSnapshot, Message, Follows, FollowSuggestion,
+                    UserStats)
+from archive import ARCHIVE_AFTER, archive_messages
+from recommend import TOP_K, recommend_follows
+from stats import compute_user_stats
+from readmodels import Profile, profile_query, user_cards
+from notifications import (FOLLOW, LIKE, coalesce_in_background, coalesce_notifications,
+                           inbox_page, mark_read, notify, notify_mentions)
+from backup import (USER_TABLES, export_csv_dir, export_ndjson, import_csv_dir, import_ndjson,
+                    to_csv, to_ndjson, user_columns, user_rows)
+from deletion import purge_deleted_users, purge_in_background
+from ratelimit import RateLimiter, make_store
+from sessions import ServerSideSessionInterface, make_session_store
+from socialgraph import SocialGraph
+from shards import make_shards
+from availability import TakenNames
+from staticpages import ACTIVE_DAYS, MESSAGE, PROFILE, StaticPages
+from compression import MIN_SIZE, CompressionMiddleware, WhitespaceStripper
+from images import SIZES, ImageSourceError, ThumbnailCache, thumb_url, valid_signature
+from trending import record_like, record_post, trending_messages, trending_hashtags, prune_buckets
 
 CURR_USER_KEY = "curr_user"
+USER_SNAPSHOT_KEY = "curr_user_snapshot"
+MESSAGES_PER_PAGE = 50
+HOME_MESSAGES = 100
+STREAM_YIELD_PER = 100
+STREAM_BUFFER_SIZE = 20
 
 app = Flask(__name__)
 
@@ -21,25 +48,169 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'thumbnails'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+app.config['IMAGE_FETCH_REMOTE'] = True
+app.config['PURGE_DELETED_USERS_IN_BACKGROUND'] = True
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = True
+app.config['SESSION_STORE'] = os.environ.get(
+    'SESSION_STORE', os.path.join(app.instance_path, 'sessions.sqlite3'))
+app.config['RATELIMIT_ENABLED'] = True
+app.config['RATELIMIT_STORAGE'] = os.environ.get(
+    'RATELIMIT_STORAGE', os.path.join(app.instance_path, 'ratelimit.sqlite3'))
+app.config['SOCIAL_GRAPH_WARM'] = os.environ.get('SOCIAL_GRAPH_WARM') == '1'
+app.config['ASYNC_DATABASE_URL'] = os.environ.get(
+    'ASYNC_DATABASE_URL',
+    app.config['SQLALCHEMY_DATABASE_URI'].replace('postgresql://', 'postgresql+asyncpg://', 1))
+app.config['ASYNC_DB_POOL_SIZE'] = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))
+app.config['ASYNC_DB_MAX_OVERFLOW'] = int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', 80))
+# comma-separated database URLs to shard messages and likes over
+app.config['MESSAGE_SHARDS'] = os.environ.get('MESSAGE_SHARDS', '')
+app.config['COMPRESS_RESPONSES'] = True
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', MIN_SIZE))
+# strip template indentation and block-tag lines from the HTML
+app.config['MINIFY_TEMPLATES'] = os.environ.get('MINIFY_TEMPLATES') == '1'
+# directory of pre-rendered signed-out pages (see staticpages.py); unset: none
+app.config['STATIC_PAGES_DIR'] = os.environ.get('STATIC_PAGES_DIR', '')
+app.config['STATIC_PAGES_IN_BACKGROUND'] = True
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+app.add_template_filter(thumb_url, 'thumb')
+
+if app.config['MINIFY_TEMPLATES']:
+    app.jinja_env.trim_blocks = True
+    app.jinja_env.lstrip_blocks = True
+    app.jinja_env.add_extension(WhitespaceStripper)
+
+app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config)
+
+rate_limiter = RateLimiter(make_store(app.config['RATELIMIT_STORAGE']))
+
+session_store = make_session_store(app.config['SESSION_STORE'])
+app.session_interface = ServerSideSessionInterface(session_store)
+
+social_graph = SocialGraph(session_store.user_version)
+if app.config['SOCIAL_GRAPH_WARM']:
+    with app.app_context():
+        social_graph.warm()
+
+shards = make_shards(app.config['MESSAGE_SHARDS'])
+
+taken_names = TakenNames()
+
+static_pages = StaticPages(app, app.config['STATIC_PAGES_DIR'], message_ids=shards.message_ids)
+
+thumbnail_caches = {}
+
+
+@app.teardown_appcontext
+def remove_shard_sessions(exception=None):
+    shards.remove()
+
 
 ##############################################################################
 # User signup/login/logout
 
 
+@app.before_request
+def check_rate_limits():
+    """Turn away POSTs over their rate limit before touching the DB.
+
+    Registered first so it runs ahead of add_user_to_g; it only reads
+    the request and the session cookie.
+    """
+
+    if not app.config['RATELIMIT_ENABLED'] or request.method != 'POST':
+        return None
+
+    wait = rate_limiter.check(request.endpoint, {
+        'ip': request.remote_addr,
+        'user': session.get(CURR_USER_KEY),
+        'username': request.form.get('username') if request.endpoint == 'login' else None,
+    })
+
+    if wait:
+        response = Response("Too many requests, please slow down.", status=429,
+                            mimetype='text/plain')
+        response.headers['Retry-After'] = str(int(wait) + 1)
+        return response
+
+
+@app.before_request
+def serve_static_page():
+    """Answer signed-out profile and message views from their pre-rendered file."""
+
+    if (request.method not in ('GET', 'HEAD')
+            or CURR_USER_KEY in session or '_flashes' in session):
+        return None
+
+    path = static_pages.lookup(request.endpoint, request.view_args, request.args)
+    return static_pages.response(path) if path else None
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    Uses the user snapshot cached in the session when it's still
+    current, so most requests don't query the database for this.
+    """
+
+    g.user = None
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-        g.liked_message_ids =  [m.id for m in g.user.liked_messages]
+        user_id = session[CURR_USER_KEY]
+        version = session_store.user_version(user_id)
+        snapshot = session.get(USER_SNAPSHOT_KEY)
 
-    else:
-        g.user = None
+        if not UserSnapshot.is_current(snapshot, user_id, version):
+            user = User.active().filter_by(id=user_id).first()
+            snapshot = UserSnapshot.build(user, version, shards) if user else None
+            session[USER_SNAPSHOT_KEY] = snapshot
+
+        if snapshot:
+            g.user = UserSnapshot(snapshot, social_graph)
+
+
+@app.template_global()
+def liked_among(messages):
+    """Ids of `messages` the current user likes.
+
+    Read for the messages on the page only, unless the view already put
+    them in g.liked_message_ids.
+    """
+
+    if g.user is None:
+        return set()
+    if 'liked_message_ids' in g:
+        return g.liked_message_ids
+
+    return set(shards.liked_message_ids(g.user.id, among=[msg.id for msg in messages]))
+
+
+def invalidate_user_snapshots(*user_ids):
+    """Make cached snapshots of these users stale in every session."""
+
+    for user_id in user_ids:
+        session_store.bump_user_version(user_id)
+
+
+def refresh_static_pages(users=(), messages=(), authors=(), create=False):
+    """Bring the pre-rendered signed-out pages of these up to date."""
+
+    static_pages.refresh(users, messages, authors, create=create,
+                         in_background=app.config['STATIC_PAGES_IN_BACKGROUND'])
+
+
+def coalesce_notifications_soon():
+    """Fold newly recorded notification events into inboxes shortly."""
+
+    if app.config['NOTIFICATIONS_IN_BACKGROUND']:
+        coalesce_in_background(app, lambda user_ids: invalidate_user_snapshots(*user_ids))
 
         
 # def check_user_logged_in(user_logged_in):
@@ -57,9 +228,86 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def get_cursor(args=None):
+    """Returns the (timestamp, id) paging cursor from the querystring, if any."""
+
+    args = request.args if args is None else args
+    before = args.get('before')
+    before_id = args.get('before_id', type=int)
+
+    if not before or before_id is None:
+        return None
+
+    try:
+        return (datetime.fromisoformat(before), before_id)
+    except ValueError:
+        return None
+
+
+def next_cursor(messages, limit):
+    """Querystring args for the page after `messages`, or None if last page."""
+
+    if len(messages) < limit:
+        return None
+
+    last = messages[-1]
+    return {'before': last.timestamp.isoformat(), 'before_id': last.id}
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response.
+
+    The page is sent in chunks as it renders, so the header goes out
+    before list rows are fetched. Pass queries with `yield_per` as the
+    row source to read them from a server-side cursor as they stream.
+    """
+
+    # pop flashes now: the session cookie is written before the body
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+
+    return Response(stream_with_context(stream))
+
+
+def get_user_or_404(user_id):
+    """Returns the active user with this id, or aborts with a 404."""
+
+    return User.active().filter_by(id=user_id).first_or_404()
+
+
+def get_profile_or_404(user_id):
+    """Profile (user and counters) of the active user with this id, or a 404.
+
+    With messages sharded, the message and like counts come from the shards.
+    """
+
+    row = db.session.execute(profile_query(user_id)).first()
+    if row is None:
+        abort(404)
+
+    user = Profile._make(row)
+    if shards.sharded:
+        user = user._replace(messages=shards.count_messages(user.id),
+                             likes=shards.count_likes(user.id))
+
+    return user
+
+
+def reject_taken(form, fields):
+    """Add a "taken" error to each of these form fields."""
+
+    for field in fields:
+        form[field].errors.append(f"{form[field].label.text} already taken")
+
+
 def do_login(user):
     """Log in user."""
 
+    session.regenerate()
+    session.pop(USER_SNAPSHOT_KEY, None)
     session[CURR_USER_KEY] = user.id
 
 
@@ -69,6 +317,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(USER_SNAPSHOT_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -78,13 +328,19 @@ def signup():
 
     If form not valid, present form.
 
-    If the there already is a user with that username: flash message
-    and re-present form.
+    If the there already is a user with that username or email: show
+    it on the form and re-present it. This is checked before the
+    password is hashed.
     """
 
     form = UserAddForm()
 
     if form.validate_on_submit():
+        taken = taken_names.taken(username=form.username.data, email=form.email.data)
+        if taken:
+            reject_taken(form, taken)
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -98,6 +354,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        taken_names.add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -126,6 +383,17 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.route('/api/username-available')
+def username_available():
+    """JSON saying whether the 'username' param is free, for the signup form."""
+
+    username = request.args.get('username', '').strip()
+
+    return jsonify(username=username,
+                   available=bool(username) and not taken_names.taken(exact=True,
+                                                                       username=username))
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -147,39 +415,63 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html',
+                           users=user_cards(search, STREAM_YIELD_PER),
+                           followed_ids=g.user.following_ids() if g.user else set())
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Shows a page of the user's messages; takes 'before' / 'before_id'
+    params for older pages.
+    """
 
-    user = User.query.get_or_404(user_id)
+    user = get_profile_or_404(user_id)
+    messages = shards.timeline([user.id], MESSAGES_PER_PAGE, before=get_cursor())
 
-    return render_template('users/show.html', user=user, messages=user.messages)
+    return stream_template('users/show.html',
+                           user=user,
+                           stats=UserStats.query.get(user.id),
+                           messages=messages,
+                           older=next_cursor(messages, MESSAGES_PER_PAGE))
 
 
 @app.route('/users/<int:user_id>/following')
 @login_required
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of people this user is following.
+
+    Takes an 'after' param (a user id) for later pages.
+    """
+
+    user = get_profile_or_404(user_id)
+    users, next_after = User.get_following_page(user, after=request.args.get('after', type=int))
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return stream_template('users/following.html',
+                           user=user,
+                           users=users,
+                           followed_ids=g.user.following_ids(among=[u.id for u in users]),
+                           next_after=next_after)
 
 
 @app.route('/users/<int:user_id>/followers')
 @login_required
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of followers of this user.
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    Takes an 'after' param (a user id) for later pages.
+    """
+
+    user = get_profile_or_404(user_id)
+    users, next_after = User.get_followers_page(user, after=request.args.get('after', type=int))
+
+    return stream_template('users/followers.html',
+                           user=user,
+                           users=users,
+                           followed_ids=g.user.following_ids(among=[u.id for u in users]),
+                           next_after=next_after)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -187,9 +479,21 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    get_user_or_404(follow_id)
+
+    if not social_graph.is_following(g.user.id, follow_id):
+        db.session.add(Follows(user_being_followed_id=follow_id,
+                               user_following_id=g.user.id))
+        (FollowSuggestion
+         .query
+         .filter_by(user_id=g.user.id, suggested_user_id=follow_id)
+         .delete())
+        notify(follow_id, FOLLOW, g.user.id)
+        db.session.commit()
+        invalidate_user_snapshots(g.user.id, follow_id)
+        social_graph.follow(g.user.id, follow_id)
+        refresh_static_pages(users=[g.user.id, follow_id])
+        coalesce_notifications_soon()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -199,20 +503,37 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    deleted = (Follows
+               .query
+               .filter_by(user_being_followed_id=follow_id, user_following_id=g.user.id)
+               .delete())
     db.session.commit()
 
+    if deleted:
+        invalidate_user_snapshots(g.user.id, follow_id)
+        social_graph.unfollow(g.user.id, follow_id)
+        refresh_static_pages(users=[g.user.id, follow_id])
+
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
-    """Shows list of liked messages"""
-    
-    liked_messages = g.user.get_sorted_liked_messages()
-    
-    return render_template('users/liked.html', user=g.user, messages=liked_messages)
+    """Shows a page of this user's liked messages.
+
+    Takes optional 'page' and 'order' ("liked" or "posted") params.
+    """
+
+    user = get_profile_or_404(user_id)
+    page = request.args.get('page', 1, type=int)
+    order_by = request.args.get('order', 'liked')
+
+    liked_messages = shards.liked_messages(user.id, page=page, order_by=order_by)
+
+    return render_template('users/liked.html',
+                           user=user,
+                           messages=liked_messages.items,
+                           pagination=liked_messages)
     
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -223,6 +544,13 @@ def profile():
     form = UserEditForm(obj=g.user)
 
     if form.validate_on_submit():
+        old = (g.user.username, g.user.email)
+        taken = taken_names.taken(**{field: form[field].data for field in TakenNames.FIELDS
+                                     if form[field].data != getattr(g.user, field)})
+        if taken:
+            reject_taken(form, taken)
+            return render_template('users/edit.html', form=form)
+
         if User.authenticate(g.user.username, form.password.data):       
             g.user.username = form.username.data
             g.user.email = form.email.data
@@ -230,6 +558,10 @@ def profile():
             g.user.header_image_url = form.header_image_url.data
             g.user.bio = form.bio.data
             db.session.commit()
+            invalidate_user_snapshots(g.user.id)
+            taken_names.replace(old, (g.user.username, g.user.email))
+            # their messages' pages show the username and picture too
+            refresh_static_pages(users=[g.user.id], authors=[g.user.id])
             return redirect(f'/users/{g.user.id}')
 
         flash("Please enter your password to confirm changes")
@@ -246,19 +578,63 @@ def reset_password(user_id):
     if form.validate_on_submit():
         if User.authenticate(g.user.username, form.curr_password.data):       
             g.user.reset_password(form.new_password.data)
+            invalidate_user_snapshots(g.user.id)
             return redirect(f'/users/{g.user.id}')
 
     return render_template('users/reset.html', form=form)
 
+@app.route('/users/<int:user_id>/export')
+@login_required
+def export_user(user_id):
+    """Download all of the current user's data.
+
+    Streams NDJSON of every table by default; with 'format=csv', streams
+    one table (the 'table' param, default messages) as CSV.
+    """
+
+    if user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if request.args.get('format') == 'csv':
+        table = request.args.get('table', 'messages')
+        if table not in USER_TABLES:
+            abort(404)
+
+        rows = (row for _, row in user_rows(user_id, tables=[table], shards=shards))
+        body, mimetype, filename = to_csv(rows, user_columns(table)), 'text/csv', f"{table}.csv"
+    else:
+        body, mimetype, filename = (to_ndjson(user_rows(user_id, shards=shards)),
+                                    'application/x-ndjson', 'warbler.ndjson')
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 @app.route('/users/delete', methods=["POST"])
 @login_required
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is hidden right away; its messages, likes and follows
+    are removed in batches by a background purge.
+    """
 
     do_logout()
 
-    db.session.delete(g.user)
+    g.user.mark_deleted()
     db.session.commit()
+    # followers and followees are invalidated by the purge, as it unlinks them
+    invalidate_user_snapshots(g.user.id)
+    # not re-rendered: the messages stay visible until purged
+    static_pages.remove([(PROFILE, g.user.id)])
+    static_pages.remove_authors([g.user.id],
+                                in_background=app.config['STATIC_PAGES_IN_BACKGROUND'])
+
+    if app.config['PURGE_DELETED_USERS_IN_BACKGROUND']:
+        purge_in_background(app, on_purge=taken_names.remove, shards=shards,
+                            on_unfollow=lambda user_ids: invalidate_user_snapshots(*user_ids))
 
     return redirect("/signup")
 
@@ -277,9 +653,13 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        msg = shards.add_message(g.user.id, form.text.data)
+        record_post(msg.text)
+        notify_mentions(msg)
+        shards.commit()
+        invalidate_user_snapshots(g.user.id)
+        refresh_static_pages(users=[g.user.id], messages=[msg.id], create=True)
+        coalesce_notifications_soon()
 
         return redirect(request.referrer if request.referrer != "http://localhost:5000/messages/new" else f"/users/{g.user.id}")
 
@@ -290,7 +670,10 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = shards.get_message(message_id)
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -299,9 +682,13 @@ def messages_show(message_id):
 def messages_destroy(message_id):
     """Delete a message."""
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    author_id = shards.delete_message(message_id)
+    if author_id is None:
+        abort(404)
+
+    shards.commit()
+    invalidate_user_snapshots(author_id)
+    refresh_static_pages(users=[author_id], messages=[message_id])
 
     return redirect(f"/users/{g.user.id}")
 
@@ -309,9 +696,15 @@ def messages_destroy(message_id):
 def like_message(message_id):
     """Like a message."""
 
-    liked_message = Like(user_id=g.user.id, message_id=message_id)
-    db.session.add(liked_message)
-    db.session.commit()
+    author_id = shards.like(g.user.id, message_id)
+
+    if author_id is not None:
+        record_like(message_id)
+        notify(author_id, LIKE, g.user.id, message_id)
+        shards.commit()
+        invalidate_user_snapshots(g.user.id)
+        refresh_static_pages(users=[g.user.id, author_id], messages=[message_id])
+        coalesce_notifications_soon()
 
     return redirect(request.referrer)
 
@@ -319,14 +712,115 @@ def like_message(message_id):
 def unlike_message(message_id):
     """Unlike a message."""
 
-    liked_message = Like.query.filter((Like.message_id==message_id) & (Like.user_id==g.user.id)).first()
-    
-    db.session.delete(liked_message)
-    db.session.commit()
+    liked_at = shards.unlike(g.user.id, message_id)
+
+    if liked_at is not None:
+        record_like(message_id, when=liked_at, delta=-1)
+        shards.commit()
+        invalidate_user_snapshots(g.user.id)
+
+        msg = shards.get_message(message_id) if static_pages.enabled else None
+        refresh_static_pages(users=[g.user.id] + ([msg.user_id] if msg else []),
+                             messages=[message_id])
 
     return redirect(request.referrer)
 
 
+@app.route('/messages/<int:message_id>/likes')
+def show_message_likers(message_id):
+    """Show a page of users who liked a message, newest likes first.
+
+    Takes 'before' / 'before_id' params for older pages.
+    """
+
+    msg = shards.get_message(message_id)
+    if msg is None:
+        abort(404)
+
+    likers, next_before = shards.likers_page(msg.id, before=get_cursor())
+
+    if next_before:
+        liked_at, user_id = next_before
+        next_before = {'before': liked_at.isoformat(), 'before_id': user_id}
+
+    return render_template('messages/likes.html',
+                           message=msg,
+                           likers=likers,
+                           older=next_before)
+
+
+@app.route('/trending')
+def trending():
+    """Show the most-liked messages and most-used hashtags right now."""
+
+    return render_template('trending.html',
+                           trending=trending_messages(shards=shards),
+                           hashtags=trending_hashtags())
+
+
+##############################################################################
+# Images
+
+
+def thumbnail_cache():
+    """The ThumbnailCache for the current settings, kept so it keeps its byte count."""
+
+    settings = (app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'],
+                app.config['IMAGE_FETCH_REMOTE'])
+
+    if settings not in thumbnail_caches:
+        directory, max_bytes, allow_remote = settings
+        thumbnail_caches[settings] = ThumbnailCache(directory, max_bytes, app.static_folder,
+                                                    allow_remote=allow_remote)
+
+    return thumbnail_caches[settings]
+
+
+@app.route('/images/<size>')
+def image_thumbnail(size):
+    """Serve a cached, resized copy of the image given by the 'src' param."""
+
+    src = request.args.get('src', '')
+
+    # only URLs made by the thumb filter: no fetching arbitrary hosts
+    if size not in SIZES or not valid_signature(src, size, request.args.get('sig'),
+                                                app.config['SECRET_KEY']):
+        abort(404)
+
+    try:
+        path = thumbnail_cache().get(size, src)
+    except ImageSourceError:
+        abort(404)
+
+    response = send_file(path, mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = 30 * 24 * 60 * 60
+    return response
+
+
+@app.route('/notifications')
+@login_required
+def show_notifications():
+    """Show a page of the current user's notifications and mark them read.
+
+    Takes a 'page' param.
+    """
+
+    pagination, notifications = inbox_page(g.user.id,
+                                           page=request.args.get('page', 1, type=int),
+                                           shards=shards)
+    unread = {n.id for n in pagination.items if n.read_at is None}
+
+    if mark_read(g.user.id):
+        db.session.commit()
+        invalidate_user_snapshots(g.user.id)
+
+    return render_template('notifications.html',
+                           pagination=pagination,
+                           notifications=notifications,
+                           unread=unread)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -336,20 +830,19 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: HOME_MESSAGES most recent messages of followed_users
     """
     form = MessageForm()
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(following_ids)) | (Message.user_id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        return render_template('home.html', messages=messages, form=form )
+        following_ids = social_graph.following(g.user.id).tolist()
+        messages = shards.timeline(following_ids + [g.user.id], HOME_MESSAGES)
+        suggestions = g.user.get_follow_suggestions()
+
+        return render_template('home.html',
+                               messages=messages,
+                               suggestions=suggestions,
+                               form=form)
 
     else:
         return render_template('home-anon.html')
@@ -364,8 +857,167 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to every response that doesn't set its own."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
     return response
+
+
+##############################################################################
+# Commands
+
+
+def unsharded_only(f):
+    """Refuse to run a command that reads messages from the main database while sharded."""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if shards.sharded:
+            name = click.get_current_context().info_name
+            raise click.ClickException(f"{name} does not support MESSAGE_SHARDS yet")
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@app.cli.command('archive-messages')
+@click.option('--days', default=ARCHIVE_AFTER.days,
+              help='Archive messages older than this many days.')
+@unsharded_only
+def archive_messages_command(days):
+    """Move old messages into the compressed message archive."""
+
+    count = archive_messages(datetime.utcnow() - timedelta(days=days))
+    print(f"Archived {count} messages")
+
+
+@app.cli.command('recommend-follows')
+@click.option('--top', default=TOP_K, help='Suggestions to keep per user.')
+@click.option('--method', type=click.Choice(['fof', 'ppr']), default='fof',
+              help='Friends-of-friends or personalized PageRank.')
+def recommend_follows_command(top, method):
+    """Recompute who-to-follow suggestions for every user."""
+
+    count = recommend_follows(top, method)
+    print(f"Wrote {count} suggestions")
+
+
+@app.cli.command('prune-trending')
+def prune_trending_command():
+    """Delete trending buckets older than the trending window."""
+
+    count = prune_buckets()
+    print(f"Deleted {count} buckets")
+
+
+@app.cli.command('purge-deleted-users')
+def purge_deleted_users_command():
+    """Remove the data of accounts marked as deleted."""
+
+    count = purge_deleted_users(shards=shards,
+                                on_unfollow=lambda user_ids: invalidate_user_snapshots(*user_ids))
+    print(f"Purged {count} users")
+
+
+@app.cli.command('export-data')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help='One NDJSON file, or a directory of CSV files.')
+def export_data_command(path, fmt):
+    """Export every table to PATH ('-' for NDJSON on stdout)."""
+
+    if fmt == 'csv':
+        export_csv_dir(path, shards)
+    elif path == '-':
+        export_ndjson(click.get_text_stream('stdout'), shards)
+    else:
+        with open(path, 'w') as f:
+            export_ndjson(f, shards)
+
+
+@app.cli.command('import-data')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help='One NDJSON file, or a directory of CSV files.')
+@unsharded_only
+def import_data_command(path, fmt):
+    """Bulk-load an export from PATH into the database."""
+
+    if fmt == 'csv':
+        count = import_csv_dir(path)
+    else:
+        with open(path) as f:
+            count = import_ndjson(f)
+
+    print(f"Imported {count} rows")
+
+
+@app.cli.command('recount-likes')
+@unsharded_only
+def recount_likes_command():
+    """Recompute every message's like count from the likes table."""
+
+    Message.recount_likes()
+    print("Recounted likes")
+
+
+@app.cli.command('compute-stats')
+@click.option('--full', is_flag=True, help='Recompute every user, not just changed ones.')
+@click.option('--processes', type=int, default=None,
+              help='Worker processes (default: one per CPU).')
+@unsharded_only
+def compute_stats_command(full, processes):
+    """Update per-user engagement statistics."""
+
+    count = compute_user_stats(full=full, processes=processes)
+    print(f"Wrote stats for {count} users")
+
+
+@app.cli.command('coalesce-notifications')
+def coalesce_notifications_command():
+    """Fold pending notification events into users' inboxes."""
+
+    changed = coalesce_notifications()
+    invalidate_user_snapshots(*changed)
+    print(f"Updated {len(changed)} inboxes")
+
+
+@app.cli.command('render-static-pages')
+@click.option('--days', default=ACTIVE_DAYS,
+              help='Render users who posted in this many days, and those messages.')
+def render_static_pages_command(days):
+    """Pre-render signed-out pages of active users and their recent messages."""
+
+    if not static_pages.enabled:
+        print("STATIC_PAGES_DIR is not set")
+        return
+
+    messages = shards.recent_messages(datetime.utcnow() - timedelta(days=days))
+    active = {user_id for (user_id,) in (User
+                                         .active()
+                                         .filter(User.id.in_({user_id for _, user_id in messages}))
+                                         .with_entities(User.id))}
+
+    count = static_pages.generate(sorted(active),
+                                  sorted(message_id for message_id, user_id in messages
+                                         if user_id in active))
+    print(f"Rendered {count} pages")
+
+
+@app.cli.command('init-shards')
+def init_shards_command():
+    """Prepare the MESSAGE_SHARDS databases for messages and likes."""
+
+    if not shards.sharded:
+        print("MESSAGE_SHARDS is not set")
+        return
+
+    shards.create_tables()
+    for engine in [db.engine] + shards.engines:
+        shards.release_message_foreign_keys(engine)
+    messages, likes = shards.move_from_main()
+    shards.fill_like_timestamps()
+    shards.interleave_ids()
+    print(f"Moved {messages} messages and {likes} likes from the main database")
+    print(f"Initialized {len(shards)} shards")
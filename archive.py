@@ -0,0 +1,156 @@
+"""Hot/cold storage for messages.
+
+Recent messages live in the `messages` table. Messages older than
+ARCHIVE_AFTER are moved by `archive_messages()` into compressed
+per-user, per-month blocks in `message_archive`, which keeps the hot
+table (and its timestamp indexes) small. Timeline reads go to the hot
+table first and only fall back to the archive when a page runs past it.
+"""
+
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import select
+
+from models import db, Message, MessageArchive, Like
+from readmodels import message_query, message_rows
+
+ARCHIVE_AFTER = timedelta(days=365)
+ARCHIVE_BATCH_SIZE = 1000
+# archive blocks fetched at a time when paging; each is a user's month
+ARCHIVE_READ_BATCH = 4
+
+
+def archive_messages(cutoff=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move messages older than `cutoff` into the archive.
+
+    Works in batches of `batch_size` messages, committing after each one,
+    so it can be stopped and re-run safely. Returns the number of
+    messages archived.
+    """
+
+    if cutoff is None:
+        cutoff = datetime.utcnow() - ARCHIVE_AFTER
+
+    archived = 0
+
+    while True:
+        rows = (db.session
+                .query(Message.id, Message.user_id, Message.text, Message.timestamp)
+                .filter(Message.timestamp < cutoff)
+                .order_by(Message.user_id, Message.timestamp)
+                .limit(batch_size)
+                .all())
+
+        if not rows:
+            return archived
+
+        message_ids = [row.id for row in rows]
+        likers = {}
+        for message_id, user_id in (db.session
+                                    .query(Like.message_id, Like.user_id)
+                                    .filter(Like.message_id.in_(message_ids))):
+            likers.setdefault(message_id, []).append(user_id)
+
+        def period(row):
+            return (row.user_id, row.timestamp.year, row.timestamp.month)
+
+        for (user_id, _, _), group in groupby(rows, key=period):
+            db.session.add(MessageArchive.pack(
+                user_id,
+                [(row.id, row.text, row.timestamp, likers.get(row.id, []))
+                 for row in group],
+            ))
+
+        # likes on these messages go with them via the FK cascade
+        (Message
+         .query
+         .filter(Message.id.in_(message_ids))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+        archived += len(rows)
+
+
+def timeline_query(user_ids, limit, before=None):
+    """Select of the newest `limit` hot messages by any of `user_ids`."""
+
+    query = (message_query()
+             .where(Message.user_id.in_(user_ids))
+             .order_by(Message.timestamp.desc(), Message.id.desc()))
+
+    if before:
+        query = query.where(db.tuple_(Message.timestamp, Message.id) < before)
+
+    return query.limit(limit)
+
+
+def timeline(user_ids, limit, before=None):
+    """Most recent `limit` messages by any of `user_ids`.
+
+    `before` is an optional (timestamp, id) cursor; only messages older
+    than it are returned. Hot messages come back as MessageRows; once
+    those run out the page is filled from the archive.
+    """
+
+    messages = message_rows(db.session.execute(timeline_query(user_ids, limit, before)))
+    return with_archived(messages, user_ids, limit, before)
+
+
+def with_archived(messages, user_ids, limit, before=None):
+    """Fill a short page of hot `messages` up to `limit` from the archive."""
+
+    if len(messages) < limit:
+        if messages:
+            before = (messages[-1].timestamp, messages[-1].id)
+        messages += archived_timeline(user_ids, limit - len(messages), before)
+
+    return messages
+
+
+def archive_blocks_query(user_ids, before=None):
+    """Select of archive blocks for `user_ids`, newest first."""
+
+    query = (select(MessageArchive)
+             .where(MessageArchive.user_id.in_(user_ids))
+             .options(db.joinedload(MessageArchive.user)
+                      .load_only('id', 'username', 'image_url'))
+             .order_by(MessageArchive.period_end.desc()))
+
+    if before:
+        query = query.where(MessageArchive.period_start <= before[0])
+
+    return query
+
+
+def pick_archived(blocks, limit, before=None):
+    """Most recent `limit` messages out of newest-first `blocks`."""
+
+    def key(msg):
+        return (msg.timestamp, msg.id)
+
+    found = []
+
+    for block in blocks:
+        # blocks come newest-first, so once we have a full page that is
+        # newer than everything left we can stop decompressing
+        if len(found) >= limit and block.period_end < found[limit - 1].timestamp:
+            break
+
+        found.extend(msg for msg in block.unpack()
+                     if before is None or key(msg) < before)
+        found.sort(key=key, reverse=True)
+
+    return found[:limit]
+
+
+def archived_timeline(user_ids, limit, before=None):
+    """Most recent `limit` archived messages by any of `user_ids`."""
+
+    # streamed, so the blocks (and payloads) past a full page are never fetched
+    query = archive_blocks_query(user_ids, before).execution_options(yield_per=ARCHIVE_READ_BATCH)
+    blocks = db.session.execute(query).scalars()
+    try:
+        return pick_archived(blocks, limit, before)
+    finally:
+        blocks.close()
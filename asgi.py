@@ -0,0 +1,362 @@
+"""ASGI entry point with an asyncio read path for the hottest pages.
+
+    uvicorn asgi:application
+
+GETs of the homepage, profiles, single messages and user searches
+(`/users?q=...`) are served by coroutines that read Postgres through
+SQLAlchemy's asyncio extension (asyncpg) and one shared connection
+pool, so a slow query parks a coroutine instead of a worker and one
+process can have hundreds of reads in flight. They run the same
+statements (archive.py, readmodels.py) and render the same templates
+as the Flask views.
+
+Everything else -- writes, other pages, requests the fast path can't
+finish by itself (a logged-in session without a current user snapshot,
+pending flash messages, unknown ids), signed-out views with a
+pre-rendered page (see staticpages.py), and all of these pages when
+messages are sharded (see shards.py) -- goes to the Flask app
+through asgiref's WSGI adapter, which runs it in a thread pool.
+
+Flask's context locals aren't coroutine-aware, so a request context is
+only pushed around the synchronous render, after every await. Session
+reads go to the session store (a SQLite file by default), so they run
+in asgiref's thread pool rather than on the event loop.
+
+Fast-path responses go through the same CompressionMiddleware as the
+Flask app's.
+"""
+
+import io
+import sys
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, render_template
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import HTTPException
+
+from app import (app, session_store, shards, static_pages, CURR_USER_KEY, USER_SNAPSHOT_KEY,
+                 MESSAGES_PER_PAGE, HOME_MESSAGES, get_cursor, next_cursor)
+from archive import timeline_query, archive_blocks_query, pick_archived
+from compression import CompressionMiddleware
+from forms import MessageForm
+from models import db, User, UserSnapshot, Follows, FollowSuggestion, UserStats, Message, Like
+from readmodels import (Profile, UserCard, message_query, message_rows, profile_query,
+                        user_card_query)
+
+engine = create_async_engine(app.config['ASYNC_DATABASE_URL'],
+                             pool_size=app.config['ASYNC_DB_POOL_SIZE'],
+                             max_overflow=app.config['ASYNC_DB_MAX_OVERFLOW'])
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+flask_app = WsgiToAsgi(app)
+
+
+class FollowSet:
+    """Stands in for SocialGraph for the current user, from ids read up front."""
+
+    def __init__(self, user_id, ids):
+        self.user_id = user_id
+        self.ids = ids
+
+    def following_ids(self, user_id, among=None):
+        return self.ids if among is None else self.ids & set(among)
+
+    def is_following(self, user_id, other_id):
+        return user_id == self.user_id and other_id in self.ids
+
+
+class ReadRequest:
+    """A request on the async path, with its session and current user."""
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.request = app.request_class(environ)
+        # read by load_session()
+        self.session = None
+        self.user_id = None
+        self.followed = set()
+        # liked ids among the page's messages, read by the view
+        self.liked = set()
+
+    async def load_session(self):
+        """Read the session from the session store, off the event loop."""
+
+        self.session = await sync_to_async(app.session_interface.open_session,
+                                           thread_sensitive=False)(app, self.request)
+        self.user_id = self.session.get(CURR_USER_KEY)
+
+    async def can_serve(self):
+        """Can this be answered without Flask's before_request hooks?"""
+
+        if '_flashes' in self.session:
+            return False
+
+        if self.user_id is None:
+            return True
+
+        version = await sync_to_async(session_store.user_version,
+                                      thread_sensitive=False)(self.user_id)
+        return UserSnapshot.is_current(self.session.get(USER_SNAPSHOT_KEY), self.user_id,
+                                       version)
+
+    def render(self, render):
+        """Run `render` in a request context; returns the Flask response."""
+
+        ctx = app.request_context(self.environ)
+        ctx.session = self.session
+        ctx.push()
+
+        try:
+            g.user = None
+            if self.user_id is not None:
+                g.user = UserSnapshot(self.session[USER_SNAPSHOT_KEY],
+                                      FollowSet(self.user_id, self.followed))
+                g.liked_message_ids = self.liked
+
+            return app.process_response(app.make_response(render()))
+        finally:
+            ctx.pop()
+
+
+##############################################################################
+# Async queries
+
+
+async def following_ids(db_session, user_id):
+    """Set of active user ids that `user_id` follows."""
+
+    result = await db_session.execute(
+        select(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id, User.deleted_at.is_(None)))
+
+    return set(result.scalars())
+
+
+async def liked_ids(db_session, user_id, messages):
+    """Set of ids of `messages` that `user_id` likes."""
+
+    result = await db_session.execute(
+        select(Like.message_id)
+        .where(Like.user_id == user_id, Like.message_id.in_([msg.id for msg in messages])))
+
+    return set(result.scalars())
+
+
+async def timeline(db_session, user_ids, limit, before=None):
+    """archive.timeline() on an AsyncSession."""
+
+    messages = message_rows(await db_session.execute(timeline_query(user_ids, limit, before)))
+
+    if len(messages) < limit:
+        if messages:
+            before = (messages[-1].timestamp, messages[-1].id)
+        blocks = await db_session.execute(archive_blocks_query(user_ids, before))
+        messages += pick_archived(blocks.scalars(), limit - len(messages), before)
+
+    return messages
+
+
+##############################################################################
+# Views
+#
+# Each does its queries, then returns a function that renders the page
+# (called inside a request context), or None to leave it to Flask.
+
+
+async def homepage(db_session, req):
+    if req.user_id is None:
+        return lambda: render_template('home-anon.html')
+
+    messages = await timeline(db_session, list(req.followed) + [req.user_id], HOME_MESSAGES)
+    req.liked = await liked_ids(db_session, req.user_id, messages)
+    suggestions = (await db_session.execute(
+        select(FollowSuggestion)
+        .where(FollowSuggestion.user_id == req.user_id)
+        .options(db.joinedload(FollowSuggestion.suggested_user))
+        .order_by(FollowSuggestion.rank)
+        .limit(5))).scalars().all()
+
+    return lambda: render_template('home.html',
+                                   messages=messages,
+                                   suggestions=suggestions,
+                                   form=MessageForm())
+
+
+async def users_show(db_session, req, user_id):
+    row = (await db_session.execute(profile_query(user_id))).first()
+    if row is None:
+        return None
+
+    stats = await db_session.get(UserStats, user_id)
+    messages = await timeline(db_session, [user_id], MESSAGES_PER_PAGE,
+                              before=get_cursor(req.request.args))
+    if req.user_id is not None:
+        req.liked = await liked_ids(db_session, req.user_id, messages)
+
+    return lambda: render_template('users/show.html',
+                                   user=Profile._make(row),
+                                   stats=stats,
+                                   messages=messages,
+                                   older=next_cursor(messages, MESSAGES_PER_PAGE))
+
+
+async def messages_show(db_session, req, message_id):
+    messages = message_rows(await db_session.execute(
+        message_query().where(Message.id == message_id)))
+    if not messages:
+        return None
+
+    return lambda: render_template('messages/show.html', message=messages[0])
+
+
+async def list_users(db_session, req):
+    search = req.request.args.get('q')
+    if not search:
+        # the full list is streamed by the Flask view
+        return None
+
+    users = [UserCard._make(row)
+             for row in await db_session.execute(user_card_query(search))]
+
+    return lambda: render_template('users/index.html',
+                                   users=users,
+                                   followed_ids=req.followed)
+
+
+ASYNC_VIEWS = {
+    'homepage': homepage,
+    'users_show': users_show,
+    'messages_show': messages_show,
+    'list_users': list_users,
+}
+
+
+##############################################################################
+# ASGI plumbing
+
+
+def build_environ(scope):
+    """WSGI environ for a body-less ASGI http request."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{name}"
+        value = value.decode('latin1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+def run_wsgi(wsgi_app, environ):
+    """(status code, headers, body) of a WSGI app's response."""
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split()[0]), headers]
+
+    chunks = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    return started[0], started[1], body
+
+
+async def serve(scope, send):
+    """Answer a GET on the async path. Returns False to fall back to Flask."""
+
+    environ = build_environ(scope)
+
+    try:
+        endpoint, args = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return False
+
+    view = None if shards.sharded else ASYNC_VIEWS.get(endpoint)
+    if view is None:
+        return False
+
+    req = ReadRequest(environ)
+    await req.load_session()
+    if not await req.can_serve():
+        return False
+
+    if req.user_id is None and static_pages.lookup(endpoint, args, req.request.args):
+        return False
+
+    async with Session() as db_session:
+        if req.user_id is not None:
+            req.followed = await following_ids(db_session, req.user_id)
+        render = await view(db_session, req, **args)
+
+    if render is None:
+        return False
+
+    response = req.render(render)
+    status, headers, body = run_wsgi(CompressionMiddleware(response, app.config), environ)
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in headers],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b'' if scope['method'] == 'HEAD' else body,
+    })
+
+    return True
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI app: async read path first, Flask for everything else."""
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        if await serve(scope, send):
+            return
+
+    await flask_app(scope, receive, send)
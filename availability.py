@@ -0,0 +1,164 @@
+"""Cheap "is this username / e-mail free?" checks for signup.
+
+Signing up hashes the password with bcrypt, which is slow on purpose,
+so signups bound to fail on a taken username or e-mail are turned away
+before hashing. `TakenNames` keeps a counting Bloom filter of every
+username and e-mail in `users` (deleted accounts included, until they
+are purged): a name the filter has never seen is free without touching
+the database, and one it may have seen is confirmed with a lookup on the
+column's unique index.
+
+The filter is built from the table on first use, rebuilt every
+REBUILD_EVERY seconds, and kept in step by signups and profile edits in
+this process. Other workers' changes only reach it when it is rebuilt.
+For signup that is harmless: a missed name just falls through to the
+unique constraint (the old IntegrityError path), and a stale one costs
+an index lookup. Answers shown to the user (`taken(exact=True)`, used by
+the availability API) always go to the index.
+
+Only names this process added since the last rebuild are removed from
+the filter again: a name it merely seems to hold (a false positive, or
+one added by another worker) would take other names' counters down
+with it. Purged names loaded from the table stay until the next rebuild,
+which only costs an index lookup.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+import numpy as np
+
+from models import db, User
+
+ERROR_RATE = 0.01
+MIN_CAPACITY = 1024
+LOAD_YIELD_PER = 1000
+REBUILD_EVERY = 60 * 60
+
+
+class CountingBloomFilter:
+    """Bloom filter with 8-bit counters, so keys can also be removed."""
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 1)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.counters = np.zeros(self.size, dtype=np.uint8)
+        self.count = 0
+
+    def _slots(self, key):
+        digest = hashlib.blake2b(key.encode('UTF-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        slots = self._slots(key)
+        # saturated counters stay put, so they can never drop to zero
+        self.counters[slots] = np.minimum(self.counters[slots].astype(np.uint16) + 1, 255)
+        self.count += 1
+
+    def remove(self, key):
+        """Remove a key that was added; removing others corrupts the filter."""
+
+        slots = [slot for slot in self._slots(key) if 0 < self.counters[slot] < 255]
+        self.counters[slots] -= 1
+        self.count -= 1
+
+    def __contains__(self, key):
+        return bool(self.counters[self._slots(key)].all())
+
+    def __len__(self):
+        return self.count
+
+
+class TakenNames:
+    """Usernames and e-mails in use, answered by Bloom filter, then index."""
+
+    FIELDS = {'username': User.username, 'email': User.email}
+
+    def __init__(self, error_rate=ERROR_RATE):
+        self.error_rate = error_rate
+        self.filter = None
+        self.loaded_at = 0
+        # keys add() put in the filter since it was built
+        self.added = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(field, value):
+        return f"{field}:{value}"
+
+    def load(self):
+        """(Re)build the filter from the users table."""
+
+        users = db.session.query(db.func.count(User.id)).scalar()
+        # two keys per user, and room for as many again
+        bloom = CountingBloomFilter(max(users * 4, MIN_CAPACITY), self.error_rate)
+
+        for username, email in (db.session
+                                .query(User.username, User.email)
+                                .yield_per(LOAD_YIELD_PER)):
+            bloom.add(self._key('username', username))
+            bloom.add(self._key('email', email))
+
+        with self.lock:
+            self.filter = bloom
+            self.loaded_at = time.time()
+            self.added = set()
+
+    def _bloom(self):
+        # rebuilt bigger once it holds more than it was sized for
+        if (self.filter is None or len(self.filter) > self.filter.capacity
+                or time.time() - self.loaded_at > REBUILD_EVERY):
+            self.load()
+        return self.filter
+
+    def might_be_taken(self, field, value):
+        """False if `value` is certainly free; True if it may be taken."""
+
+        return self._key(field, value) in self._bloom()
+
+    def taken(self, exact=False, **values):
+        """Names of the fields (username=..., email=...) whose value is taken.
+
+        With `exact`, every value is looked up in the index, so names other
+        workers added since the last rebuild are seen too.
+        """
+
+        taken = []
+
+        for field, value in values.items():
+            if not value or not (exact or self.might_be_taken(field, value)):
+                continue
+
+            column = self.FIELDS[field]
+            if db.session.query(column).filter(column == value).first() is not None:
+                taken.append(field)
+
+        return taken
+
+    def add(self, username, email):
+        bloom = self._bloom()
+        with self.lock:
+            for key in (self._key('username', username), self._key('email', email)):
+                bloom.add(key)
+                self.added.add(key)
+
+    def remove(self, username, email):
+        """Forget a pair, if this process added it since the last rebuild."""
+
+        with self.lock:
+            for key in (self._key('username', username), self._key('email', email)):
+                if key in self.added:
+                    self.filter.remove(key)
+                    self.added.discard(key)
+
+    def replace(self, old, new):
+        """Swap (username, email) pair `old` for `new`, e.g. on a profile edit."""
+
+        if old != new:
+            self.remove(*old)
+            self.add(*new)
@@ -0,0 +1,283 @@
+"""Bulk export and import of Warbler data.
+
+Exports stream rows straight from server-side cursors (`yield_per`), so
+memory use stays flat however large the tables are. Two formats are
+supported:
+
+- NDJSON: one `{"table": ..., "row": {...}}` object per line, all
+  tables in one stream.
+- CSV: one file per table, with a header row, in the same layout as the
+  seed files in generator/.
+
+Imports read either format back and load it in batches with
+`bulk_insert_mappings`, the same path seed.py uses.
+
+Exports take an optional ShardSet, to read messages and likes from the
+shards when they are sharded (see shards.py).
+"""
+
+import base64
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+from models import db, User, Message, Follows, Like, MessageArchive
+
+YIELD_PER = 1000
+IMPORT_BATCH_SIZE = 5000
+
+# in dependency order, so imports never reference missing rows
+TABLES = {
+    'users': User,
+    'messages': Message,
+    'message_archive': MessageArchive,
+    'follows': Follows,
+    'likes': Like,
+}
+
+# tables that live on the shards when messages are sharded
+SHARDED_TABLES = ('messages', 'likes')
+
+# tables in a single user's export
+USER_TABLES = ('users', 'messages', 'follows', 'likes')
+
+# never include password hashes in a user's own export
+PROFILE_COLUMNS = ['id', 'email', 'username', 'image_url', 'header_image_url',
+                   'bio', 'location']
+
+
+def columns(table):
+    """Column names of `table`, in schema order."""
+
+    return [col.name for col in TABLES[table].__table__.columns]
+
+
+def to_json_value(value):
+    """Value as something json (or csv) can hold."""
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+
+def from_json_value(column, value):
+    """Value read from an export, converted back for `column`."""
+
+    if value is None or (value == "" and column.nullable
+                         and not isinstance(column.type, db.String)):
+        return None
+    if isinstance(column.type, db.DateTime) and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, db.LargeBinary) and isinstance(value, str):
+        return base64.b64decode(value)
+    if isinstance(column.type, db.Integer) and isinstance(value, str):
+        return int(value)
+    return value
+
+
+##############################################################################
+# Export
+
+
+def table_sessions(table, shards=None):
+    """Sessions holding `table`'s rows: every shard's, for sharded tables."""
+
+    if shards is not None and shards.sharded and table in SHARDED_TABLES:
+        return shards.sessions
+    return [db.session]
+
+
+def table_rows(table, condition=None, names=None, session=None):
+    """Stream rows of `table` as dicts, optionally filtered by `condition`."""
+
+    model = TABLES[table]
+    names = names or columns(table)
+    query = (session or db.session).query(*[getattr(model, name) for name in names])
+
+    if condition is not None:
+        query = query.filter(condition)
+
+    for row in query.yield_per(YIELD_PER):
+        yield {name: to_json_value(value) for name, value in zip(names, row)}
+
+
+def dataset_rows(shards=None):
+    """Stream (table, row) pairs for every table."""
+
+    for table in TABLES:
+        for session in table_sessions(table, shards):
+            for row in table_rows(table, session=session):
+                yield table, row
+
+
+def user_rows(user_id, tables=USER_TABLES, shards=None):
+    """Stream (table, row) pairs for everything belonging to one user.
+
+    Only `tables` are included. Archived messages are unpacked into
+    ordinary message rows.
+    """
+
+    # a user's messages and likes are all on their shard
+    session = shards.for_user(user_id) if shards is not None else db.session
+
+    if 'users' in tables:
+        for row in table_rows('users', User.id == user_id, PROFILE_COLUMNS):
+            yield 'users', row
+
+    if 'messages' in tables:
+        for row in table_rows('messages', Message.user_id == user_id, session=session):
+            yield 'messages', row
+
+        blocks = (MessageArchive
+                  .query
+                  .filter_by(user_id=user_id)
+                  .order_by(MessageArchive.period_start)
+                  .yield_per(10))
+        for block in blocks:
+            for msg in block.unpack():
+                yield 'messages', {'id': msg.id,
+                                   'text': msg.text,
+                                   'timestamp': to_json_value(msg.timestamp),
+                                   'user_id': user_id,
+                                   'like_count': msg.like_count}
+
+    if 'follows' in tables:
+        follows = ((Follows.user_being_followed_id == user_id)
+                   | (Follows.user_following_id == user_id))
+        for row in table_rows('follows', follows):
+            yield 'follows', row
+
+    if 'likes' in tables:
+        for row in table_rows('likes', Like.user_id == user_id, session=session):
+            yield 'likes', row
+
+
+def user_columns(table):
+    """Column names of `table` as it appears in a user's export."""
+
+    return PROFILE_COLUMNS if table == 'users' else columns(table)
+
+
+def to_ndjson(rows):
+    """Encode (table, row) pairs as NDJSON lines."""
+
+    for table, row in rows:
+        yield json.dumps({'table': table, 'row': row}) + "\n"
+
+
+def to_csv(rows, names):
+    """Encode row dicts as CSV text chunks, header first."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=names)
+    writer.writeheader()
+
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_ndjson(f, shards=None):
+    """Write the whole dataset to file `f` as NDJSON."""
+
+    for line in to_ndjson(dataset_rows(shards)):
+        f.write(line)
+
+
+def export_csv_dir(directory, shards=None):
+    """Write one <table>.csv per table into `directory`."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    for table in TABLES:
+        rows = (row for session in table_sessions(table, shards)
+                for row in table_rows(table, session=session))
+        with open(os.path.join(directory, f"{table}.csv"), 'w', newline='') as f:
+            for chunk in to_csv(rows, columns(table)):
+                f.write(chunk)
+
+
+##############################################################################
+# Import
+
+
+def import_rows(rows, batch_size=IMPORT_BATCH_SIZE):
+    """Bulk-insert (table, row) pairs. Returns the number of rows loaded.
+
+    Rows are buffered and flushed in batches, and whenever the table
+    changes, so referenced rows are always written first as long as
+    they come first in `rows`.
+    """
+
+    table = None
+    batch = []
+    count = 0
+
+    for row_table, row in rows:
+        if batch and (row_table != table or len(batch) >= batch_size):
+            db.session.bulk_insert_mappings(TABLES[table], batch)
+            batch = []
+
+        table = row_table
+        table_columns = TABLES[table].__table__.columns
+        batch.append({name: from_json_value(table_columns[name], value)
+                      for name, value in row.items()})
+        count += 1
+
+    if batch:
+        db.session.bulk_insert_mappings(TABLES[table], batch)
+
+    reset_sequences()
+    db.session.commit()
+
+    return count
+
+
+def import_ndjson(f, batch_size=IMPORT_BATCH_SIZE):
+    """Load an NDJSON export from file `f`."""
+
+    def rows():
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['table'], record['row']
+
+    return import_rows(rows(), batch_size)
+
+
+def import_csv_dir(directory, batch_size=IMPORT_BATCH_SIZE):
+    """Load every <table>.csv found in `directory`."""
+
+    count = 0
+
+    for table in TABLES:
+        path = os.path.join(directory, f"{table}.csv")
+
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                count += import_rows(((table, row) for row in csv.DictReader(f)),
+                                     batch_size)
+
+    return count
+
+
+def reset_sequences():
+    """Move id sequences past imported ids (Postgres only)."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for table, model in TABLES.items():
+        if 'id' in model.__table__.columns:
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table}"))
@@ -0,0 +1,88 @@
+"""Micro-benchmark: full ORM entities vs. projection rows.
+
+Loads the same timeline page and user list both ways and reports the
+time per row and the memory each load allocates (peak) and keeps alive
+for its result (retained), as measured by tracemalloc.
+
+    python bench_readmodels.py [--rows 1000] [--repeat 5]
+
+Runs against DATABASE_URL (default: the development database), which
+should already be seeded (python seed.py).
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from app import app
+from models import db, User, Message
+from readmodels import UserCard, message_query, message_rows, user_card_query
+
+
+def orm_timeline(rows):
+    return (Message
+            .query
+            .options(db.joinedload(Message.user))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(rows)
+            .all())
+
+
+def row_timeline(rows):
+    return message_rows(db.session.execute(
+        message_query()
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(rows)))
+
+
+def orm_users(rows):
+    return User.query.limit(rows).all()
+
+
+def row_users(rows):
+    return [UserCard._make(row)
+            for row in db.session.execute(user_card_query().limit(rows))]
+
+
+def measure(load, rows, repeat):
+    """(rows loaded, best seconds per row, peak bytes, retained bytes)."""
+
+    best = float('inf')
+
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        result = load(rows)
+        best = min(best, time.perf_counter() - start)
+        del result
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    result = load(rows)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = max(len(result), 1)
+    return len(result), best / count, peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'load':<16}{'rows':>8}{'us/row':>10}{'peak KiB':>12}{'kept KiB':>12}")
+
+    with app.app_context():
+        for name, load in (('orm timeline', orm_timeline),
+                           ('row timeline', row_timeline),
+                           ('orm users', orm_users),
+                           ('row users', row_users)):
+            count, per_row, peak, retained = measure(load, args.rows, args.repeat)
+            print(f"{name:<16}{count:>8}{per_row * 1e6:>10.1f}"
+                  f"{peak / 1024:>12.1f}{retained / 1024:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
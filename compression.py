@@ -0,0 +1,185 @@
+"""gzip/brotli compression of HTML and JSON responses.
+
+`CompressionMiddleware` wraps the WSGI app, so it sees every response
+last -- after the after_request hooks and the debug toolbar -- and
+compresses HTML and JSON bodies for clients that send a matching
+Accept-Encoding: brotli when it is installed and accepted, else gzip.
+
+Responses with a Content-Length under the size threshold are sent as
+they are; compressing a redirect page or a small JSON answer costs more
+than it saves. Streamed responses (see `stream_template`) have no
+length and are compressed chunk by chunk, flushing the compressor after
+each one so the page still reaches the browser as it renders.
+
+A compressed file from `send_file` is no longer byte-for-byte the file
+its ETag names, so its ETag is made weak -- still good for
+If-None-Match -- and Accept-Ranges is dropped.
+
+`WhitespaceStripper` is a Jinja extension that drops the indentation
+and blank lines from template source before it is compiled, so pages
+are smaller before compression at no cost per render.
+"""
+
+import re
+import zlib
+
+from jinja2.ext import Extension
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'text/html', 'application/json', 'application/x-ndjson'}
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# dynamic pages are compressed per request: brotli's top qualities are far too slow
+BROTLI_QUALITY = 5
+
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header."""
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    # ties go to the first offered, i.e. brotli
+    scores = [(accepted.get(coding, accepted.get('*', 0.0)), -rank, coding)
+              for rank, coding in enumerate(offered)]
+    quality, _, coding = max(scores)
+
+    return coding if quality > 0 else None
+
+
+class Compressor:
+    """Incremental gzip or brotli compressor with the same three calls."""
+
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress = self.compressor.process
+            self._flush = self.compressor.flush
+            self._finish = self.compressor.finish
+        else:
+            # wbits 16+ writes a gzip header and trailer
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = self.compressor.compress
+            self._flush = lambda: self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self.compressor.flush
+
+    def compress(self, data, flush=False):
+        out = self._compress(data)
+        return out + self._flush() if flush else out
+
+    def finish(self):
+        return self._finish()
+
+
+def header(headers, name):
+    name = name.lower()
+    return next((value for key, value in headers if key.lower() == name), None)
+
+
+def compressible(status, headers, min_size):
+    """Is a response with this status and these headers worth compressing?"""
+
+    if not status.startswith('200') or header(headers, 'Content-Encoding'):
+        return False
+
+    content_type = (header(headers, 'Content-Type') or '').split(';')[0].strip().lower()
+    if content_type not in COMPRESSIBLE_TYPES:
+        return False
+
+    length = header(headers, 'Content-Length')
+    return length is None or int(length) >= min_size
+
+
+def weak_etag(etag):
+    return etag if etag.startswith('W/') else f"W/{etag}"
+
+
+def compress_chunks(chunks, compressor):
+    """Compress an app iterator, flushing after each non-empty chunk."""
+
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk, flush=True)
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing HTML and JSON responses.
+
+    Reads COMPRESS_RESPONSES and COMPRESS_MIN_SIZE from `config` on each
+    request, so they can be changed after the app is wrapped.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        if not self.config.get('COMPRESS_RESPONSES', True):
+            return self.app(environ, start_response)
+
+        encoding = None
+        if environ['REQUEST_METHOD'] != 'HEAD':
+            encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        min_size = self.config.get('COMPRESS_MIN_SIZE', MIN_SIZE)
+        compressor = None
+
+        def start(status, headers, exc_info=None):
+            nonlocal compressor
+
+            content_type = (header(headers, 'Content-Type') or '').split(';')[0]
+            if content_type.strip().lower() in COMPRESSIBLE_TYPES:
+                vary = header(headers, 'Vary')
+                if vary is None:
+                    headers.append(('Vary', 'Accept-Encoding'))
+                elif 'accept-encoding' not in vary.lower():
+                    headers = [(key, f"{value}, Accept-Encoding"
+                                if key.lower() == 'vary' else value)
+                               for key, value in headers]
+
+            if encoding is not None and compressible(status, headers, min_size):
+                compressor = Compressor(encoding)
+                headers = [(key, weak_etag(value) if key.lower() == 'etag' else value)
+                           for key, value in headers
+                           if key.lower() not in ('content-length', 'accept-ranges')]
+                headers.append(('Content-Encoding', encoding))
+
+            return start_response(status, headers, exc_info)
+
+        chunks = self.app(environ, start)
+
+        # Flask (werkzeug) calls start_response before returning its iterator
+        if compressor is None:
+            return chunks
+        return compress_chunks(chunks, compressor)
+
+
+class WhitespaceStripper(Extension):
+    """Strip indentation and blank lines from template source.
+
+    Newlines are kept, so inline scripts with // comments still work.
+    Don't enable it for templates with <pre> or <textarea> content.
+    """
+
+    def preprocess(self, source, name, filename=None):
+        source = re.sub(r'^[ \t]+', '', source, flags=re.M)
+        return re.sub(r'\n\s*\n', '\n', source)
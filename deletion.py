@@ -0,0 +1,147 @@
+"""Removal of deleted accounts.
+
+Deleting an account only marks the user row (see User.mark_deleted), so
+the request stays fast. `purge_deleted_users()` then removes the user's
+rows a bounded batch at a time, committing after each batch so no single
+transaction holds locks for long. Deleting a message takes its likes,
+trending buckets and so on with it through the `ondelete="cascade"`
+foreign keys; the user row itself goes last.
+
+The purge runs in a background thread after each deletion and can also
+be run with `flask purge-deleted-users`, e.g. from cron, to pick up
+anything a restart interrupted. Purges hold a Postgres advisory lock, so
+overlapping runs take turns instead of uncounting the same likes twice.
+With messages sharded, pass the ShardSet:
+messages and likes are then deleted from the shards (see
+ShardSet.purge_user).
+
+Followers and followees of a deleted account are told about it here,
+through `on_unfollow`, a batch of ids at a time once their follows are
+gone -- not in the delete request, which would cost O(followers).
+"""
+
+import threading
+
+from sqlalchemy import select
+
+from models import (db, User, Message, Like, Follows, MessageArchive, FollowSuggestion,
+                    NotificationActor)
+
+PURGE_BATCH_SIZE = 500
+# pg_advisory_lock key held while purging
+LOCK_KEY = 4202
+
+
+def delete_in_batches(key_cols, condition, batch_size=PURGE_BATCH_SIZE, before_delete=None,
+                      after_delete=None):
+    """Delete rows matching `condition`, `batch_size` rows per transaction.
+
+    `key_cols` are the primary key columns of the table to delete from.
+    `before_delete`, if given, is called with each batch of keys inside
+    its transaction, and `after_delete` once it is committed. Returns the
+    number of rows deleted.
+    """
+
+    model = key_cols[0].class_
+    deleted = 0
+
+    while True:
+        keys = db.session.query(*key_cols).filter(condition).limit(batch_size).all()
+
+        if not keys:
+            return deleted
+
+        if before_delete:
+            before_delete(keys)
+
+        (model
+         .query
+         .filter(db.tuple_(*key_cols).in_(keys))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+        if after_delete:
+            after_delete(keys)
+
+        deleted += len(keys)
+
+
+def purge_user(user_id, batch_size=PURGE_BATCH_SIZE, shards=None, on_unfollow=None):
+    """Remove everything belonging to deleted user `user_id`, then the user.
+
+    `on_unfollow`, if given, is called with each batch of ids of users
+    whose follows with `user_id` were removed. Returns whether this call
+    deleted the user row.
+    """
+
+    def unfollowed(keys):
+        if on_unfollow:
+            on_unfollow([other for pair in keys for other in pair if other != user_id])
+
+    if shards is not None and shards.sharded:
+        shards.purge_user(user_id, batch_size)
+    else:
+        delete_in_batches([Message.id], Message.user_id == user_id, batch_size)
+        delete_in_batches([Like.user_id, Like.message_id], Like.user_id == user_id, batch_size,
+                          before_delete=lambda keys: Message.adjust_like_counts(
+                              [message_id for _, message_id in keys], -1))
+
+    delete_in_batches([MessageArchive.id], MessageArchive.user_id == user_id, batch_size)
+    delete_in_batches([Follows.user_being_followed_id, Follows.user_following_id],
+                      Follows.user_being_followed_id == user_id, batch_size,
+                      after_delete=unfollowed)
+    delete_in_batches([Follows.user_being_followed_id, Follows.user_following_id],
+                      Follows.user_following_id == user_id, batch_size,
+                      after_delete=unfollowed)
+    delete_in_batches([FollowSuggestion.user_id, FollowSuggestion.rank],
+                      FollowSuggestion.suggested_user_id == user_id, batch_size)
+    delete_in_batches([NotificationActor.notification_id, NotificationActor.actor_id],
+                      NotificationActor.actor_id == user_id, batch_size)
+
+    deleted = User.query.filter_by(id=user_id).delete()
+    db.session.commit()
+
+    return deleted > 0
+
+
+def purge_deleted_users(batch_size=PURGE_BATCH_SIZE, on_purge=None, shards=None,
+                        on_unfollow=None):
+    """Purge every account marked as deleted. Returns how many.
+
+    `on_purge`, if given, is called with the username and e-mail of each
+    account once it's gone -- once per account, by the purge that deleted
+    its user row. `on_unfollow` is passed on to `purge_user()`.
+    """
+
+    # a session-level lock on a connection of its own: the session's
+    # connection goes back to the pool at every commit
+    with db.engine.connect() as lock:
+        lock.execute(select(db.func.pg_advisory_lock(LOCK_KEY)))
+        try:
+            users = (db.session
+                     .query(User.id, User.username, User.email)
+                     .filter(User.deleted_at.isnot(None))
+                     .all())
+
+            purged = 0
+            for user_id, username, email in users:
+                if purge_user(user_id, batch_size, shards, on_unfollow):
+                    purged += 1
+                    if on_purge:
+                        on_purge(username, email)
+        finally:
+            lock.execute(select(db.func.pg_advisory_unlock(LOCK_KEY)))
+
+    return purged
+
+
+def purge_in_background(app, on_purge=None, shards=None, on_unfollow=None):
+    """Run purge_deleted_users() in a daemon thread."""
+
+    def run():
+        with app.app_context():
+            purge_deleted_users(on_purge=on_purge, shards=shards, on_unfollow=on_unfollow)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
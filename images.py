@@ -0,0 +1,257 @@
+"""Resized thumbnails for avatars and header images.
+
+Templates point image URLs at `/images/<size>?src=...` (see the `thumb`
+filter). The first request for a source and size reads the source -- a
+file under /static, or a remote http(s) URL -- and writes a
+fixed-size JPEG into an on-disk cache named by a hash of the source
+and size. Later requests are served straight from that file. When the
+cache grows past its size budget, the least recently used thumbnails
+are evicted.
+
+Thumbnail URLs carry an HMAC of the source and size keyed on the app's
+SECRET_KEY, so the server only fetches and caches images that one of
+its own pages asked for. Image URLs are whatever users saved, though,
+so remote fetches only connect to public addresses -- checked on the
+connected socket, so DNS answers that change between lookups don't get
+around it -- and don't follow redirects or use proxies.
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import urllib.request
+from urllib.parse import urlencode
+
+from flask import current_app
+from PIL import Image, ImageOps
+
+SIZES = {
+    'timeline': (96, 96),
+    'card': (140, 140),
+    'profile': (400, 400),
+    'hero': (1280, 360),
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40 * 1000 * 1000
+FETCH_TIMEOUT = 5
+JPEG_QUALITY = 85
+# evicting goes this far under the budget, so it doesn't run on every miss
+EVICT_TO = 0.9
+
+
+class ImageSourceError(Exception):
+    """The source image could not be read or decoded."""
+
+
+def is_public_address(address):
+    """Is IP `address` on the public internet (not private, loopback, link-local...)?"""
+
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+
+    return ip.is_global and not ip.is_multicast
+
+
+def create_public_connection(address, *args, **kwargs):
+    """socket.create_connection() that refuses non-public peers."""
+
+    sock = socket.create_connection(address, *args, **kwargs)
+    peer = sock.getpeername()[0]
+
+    if not is_public_address(peer):
+        sock.close()
+        raise ImageSourceError(f"Refusing to fetch from {peer}")
+
+    return sock
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+public_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}),
+                                            PublicHTTPHandler, PublicHTTPSHandler, NoRedirects)
+
+
+class ThumbnailCache:
+    """Size-bounded directory of thumbnails, evicted least recently used."""
+
+    def __init__(self, directory, max_bytes, static_folder, allow_remote=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.static_folder = static_folder
+        self.allow_remote = allow_remote
+        # bytes in the cache, counted on the first write and kept up after
+        self.total = None
+        self.lock = threading.Lock()
+
+    def path_for(self, size, src):
+        """Cache file path for `src` resized to `size`."""
+
+        digest = hashlib.sha256(f"{size}\n{src}".encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpg")
+
+    def get(self, size, src):
+        """Path to the `size` thumbnail of `src`, creating it if needed."""
+
+        path = self.path_for(size, src)
+
+        if os.path.exists(path):
+            # bump mtime so eviction sees this as recently used
+            os.utime(path)
+            return path
+
+        thumbnail = make_thumbnail(self.read_source(src), SIZES[size])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(thumbnail)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.total is None:
+                self.total = self.size_on_disk()
+            else:
+                self.total += len(thumbnail)
+            over = self.total > self.max_bytes
+
+        if over:
+            self.evict(int(self.max_bytes * EVICT_TO))
+        return path
+
+    def read_source(self, src):
+        """Bytes of the original image at `src`."""
+
+        if src.startswith('/static/'):
+            root = os.path.realpath(self.static_folder)
+            path = os.path.realpath(os.path.join(root, src[len('/static/'):]))
+
+            if not path.startswith(root + os.sep) or not os.path.isfile(path):
+                raise ImageSourceError(f"No static image at {src}")
+
+            with open(path, 'rb') as f:
+                return f.read(MAX_SOURCE_BYTES + 1)
+
+        if self.allow_remote and src.startswith(('http://', 'https://')):
+            try:
+                with public_opener.open(src, timeout=FETCH_TIMEOUT) as resp:
+                    return resp.read(MAX_SOURCE_BYTES + 1)
+            except (OSError, ValueError) as e:
+                raise ImageSourceError(f"Could not fetch {src}: {e}")
+
+        raise ImageSourceError(f"Unsupported image source {src}")
+
+    def size_on_disk(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        """(mtime, size, path) of every cached thumbnail."""
+
+        entries = []
+
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def evict(self, target=None):
+        """Delete least recently used thumbnails until under `target` (max_bytes)."""
+
+        target = self.max_bytes if target is None else target
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        with self.lock:
+            self.total = total
+
+
+def make_thumbnail(data, size):
+    """JPEG bytes of image `data` cropped and scaled to exactly `size`."""
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ImageSourceError("Source image too large")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        if width * height > MAX_SOURCE_PIXELS:
+            raise ImageSourceError("Source image too large")
+
+        # JPEGs can be decoded at a fraction of their size, still >= `size`
+        # either way round (EXIF may rotate it)
+        image.draft('RGB', (max(size), max(size)))
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image.convert('RGB'), size, Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageSourceError(f"Could not decode image: {e}")
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def signature(src, size, key):
+    """HMAC of a thumbnail's source and size."""
+
+    message = f"{size}\n{src}".encode('UTF-8')
+    return hmac.new(key.encode('UTF-8'), message, hashlib.sha256).hexdigest()[:32]
+
+
+def valid_signature(src, size, sig, key):
+    return hmac.compare_digest(signature(src, size, key), sig or '')
+
+
+def thumb_url(src, size):
+    """URL of the `size` thumbnail for image URL `src`, signed with SECRET_KEY."""
+
+    if not src:
+        return src
+
+    sig = signature(src, size, current_app.config['SECRET_KEY'])
+    return f"/images/{size}?{urlencode({'src': src, 'sig': sig})}"
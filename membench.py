@@ -0,0 +1,344 @@
+"""Memory benchmark: peak and retained allocations per route.
+
+Seeds a scaled dataset, then requests each of ROUTES through the test
+client under tracemalloc and reports, per request:
+
+- peak: the most memory the request had allocated at once;
+- kept: what is still allocated once the request is over and garbage
+  has been collected (caches, leaks).
+
+Each is broken down by where the memory was allocated: ORM (SQLAlchemy
+and the DB driver, lazy loads from templates included), template
+rendering (Jinja), form handling (WTForms), and everything else. The
+peak breakdown comes from a snapshot taken within a few percent of the
+peak, on a second run of the request under a profile hook (which adds
+a few KiB of its own).
+
+    python membench.py [--scale 1] [--no-seed] [--update-budgets]
+
+Exits non-zero if a route's peak is over its budget in membench.json
+for this scale. `--update-budgets` writes this run's peaks, plus
+BUDGET_HEADROOM, as the new budgets.
+
+Runs against DATABASE_URL (default: postgresql:///warbler-membench,
+create it with `createdb warbler-membench`), which it wipes and reseeds
+unless given --no-seed.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-membench")
+os.environ.setdefault('SESSION_STORE', ':memory:')
+os.environ.setdefault('RATELIMIT_STORAGE', ':memory:')
+
+from app import app, CURR_USER_KEY
+from models import db, bcrypt, User, Message, Like, Follows, NotificationEvent
+from notifications import LIKE, FOLLOW, coalesce_notifications
+
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'membench.json')
+BUDGET_HEADROOM = 0.25
+
+# base dataset, multiplied by --scale
+USERS = 500
+MESSAGES_PER_USER = 10
+LIKES_PER_USER = 10
+
+# deep enough to reach the view function from an allocation in the driver
+TRACE_FRAMES = 100
+
+# re-snapshot whenever traced memory grows by this share of the peak
+SNAPSHOT_STEP = 0.04
+
+CATEGORIES = (
+    ('orm', ('/sqlalchemy/', '/flask_sqlalchemy/', '/psycopg2/')),
+    ('template', ('/jinja2/', '/markupsafe/', '/templates/')),
+    ('form', ('/wtforms/', '/flask_wtf/', '/forms.py')),
+)
+OTHER = 'other'
+
+
+class Route(namedtuple('Route', ['name', 'method', 'path', 'login', 'data'])):
+    """A request to measure; `path` may use {user} and {message}."""
+
+    __slots__ = ()
+
+
+Route.__new__.__defaults__ = (False, None)
+
+ROUTES = (
+    Route('homepage', 'GET', '/', True),
+    Route('homepage_anon', 'GET', '/'),
+    Route('users_show', 'GET', '/users/{user}'),
+    Route('show_liked_messages', 'GET', '/users/{user}/likes'),
+    Route('list_users', 'GET', '/users'),
+    Route('list_users_search', 'GET', '/users?q=user1'),
+    Route('show_following', 'GET', '/users/{user}/following', True),
+    Route('users_followers', 'GET', '/users/{user}/followers', True),
+    Route('messages_show', 'GET', '/messages/{message}'),
+    Route('show_message_likers', 'GET', '/messages/{message}/likes'),
+    Route('trending', 'GET', '/trending'),
+    Route('show_notifications', 'GET', '/notifications', True),
+    Route('signup_form', 'GET', '/signup'),
+    Route('profile_form', 'GET', '/users/profile', True),
+    Route('messages_add', 'POST', '/messages/new', True, {'text': "Hello @user1 #membench"}),
+)
+
+
+def seed(scale):
+    """Wipe the database and fill it with `scale` times the base dataset.
+
+    The first user, 'prolific', has as many messages as everyone else
+    put together and likes all of theirs; they follow everyone, everyone
+    follows them, and each other user likes LIKES_PER_USER of their
+    messages. Returns the prolific user's id.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    users = USERS * scale
+    password = bcrypt.generate_password_hash("password").decode('UTF-8')
+    now = datetime.utcnow()
+
+    db.session.execute(insert(User), [
+        {'username': 'prolific' if i == 0 else f"user{i}",
+         'email': f"user{i}@example.com",
+         'password': password}
+        for i in range(users + 1)])
+    user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+    prolific, others = user_ids[0], user_ids[1:]
+
+    db.session.execute(insert(Message), [
+        {'text': f"Message {i} from {user_id}", 'user_id': user_id,
+         'timestamp': now - timedelta(minutes=i)}
+        for user_id in others
+        for i in range(MESSAGES_PER_USER)] + [
+        {'text': f"Message {i} from the prolific user", 'user_id': prolific,
+         'timestamp': now - timedelta(minutes=i)}
+        for i in range(users * MESSAGES_PER_USER)])
+
+    own = db.session.execute(
+        select(Message.id).where(Message.user_id == prolific).order_by(Message.id)
+    ).scalars().all()
+    theirs = db.session.execute(
+        select(Message.id).where(Message.user_id != prolific)).scalars().all()
+
+    likes = [{'user_id': prolific, 'message_id': message_id} for message_id in theirs]
+    likes += [{'user_id': user_id, 'message_id': own[(n + i) % len(own)]}
+              for n, user_id in enumerate(others)
+              for i in range(LIKES_PER_USER)]
+    db.session.execute(insert(Like), likes)
+
+    db.session.execute(insert(Follows), [
+        follow
+        for user_id in others
+        for follow in ({'user_following_id': prolific, 'user_being_followed_id': user_id},
+                       {'user_following_id': user_id, 'user_being_followed_id': prolific})])
+
+    db.session.execute(insert(NotificationEvent), [
+        {'user_id': prolific, 'kind': LIKE, 'actor_id': like['user_id'],
+         'message_id': like['message_id']}
+        for like in likes if like['user_id'] != prolific] + [
+        {'user_id': prolific, 'kind': FOLLOW, 'actor_id': user_id, 'message_id': None}
+        for user_id in others])
+    db.session.commit()
+
+    Message.recount_likes()
+    db.session.commit()
+    coalesce_notifications()
+
+    return prolific
+
+
+def category(traceback):
+    """The CATEGORIES name of the innermost frame that has one."""
+
+    for frame in reversed(traceback):
+        for name, paths in CATEGORIES:
+            if any(path in frame.filename for path in paths):
+                return name
+
+    return OTHER
+
+
+def breakdown(snapshot):
+    """Bytes allocated in `snapshot`, by category."""
+
+    sizes = dict.fromkeys([name for name, _ in CATEGORIES] + [OTHER], 0)
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    for trace in snapshot.traces:
+        sizes[category(trace.traceback)] += trace.size
+
+    return sizes
+
+
+class PeakSnapshot:
+    """Profile function keeping a snapshot from near the traced peak.
+
+    On every call and return it checks traced memory, and takes a new
+    snapshot once it has grown `step` bytes past the last one.
+    """
+
+    def __init__(self, step):
+        self.step = step
+        self.size = 0
+        self.snapshot = None
+
+    def __call__(self, frame, event, arg):
+        current = tracemalloc.get_traced_memory()[0]
+
+        if current >= self.size + self.step:
+            self.snapshot = None
+            self.snapshot = tracemalloc.take_snapshot()
+            self.size = current
+
+
+def request(client, route, user_id, message_id):
+    response = client.open(route.path.format(user=user_id, message=message_id),
+                           method=route.method, data=route.data)
+    response.get_data()
+    response.close()
+    assert response.status_code < 400, f"{route.name}: {response.status_code}"
+
+
+def measure(client, route, user_id, message_id):
+    """(peak bytes, peak breakdown, kept bytes, kept breakdown) of one request."""
+
+    # populate template, statement and other caches first, including
+    # whatever the interpreter sets up the first time it runs a profiler
+    sys.setprofile(lambda frame, event, arg: None)
+    try:
+        request(client, route, user_id, message_id)
+    finally:
+        sys.setprofile(None)
+
+    gc.collect()
+    tracemalloc.start(TRACE_FRAMES)
+    try:
+        request(client, route, user_id, message_id)
+        peak = tracemalloc.get_traced_memory()[1]
+        gc.collect()
+        kept = tracemalloc.get_traced_memory()[0]
+        kept_breakdown = breakdown(tracemalloc.take_snapshot())
+    finally:
+        tracemalloc.stop()
+
+    gc.collect()
+    watcher = PeakSnapshot(max(int(peak * SNAPSHOT_STEP), 1))
+    tracemalloc.start(TRACE_FRAMES)
+    sys.setprofile(watcher)
+    try:
+        request(client, route, user_id, message_id)
+    finally:
+        sys.setprofile(None)
+        tracemalloc.stop()
+
+    return peak, breakdown(watcher.snapshot), kept, kept_breakdown
+
+
+def over_budget(peaks, budgets):
+    """(route, peak, budget) for each route whose peak is over its budget."""
+
+    return [(name, peak, budgets[name]) for name, peak in peaks.items()
+            if name in budgets and peak > budgets[name]]
+
+
+def load_budgets(scale):
+    """Budgets in KiB by route name for this scale ({} if none stored)."""
+
+    try:
+        with open(BUDGETS_FILE) as f:
+            return json.load(f).get(str(scale), {})
+    except FileNotFoundError:
+        return {}
+
+
+def save_budgets(scale, peaks):
+    """Store `peaks` (KiB by route name) plus headroom as this scale's budgets."""
+
+    try:
+        with open(BUDGETS_FILE) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {}
+
+    stored[str(scale)] = {name: round(peak * (1 + BUDGET_HEADROOM))
+                          for name, peak in sorted(peaks.items())}
+
+    with open(BUDGETS_FILE, 'w') as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='Measure the data already in the database.')
+    parser.add_argument('--update-budgets', action='store_true')
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['RATELIMIT_ENABLED'] = False
+    app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
+
+    with app.app_context():
+        if args.no_seed:
+            user_id = db.session.execute(
+                select(User.id).where(User.username == 'prolific')).scalar_one()
+        else:
+            user_id = seed(args.scale)
+
+        message_id = db.session.execute(
+            select(Message.id).where(Message.user_id == user_id)
+            .order_by(Message.like_count.desc()).limit(1)).scalar_one()
+        db.session.remove()
+
+    anon = app.test_client()
+    member = app.test_client()
+    with member.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    budgets = load_budgets(args.scale)
+    names = [name for name, _ in CATEGORIES] + [OTHER]
+    peaks = {}
+
+    print(f"{'route':<22}{'peak KiB':>10}" + "".join(f"{name:>9}" for name in names)
+          + f"{'kept KiB':>10}" + "".join(f"{name:>9}" for name in names)
+          + f"{'budget':>9}")
+
+    for route in ROUTES:
+        client = member if route.login else anon
+        peak, at_peak, kept, retained = measure(client, route, user_id, message_id)
+        peaks[route.name] = peak / 1024
+
+        print(f"{route.name:<22}{peak / 1024:>10.1f}"
+              + "".join(f"{at_peak[name] / 1024:>9.1f}" for name in names)
+              + f"{kept / 1024:>10.1f}"
+              + "".join(f"{retained[name] / 1024:>9.1f}" for name in names)
+              + f"{budgets.get(route.name, '-'):>9}")
+
+    if args.update_budgets:
+        save_budgets(args.scale, peaks)
+        print(f"Wrote budgets for scale {args.scale} to {BUDGETS_FILE}")
+        return
+
+    over = over_budget(peaks, budgets)
+    for name, peak, budget in over:
+        print(f"{name}: peak {peak:.1f} KiB is over its {budget} KiB budget")
+
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
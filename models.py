@@ -1,13 +1,25 @@
 """SQLAlchemy models for Warbler."""
 
+import hashlib
+import json
+import time
+import zlib
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import ARRAY
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+LIKES_PER_PAGE = 20
+FOLLOWS_PER_PAGE = 30
+LIKERS_PER_PAGE = 30
+
+SNAPSHOT_FORMAT = 3
+SNAPSHOT_TTL = 5 * 60
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +38,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,6 +91,11 @@ class User(db.Model):
         nullable=False,
     )
 
+    # set when the account is deleted; rows are purged later by deletion.py
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -94,22 +118,129 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((other_user.id, self.id)) is not None
+
+    def following_ids(self, among=None):
+        """Set of active user ids this user follows.
+
+        Optionally only those in `among`.
+        """
+
+        query = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .join(User, User.id == Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.id,
+                         User.deleted_at.is_(None)))
+
+        if among is not None:
+            query = query.filter(Follows.user_being_followed_id.in_(among))
+
+        return {id for (id,) in query}
+
+    def count_following(self):
+        """Returns number of users this user follows"""
+
+        return Follows.query.filter_by(user_following_id=self.id).count()
+
+    def count_followers(self):
+        """Returns number of users following this user"""
+
+        return Follows.query.filter_by(user_being_followed_id=self.id).count()
+
+    def get_following_page(self, after=None, per_page=FOLLOWS_PER_PAGE):
+        """Returns (users, next_after) for a page of users this user follows.
+
+        Pages are ordered by followed user id; pass `next_after` back as
+        `after` for the next page. It is None on the last page.
+        """
+
+        return User._follows_page(self.id, Follows.user_following_id,
+                                  Follows.user_being_followed_id,
+                                  after, per_page)
+
+    def get_followers_page(self, after=None, per_page=FOLLOWS_PER_PAGE):
+        """Returns (users, next_after) for a page of this user's followers."""
+
+        return User._follows_page(self.id, Follows.user_being_followed_id,
+                                  Follows.user_following_id,
+                                  after, per_page)
+
+    # only needs the user id, so the page methods also work on a Profile
+    @staticmethod
+    def _follows_page(user_id, this_col, other_col, after, per_page):
+        query = (User
+                 .active()
+                 .join(Follows, other_col == User.id)
+                 .filter(this_col == user_id)
+                 .order_by(other_col))
+
+        if after is not None:
+            query = query.filter(other_col > after)
+
+        users = query.limit(per_page + 1).all()
+
+        if len(users) > per_page:
+            return users[:per_page], users[per_page - 1].id
+
+        return users, None
+
+    def get_sorted_liked_messages(self, page=1, per_page=LIKES_PER_PAGE, order_by="liked"):
+        """Returns a page of this user's liked messages, newest first.
+
+        `order_by` is "liked" (when the like was made) or "posted"
+        (message timestamp). Sorting and paging happen in the database.
+        """
+
+        return (Message
+                .liked_by_query(self.id, order_by)
+                .paginate(page=page, per_page=per_page, error_out=False))
+
+    def count_messages(self):
+        """Returns number of messages by this user, including archived ones"""
+
+        archived = (db.session
+                    .query(db.func.coalesce(db.func.sum(MessageArchive.count), 0))
+                    .filter(MessageArchive.user_id == self.id)
+                    .scalar())
+
+        return Message.query.filter_by(user_id=self.id).count() + archived
+
+    def count_likes(self):
+        """Returns number of messages this user has liked"""
+
+        return Like.query.filter_by(user_id=self.id).count()
+
+    def count_notifications(self):
+        """Returns number of unread notifications"""
+
+        return Notification.query.filter_by(user_id=self.id, read_at=None).count()
+
+    def get_follow_suggestions(self, limit=5):
+        """Returns this user's top precomputed who-to-follow suggestions"""
+
+        return (FollowSuggestion
+                .query
+                .filter_by(user_id=self.id)
+                .options(db.joinedload(FollowSuggestion.suggested_user))
+                .order_by(FollowSuggestion.rank)
+                .limit(limit)
+                .all())
+
+    def mark_deleted(self):
+        """Hide this account now; its rows are removed by a purge job."""
 
-    def get_timestamp(self, message):
-        """Returns message timestamp"""
-        return message.timestamp
+        self.deleted_at = datetime.utcnow()
 
-    def get_sorted_liked_messages(self):
-        """Returns sorted list of liked messages"""
-        return sorted(self.liked_messages, key=self.get_timestamp, reverse=True)
+    @classmethod
+    def active(cls):
+        """Query for users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     def reset_password(self, new_password):
         """Resets current user's password"""
@@ -148,7 +279,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -159,10 +290,141 @@ class User(db.Model):
 
     
 
+class UserSnapshot:
+    """Stand-in for the logged-in User, built from a cached snapshot.
+
+    The snapshot (kept in the server-side session) holds the few fields
+    that pages show for the current user, their counters and a digest
+    of who they follow. Which messages they've liked is read per page,
+    for the messages shown (see `liked_among` in app.py). Anything else
+    -- or any attribute write -- loads the real User row on first use
+    and is passed through to it. Given a SocialGraph, follow checks are
+    answered from it.
+    """
+
+    FIELDS = ('id', 'username', 'image_url', 'header_image_url')
+
+    # User methods that only need self.id, so can run without the row
+    ID_ONLY_METHODS = ('get_follow_suggestions',)
+
+    def __init__(self, data, graph=None):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_user', None)
+        object.__setattr__(self, '_graph', graph)
+
+    @classmethod
+    def build(cls, user, version, shards=None):
+        """Snapshot dict for `user` at user-version `version`.
+
+        Pass the app's ShardSet to read messages and likes from it.
+        """
+
+        following_ids = sorted(user.following_ids())
+
+        if shards is None:
+            likes = user.count_likes()
+            messages = user.count_messages()
+        else:
+            likes = shards.count_likes(user.id)
+            messages = shards.count_messages(user.id)
+
+        return {
+            'format': SNAPSHOT_FORMAT,
+            'version': version,
+            'built_at': time.time(),
+            'id': user.id,
+            'username': user.username,
+            'image_url': user.image_url,
+            'header_image_url': user.header_image_url,
+            'counts': {
+                'messages': messages,
+                'following': len(following_ids),
+                'followers': user.count_followers(),
+                'likes': likes,
+                'notifications': user.count_notifications(),
+            },
+            'following_digest': hashlib.sha1(
+                ",".join(map(str, following_ids)).encode('UTF-8')).hexdigest(),
+        }
+
+    @staticmethod
+    def is_current(data, user_id, version):
+        """Can snapshot `data` still stand in for user `user_id`?"""
+
+        return bool(data
+                    and data.get('format') == SNAPSHOT_FORMAT
+                    and data['id'] == user_id
+                    and data['version'] == version
+                    and data['built_at'] > time.time() - SNAPSHOT_TTL)
+
+    @property
+    def user(self):
+        """The real User row, loaded on first use."""
+
+        if self._user is None:
+            object.__setattr__(self, '_user', User.query.get(self._data['id']))
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None:
+            if name in self.FIELDS:
+                return self._data[name]
+            if name in self.ID_ONLY_METHODS:
+                return getattr(User, name).__get__(self)
+
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self._data['id']}: {self._data['username']}>"
+
+    @property
+    def following_digest(self):
+        return self._data['following_digest']
+
+    def following_ids(self, among=None):
+        if self._graph is None:
+            return User.following_ids(self, among)
+        return self._graph.following_ids(self._data['id'], among)
+
+    def is_following(self, other_user):
+        if self._graph is None:
+            return User.is_following(self, other_user)
+        return self._graph.is_following(self._data['id'], other_user.id)
+
+    def is_followed_by(self, other_user):
+        if self._graph is None:
+            return User.is_followed_by(self, other_user)
+        return self._graph.is_following(other_user.id, self._data['id'])
+
+    def count_messages(self):
+        return self._data['counts']['messages']
+
+    def count_following(self):
+        return self._data['counts']['following']
+
+    def count_followers(self):
+        return self._data['counts']['followers']
+
+    def count_likes(self):
+        return self._data['counts']['likes']
+
+    def count_notifications(self):
+        return self._data['counts']['notifications']
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+    # archived messages are read-only and can't be liked
+    archived = False
 
     id = db.Column(
         db.Integer,
@@ -177,7 +439,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        index=True,
     )
 
     user_id = db.Column(
@@ -186,10 +449,87 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # kept in step with `likes` by adjust_like_counts()
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
     liked_users = db.relationship('User', secondary='likes', backref='liked_messages')
 
+    @classmethod
+    def liked_by_query(cls, user_id, order_by="liked"):
+        """Query for messages liked by `user_id`, with authors eager-loaded.
+
+        Orders by like time for "liked", otherwise by message timestamp.
+        """
+
+        if order_by == "liked":
+            order = Like.created_at.desc()
+        else:
+            order = cls.timestamp.desc()
+
+        return (cls
+                .query
+                .join(Like, Like.message_id == cls.id)
+                .filter(Like.user_id == user_id)
+                .options(db.joinedload(cls.user))
+                .order_by(order, cls.id.desc()))
+
+    @classmethod
+    def adjust_like_counts(cls, message_ids, delta):
+        """Add `delta` to like_count of each message in `message_ids`.
+
+        Runs as a single UPDATE in the current transaction, so call it
+        alongside adding or deleting the Like rows themselves.
+        """
+
+        (cls
+         .query
+         .filter(cls.id.in_(message_ids))
+         .update({cls.like_count: cls.like_count + delta},
+                 synchronize_session=False))
+
+    @classmethod
+    def recount_likes(cls):
+        """Recompute every like_count from the likes table."""
+
+        counted = (db.session
+                   .query(db.func.count(Like.user_id))
+                   .filter(Like.message_id == cls.id)
+                   .scalar_subquery())
+
+        cls.query.update({cls.like_count: counted}, synchronize_session=False)
+        db.session.commit()
+
+    def get_likers_page(self, before=None, per_page=LIKERS_PER_PAGE):
+        """Returns ([(user, liked_at)], next_before) for who liked this message.
+
+        Newest likes first. `before` is a (liked_at, user_id) cursor;
+        `next_before` is the cursor for the next page, or None.
+        """
+
+        query = (db.session
+                 .query(User, Like.created_at)
+                 .join(Like, Like.user_id == User.id)
+                 .filter(Like.message_id == self.id, User.deleted_at.is_(None))
+                 .order_by(Like.created_at.desc(), User.id.desc()))
+
+        if before:
+            query = query.filter(db.tuple_(Like.created_at, User.id) < before)
+
+        likers = query.limit(per_page + 1).all()
+
+        if len(likers) > per_page:
+            user, liked_at = likers[per_page - 1]
+            return likers[:per_page], (liked_at, user.id)
+
+        return likers, None
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -204,15 +544,390 @@ class Like(db.Model):
     "An individual like for a message"
 
     __tablename__ = 'likes'
+    __table_args__ = (
+        db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_likes_message_id_created_at', 'message_id', 'created_at'),
+        db.Index('ix_likes_created_at', 'created_at'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class FollowSuggestion(db.Model):
+    """A precomputed who-to-follow suggestion, written by recommend.py."""
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    suggested_user = db.relationship('User', foreign_keys=[suggested_user_id])
+
+
+class MessageLikeBucket(db.Model):
+    """Number of likes a message got in one time bucket, for trending."""
+
+    __tablename__ = 'message_like_buckets'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+        index=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class HashtagBucket(db.Model):
+    """Number of messages using a hashtag in one time bucket, for trending."""
+
+    __tablename__ = 'hashtag_buckets'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+        index=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class NotificationEvent(db.Model):
+    """Something that happened to a user, waiting to be coalesced.
+
+    Written by notifications.notify*() in the same transaction as the
+    like, follow or message; turned into Notifications later.
+    """
+
+    __tablename__ = 'notification_events'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
 
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Notification(db.Model):
+    """A group of like, follow or mention events in a user's inbox.
+
+    Events of the same kind about the same message (or, for follows,
+    about the user) are merged into one unread notification.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at'),
+        db.Index('ix_notifications_unread', 'user_id', 'kind', 'message_id',
+                 postgresql_where=db.text('read_at IS NULL')),
+    )
+
+    id = db.Column(
+        db.Integer,
         primary_key=True,
     )
 
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete="cascade"),
+    )
+
+    # most recent first, at most notifications.RECENT_ACTORS
+    actor_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    message = db.relationship('Message')
+
+
+class NotificationActor(db.Model):
+    """An actor counted in a notification, so they are only counted once."""
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete="cascade"),
         primary_key=True,
-    )
\ No newline at end of file
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+
+class UserStats(db.Model):
+    """Engagement statistics for one user, written by stats.py."""
+
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    first_message_at = db.Column(
+        db.DateTime,
+    )
+
+    posts_per_day = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    recent_posts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    likes_received = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    top_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="set null"),
+    )
+
+    top_message_likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followers = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    recent_followers = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class JobCheckpoint(db.Model):
+    """When a batch job last started a successful run."""
+
+    __tablename__ = 'job_checkpoints'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class MessageArchive(db.Model):
+    """A compressed block of one user's messages moved out of `messages`.
+
+    Each block holds the messages (and who liked them) for one user over
+    one calendar month, as zlib-compressed JSON.
+    """
+
+    __tablename__ = 'message_archive'
+    __table_args__ = (
+        db.Index('ix_message_archive_user_id_period_end', 'user_id', 'period_end'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    period_start = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    period_end = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    user = db.relationship('User')
+
+    @classmethod
+    def pack(cls, user_id, rows):
+        """Build a block from (id, text, timestamp, liker_ids) rows."""
+
+        data = [[id, text, timestamp.isoformat(), liker_ids]
+                for id, text, timestamp, liker_ids in rows]
+
+        return cls(
+            user_id=user_id,
+            period_start=min(row[2] for row in rows),
+            period_end=max(row[2] for row in rows),
+            count=len(rows),
+            payload=zlib.compress(json.dumps(data).encode('UTF-8')),
+        )
+
+    def unpack(self):
+        """Returns this block's messages as ArchivedMessage objects."""
+
+        data = json.loads(zlib.decompress(self.payload).decode('UTF-8'))
+
+        return [ArchivedMessage(id=id,
+                                text=text,
+                                timestamp=datetime.fromisoformat(timestamp),
+                                user=self.user,
+                                liker_ids=liker_ids)
+                for id, text, timestamp, liker_ids in data]
+
+
+class ArchivedMessage:
+    """Read-only stand-in for a Message that lives in the archive."""
+
+    archived = True
+
+    def __init__(self, id, text, timestamp, user, liker_ids):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+        self.user_id = user.id
+        self.liker_ids = liker_ids
+        self.like_count = len(liker_ids)
+
+    def __repr__(self):
+        return f"<ArchivedMessage #{self.id}: {self.timestamp}>"
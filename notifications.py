@@ -0,0 +1,259 @@
+"""Notifications for likes, follows and mentions.
+
+Routes only append a NotificationEvent row per recipient (`notify()`,
+`notify_mentions()`), inside the transaction that makes the change.
+`coalesce_notifications()` later folds pending events into each user's
+inbox: events of one kind about the same message (or, for follows,
+about the user) are merged into a single unread Notification that keeps
+a count and the last few actors, so a popular message gives its author
+one "@a, @b and 10 others liked your message" instead of twelve rows.
+Every actor counted in a notification gets a NotificationActor row, so
+someone who unlikes and likes again (or unfollows and follows again) is
+counted once however far they have dropped out of the last few actors.
+
+The coalescer runs in a short-lived background thread a few seconds
+after events are recorded, so events arriving together are merged in
+one pass, and can also be run with `flask coalesce-notifications`. An
+advisory lock keeps concurrent coalescers from racing.
+
+Each user's unread count is kept in their session snapshot, so the
+badge costs nothing to render; the coalescer returns the users whose
+inbox changed so their snapshots can be invalidated.
+"""
+
+import re
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, User, Notification, NotificationActor, NotificationEvent
+
+LIKE = 'like'
+FOLLOW = 'follow'
+MENTION = 'mention'
+
+RECENT_ACTORS = 3
+COALESCE_BATCH_SIZE = 1000
+COALESCE_DELAY = 5
+NOTIFICATIONS_PER_PAGE = 30
+
+# pg_try_advisory_xact_lock key for the coalescer
+LOCK_KEY = 4201
+
+MENTION_RE = re.compile(r"@(\w+)")
+
+_schedule_lock = threading.Lock()
+_scheduled = False
+
+
+def notify(user_id, kind, actor_id, message_id=None):
+    """Record an event for `user_id`, unless they are the actor."""
+
+    if user_id != actor_id:
+        db.session.add(NotificationEvent(user_id=user_id, kind=kind,
+                                         actor_id=actor_id, message_id=message_id))
+
+
+def mentions(text):
+    """Distinct usernames @-mentioned in `text`."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def notify_mentions(message):
+    """Record a mention event for each active user `message` mentions."""
+
+    usernames = mentions(message.text)
+
+    if usernames:
+        db.session.execute(insert(NotificationEvent).from_select(
+            ['user_id', 'kind', 'actor_id', 'message_id', 'created_at'],
+            select(User.id, literal(MENTION), literal(message.user_id), literal(message.id),
+                   literal(datetime.utcnow()))
+            .where(User.username.in_(usernames),
+                   User.deleted_at.is_(None),
+                   User.id != message.user_id),
+        ))
+
+
+def coalesce_notifications(batch_size=COALESCE_BATCH_SIZE):
+    """Fold pending events into notifications, a batch per transaction.
+
+    Returns the set of user ids whose inbox changed. Does nothing if
+    another coalescer holds the lock.
+    """
+
+    changed = set()
+
+    while True:
+        if not db.session.execute(select(db.func.pg_try_advisory_xact_lock(LOCK_KEY))).scalar():
+            db.session.rollback()
+            return changed
+
+        events = (NotificationEvent
+                  .query
+                  .order_by(NotificationEvent.id)
+                  .limit(batch_size)
+                  .all())
+
+        if not events:
+            db.session.commit()
+            return changed
+
+        groups = {}
+        for event in events:
+            groups.setdefault((event.user_id, event.kind, event.message_id), []).append(event)
+
+        unread = (Notification
+                  .query
+                  .filter(Notification.read_at.is_(None),
+                          db.tuple_(Notification.user_id,
+                                    Notification.kind,
+                                    db.func.coalesce(Notification.message_id, 0))
+                          .in_([(user_id, kind, message_id or 0)
+                                for user_id, kind, message_id in groups])))
+        inbox = {(n.user_id, n.kind, n.message_id): n for n in unread}
+
+        # actors already counted in those notifications
+        merged = {}
+        if inbox:
+            for notification_id, actor_id in db.session.execute(
+                    select(NotificationActor.notification_id, NotificationActor.actor_id)
+                    .where(NotificationActor.notification_id.in_(
+                               [n.id for n in inbox.values()]),
+                           NotificationActor.actor_id.in_(
+                               {event.actor_id for event in events}))):
+                merged.setdefault(notification_id, set()).add(actor_id)
+
+        counted = []
+        for key, group in groups.items():
+            notification = inbox.get(key)
+
+            if notification is None:
+                user_id, kind, message_id = key
+                notification = Notification(user_id=user_id, kind=kind, message_id=message_id,
+                                            actor_ids=[], actor_count=0)
+                db.session.add(notification)
+
+            actors = merged.get(notification.id, set()) | set(notification.actor_ids)
+            counted.append((notification, merge_events(notification, group, actors)))
+
+        db.session.flush()
+        rows = [{'notification_id': notification.id, 'actor_id': actor_id}
+                for notification, actor_ids in counted for actor_id in actor_ids]
+        if rows:
+            db.session.execute(pg_insert(NotificationActor).values(rows)
+                               .on_conflict_do_nothing())
+
+        (NotificationEvent
+         .query
+         .filter(NotificationEvent.id.in_([event.id for event in events]))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+        changed.update(user_id for user_id, _, _ in groups)
+
+
+def merge_events(notification, events, merged):
+    """Add `events` (oldest first) to `notification`.
+
+    `merged` is the set of actors already counted in it; they aren't
+    counted again, and the newly counted ones are added to it. Returns
+    the newly counted actor ids.
+    """
+
+    actor_ids = list(notification.actor_ids)
+    counted = []
+
+    for event in events:
+        if event.actor_id in actor_ids:
+            actor_ids.remove(event.actor_id)
+        if event.actor_id not in merged:
+            merged.add(event.actor_id)
+            counted.append(event.actor_id)
+        actor_ids.insert(0, event.actor_id)
+
+    notification.actor_ids = actor_ids[:RECENT_ACTORS]
+    notification.actor_count += len(counted)
+    notification.updated_at = events[-1].created_at
+
+    return counted
+
+
+def coalesce_in_background(app, on_changed, delay=COALESCE_DELAY):
+    """Run coalesce_notifications() in a daemon thread after `delay`.
+
+    Calls made while a run is already waiting are folded into it.
+    `on_changed` gets the ids of users whose inbox changed.
+    """
+
+    global _scheduled
+
+    with _schedule_lock:
+        if _scheduled:
+            return None
+        _scheduled = True
+
+    def run():
+        global _scheduled
+
+        time.sleep(delay)
+
+        # events recorded from here on need a run of their own
+        with _schedule_lock:
+            _scheduled = False
+
+        with app.app_context():
+            changed = coalesce_notifications()
+
+        if changed:
+            on_changed(changed)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def inbox_page(user_id, page=1, per_page=NOTIFICATIONS_PER_PAGE, shards=None):
+    """A page of `user_id`'s notifications, newest first.
+
+    Returns (pagination, entries), where entries are (notification,
+    named actors, message or None) for the page's notifications.
+    Messages are read through `shards` when it's sharded.
+    """
+
+    sharded = shards is not None and shards.sharded
+    query = Notification.query.filter_by(user_id=user_id)
+    if not sharded:
+        query = query.options(db.joinedload(Notification.message))
+
+    pagination = (query
+                  .order_by(Notification.updated_at.desc(), Notification.id.desc())
+                  .paginate(page=page, per_page=per_page, error_out=False))
+
+    if sharded:
+        messages = {msg.id: msg for msg in shards.message_rows(
+            {n.message_id for n in pagination.items if n.message_id is not None})}
+    else:
+        messages = {n.message_id: n.message for n in pagination.items}
+
+    actor_ids = {id for n in pagination.items for id in n.actor_ids}
+    actors = {user.id: user for user in
+              User.query.filter(User.id.in_(actor_ids)).options(
+                  db.load_only('id', 'username', 'image_url'))}
+
+    return pagination, [(n, [actors[id] for id in n.actor_ids if id in actors],
+                         messages.get(n.message_id))
+                        for n in pagination.items]
+
+
+def mark_read(user_id):
+    """Mark all of `user_id`'s notifications read. Returns how many were unread."""
+
+    return (Notification
+            .query
+            .filter_by(user_id=user_id, read_at=None)
+            .update({'read_at': datetime.utcnow()}, synchronize_session=False))
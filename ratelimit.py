@@ -0,0 +1,196 @@
+"""Token-bucket rate limiting for expensive or abusable routes.
+
+Each Limit is a bucket of `capacity` tokens per key (client IP, logged
+in user id, or submitted username) that refills evenly over `per`
+seconds; a request takes one token from every bucket that applies to
+it and is rejected if any is empty.
+
+Checks only read the request and the signed session cookie, so they can
+run before any database query or password hash. Buckets live in a
+SQLite file (shared by every gunicorn worker on the host) or, for tests
+and single-process use, in memory.
+
+A bucket left alone for `per` seconds is full again, the same as no
+bucket at all, so every PRUNE_EVERY seconds a check also drops buckets
+untouched for the longest `per` of any limit.
+
+If the SQLite file stays locked past its timeout (heavy contention, or
+a stuck process), a check fails open: the request is let through and a
+warning logged, since a limiter outage shouldn't take the site down.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+Limit = namedtuple('Limit', ['scope', 'capacity', 'per'])
+
+# POST requests to these endpoints are limited
+RATE_LIMITS = {
+    'login': [Limit('ip', 20, 60), Limit('username', 5, 60)],
+    'signup': [Limit('ip', 10, 60 * 60)],
+    'messages_add': [Limit('user', 30, 60), Limit('ip', 60, 60)],
+    'like_message': [Limit('user', 60, 60), Limit('ip', 120, 60)],
+}
+
+PRUNE_EVERY = 60
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """Buckets in a dict; only shared within one process."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """Take a token from bucket `key`. Returns seconds to wait, or 0."""
+
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens, wait = refill_and_take(tokens, updated, capacity, rate, now)
+            self.buckets[key] = (tokens, now)
+            return wait
+
+    def prune(self, before):
+        """Drop buckets last used before `before`. Returns how many."""
+
+        with self.lock:
+            stale = [key for key, (_, updated) in self.buckets.items() if updated < before]
+            for key in stale:
+                del self.buckets[key]
+            return len(stale)
+
+
+class SQLiteStore:
+    """Buckets in a SQLite file, shared by every process that opens it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                         "(key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+
+    def connect(self):
+        """This thread's connection to the store."""
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.conn = conn
+
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        """Take a token from bucket `key`. Returns seconds to wait, or 0.
+
+        Returns 0 (fails open) if the file stays locked.
+        """
+
+        conn = self.connect()
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            logger.warning("Rate limit store locked; letting %s through", key, exc_info=True)
+            return 0
+
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?",
+                               (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = refill_and_take(tokens, updated, capacity, rate, now)
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.warning("Rate limit store locked; letting %s through", key, exc_info=True)
+            return 0
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def prune(self, before):
+        """Drop buckets last used before `before`. Returns how many (0 if locked)."""
+
+        try:
+            return self.connect().execute("DELETE FROM buckets WHERE updated < ?",
+                                          (before,)).rowcount
+        except sqlite3.OperationalError:
+            logger.warning("Rate limit store locked; not pruning", exc_info=True)
+            return 0
+
+
+def refill_and_take(tokens, updated, capacity, rate, now):
+    """Returns (tokens left, seconds to wait) after trying to take one."""
+
+    tokens = min(capacity, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        return tokens - 1, 0
+
+    return tokens, (1 - tokens) / rate
+
+
+def make_store(location):
+    """MemoryStore for ':memory:', otherwise a SQLiteStore at that path."""
+
+    if location == ':memory:':
+        return MemoryStore()
+
+    return SQLiteStore(location)
+
+
+class RateLimiter:
+    """Applies RATE_LIMITS-style rules to incoming requests."""
+
+    def __init__(self, store, limits=RATE_LIMITS):
+        self.store = store
+        self.limits = limits
+        # any bucket is full again after this long
+        self.refill_time = max((limit.per for rules in limits.values() for limit in rules),
+                               default=0)
+        self.pruned_at = time.time()
+
+    def check(self, endpoint, keys, now=None):
+        """Seconds the caller must wait before `endpoint`, or 0 if allowed.
+
+        `keys` maps each scope ('ip', 'user', 'username') to the value
+        for this request; limits whose scope has no value are skipped.
+        """
+
+        now = time.time() if now is None else now
+        wait = 0
+
+        if now - self.pruned_at >= PRUNE_EVERY:
+            self.pruned_at = now
+            self.store.prune(now - self.refill_time)
+
+        for limit in self.limits.get(endpoint, []):
+            value = keys.get(limit.scope)
+
+            if value is None:
+                continue
+
+            key = f"{endpoint}:{limit.scope}:{value}"
+            wait = max(wait, self.store.take(key, limit.capacity,
+                                             limit.capacity / limit.per, now))
+
+        return wait
@@ -0,0 +1,129 @@
+"""Lightweight read-only rows for the busiest listing pages.
+
+The timelines and the user list only show a handful of columns, so
+they query just those columns and wrap each result in an immutable
+named tuple (no `__dict__`, no identity map, no change tracking)
+instead of hydrating full User and Message instances. The rows have
+the same attribute names as the models, so templates don't care which
+they get.
+
+Queries are built as `select()` statements so the async read path
+(asgi.py) can run the very same ones.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import func, select
+
+from models import db, User, Message, MessageArchive, Follows, Like
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id,
+                   Message.like_count, User.username, User.image_url)
+
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url, User.header_image_url,
+                     User.bio)
+
+
+class Author(namedtuple('Author', ['id', 'username', 'image_url'])):
+    """The bits of a message's author that a timeline shows."""
+
+    __slots__ = ()
+
+
+class MessageRow(namedtuple('MessageRow',
+                            ['id', 'text', 'timestamp', 'user_id', 'like_count', 'user'])):
+    """A message on a timeline."""
+
+    __slots__ = ()
+
+    archived = False
+
+
+class Profile(namedtuple('Profile',
+                         ['id', 'username', 'image_url', 'header_image_url', 'bio',
+                          'location', 'messages', 'following', 'followers', 'likes'])):
+    """A user with their counters, for the profile page."""
+
+    __slots__ = ()
+
+    def count_messages(self):
+        return self.messages
+
+    def count_following(self):
+        return self.following
+
+    def count_followers(self):
+        return self.followers
+
+    def count_likes(self):
+        return self.likes
+
+
+class UserCard(namedtuple('UserCard',
+                          ['id', 'username', 'image_url', 'header_image_url', 'bio'])):
+    """A user in the user list."""
+
+    __slots__ = ()
+
+
+def message_query():
+    """Select of MESSAGE_COLUMNS, to filter and pass to message_rows()."""
+
+    return select(*MESSAGE_COLUMNS).join(User, User.id == Message.user_id)
+
+
+def message_rows(rows):
+    """MessageRows from MESSAGE_COLUMNS tuples; each author is built once."""
+
+    authors = {}
+    messages = []
+
+    for id, text, timestamp, user_id, like_count, username, image_url in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = Author(user_id, username, image_url)
+
+        messages.append(MessageRow(id, text, timestamp, user_id, like_count, author))
+
+    return messages
+
+
+def profile_query(user_id):
+    """Select of one active user's Profile columns, counters included."""
+
+    def count(model, condition):
+        return select(func.count()).select_from(model).where(condition).scalar_subquery()
+
+    archived = (select(func.coalesce(func.sum(MessageArchive.count), 0))
+                .where(MessageArchive.user_id == User.id)
+                .scalar_subquery())
+
+    return (select(User.id, User.username, User.image_url, User.header_image_url,
+                   User.bio, User.location,
+                   count(Message, Message.user_id == User.id) + archived,
+                   count(Follows, Follows.user_following_id == User.id),
+                   count(Follows, Follows.user_being_followed_id == User.id),
+                   count(Like, Like.user_id == User.id))
+            .where(User.id == user_id, User.deleted_at.is_(None)))
+
+
+def user_card_query(search=None):
+    """Select of USER_CARD_COLUMNS for active users, optionally matching `search`."""
+
+    query = select(*USER_CARD_COLUMNS).where(User.deleted_at.is_(None))
+
+    if search:
+        query = query.where(User.username.like(f"%{search}%"))
+
+    return query
+
+
+def user_cards(search=None, yield_per=100):
+    """Stream UserCards for active users, optionally matching `search`."""
+
+    result = db.session.execute(user_card_query(search),
+                                execution_options={'stream_results': True})
+
+    for rows in result.partitions(yield_per):
+        for row in rows:
+            yield UserCard._make(row)
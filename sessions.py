@@ -0,0 +1,190 @@
+"""Server-side sessions.
+
+The session cookie holds only a random session id; the session data
+lives in a local store (a SQLite file shared by every worker on the
+host, or a dict for single-process use). Besides `curr_user` it keeps a
+snapshot of the logged-in user (see models.UserSnapshot) so most
+requests can set up `g.user` without querying Postgres.
+
+The store also keeps a version number per user. Anything that changes
+what a snapshot holds calls `bump_user_version()`, which makes every
+session's snapshot of that user stale at once.
+"""
+
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+CLEANUP_CHANCE = 0.01
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that tracks changes and knows its store id."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = new
+        self.old_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """Move this session to a fresh id, e.g. on login."""
+
+        self.old_sid = self.old_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class MemorySessionStore:
+    """Sessions in a dict; only shared within one process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def load(self, sid, now):
+        with self.lock:
+            data, expires = self.sessions.get(sid, (None, 0))
+            return data if expires > now else None
+
+    def save(self, sid, data, expires):
+        with self.lock:
+            self.sessions[sid] = (data, expires)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def delete_expired(self, now):
+        with self.lock:
+            for sid in [sid for sid, (_, exp) in self.sessions.items() if exp <= now]:
+                del self.sessions[sid]
+
+    def user_version(self, user_id):
+        return self.versions.get(user_id, 0)
+
+    def bump_user_version(self, user_id):
+        with self.lock:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+
+class SQLiteSessionStore:
+    """Sessions in a SQLite file, shared by every process that opens it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                     "(sid TEXT PRIMARY KEY, data TEXT, expires REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS user_versions "
+                     "(user_id INTEGER PRIMARY KEY, version INTEGER)")
+
+    def connect(self):
+        """This thread's connection to the store."""
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+
+        return conn
+
+    def load(self, sid, now):
+        row = self.connect().execute(
+            "SELECT data FROM sessions WHERE sid = ? AND expires > ?", (sid, now)).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, expires):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (sid, data, expires))
+
+    def delete(self, sid):
+        self.connect().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def delete_expired(self, now):
+        self.connect().execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def user_version(self, user_id):
+        row = self.connect().execute(
+            "SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_user_version(self, user_id):
+        self.connect().execute(
+            "INSERT INTO user_versions VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET version = version + 1", (user_id,))
+
+
+def make_session_store(location):
+    """MemorySessionStore for ':memory:', otherwise a SQLiteSessionStore."""
+
+    if location == ':memory:':
+        return MemorySessionStore()
+
+    return SQLiteSessionStore(location)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface backed by a session store."""
+
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+
+        if sid:
+            data = self.store.load(sid, time.time())
+            if data is not None:
+                return ServerSideSession(self.serializer.loads(data), sid=sid)
+
+        return ServerSideSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.old_sid:
+            self.store.delete(session.old_sid)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            expires = time.time() + app.permanent_session_lifetime.total_seconds()
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), expires)
+
+            if random.random() < CLEANUP_CHANCE:
+                self.store.delete_expired(time.time())
+
+        if session.modified or session.new or session.old_sid:
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain,
+                                path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
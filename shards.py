@@ -0,0 +1,622 @@
+"""Horizontal sharding of messages and likes by user id.
+
+With MESSAGE_SHARDS set, the `messages` and `likes` tables live on N
+databases of their own: a message on its author's shard and a like on
+its liker's shard (`shard_for()`), so a user's own messages, or own
+likes, are always on one database. Everything else stays in the main
+database. Without it, ShardSet is a single "shard" that is the main
+database, and reads go through the usual joined queries.
+
+Shard tables have no foreign keys: authors and likers are read from the
+main database by id, and a like may point at a message on another
+shard. So a like on a shard also keeps its message's timestamp, which
+lets a user's likes be paged in message order from their shard alone.
+`flask init-shards` creates the tables, moves the messages and likes
+already in the main database onto their shards, and makes message ids
+unique across shards by giving shard k's id sequence step N, starting
+at k + 1 -- so a message id also tells you its shard. Ids from before
+sharding don't follow that rule, so lookups by id fall back to asking
+every shard.
+
+Reads that span users (the home timeline, likers of a message) send the
+same query to the shards involved in parallel and merge the results,
+which each come back in order, by timestamp. Writes to several
+databases (e.g. a like and its message's like count) are committed one
+database after another by `commit()`, not atomically.
+
+Account purges (deletion.py), exports (backup.py), trending and the
+notifications inbox go through a ShardSet too. Jobs that read messages
+from the main database -- archiving, stats, recounting likes, imports --
+refuse to run while sharded.
+"""
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain, islice
+
+from flask_sqlalchemy import BaseQuery, Pagination
+from sqlalchemy import (Column, DateTime, Index, MetaData, Table, create_engine, delete, func,
+                        inspect, select, update)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from archive import timeline, with_archived
+from models import db, User, Message, Like, MessageArchive, LIKES_PER_PAGE, LIKERS_PER_PAGE
+from readmodels import Author, MessageRow
+
+SHARD_MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id,
+                         Message.like_count)
+
+SHARDED_TABLES = (Message.__table__, Like.__table__)
+MOVE_BATCH_SIZE = 1000
+
+
+def shard_metadata():
+    """MetaData with copies of SHARDED_TABLES minus their foreign keys.
+
+    `likes` also gets the liked message's timestamp (see SHARD_LIKES).
+    """
+
+    metadata = MetaData()
+
+    for table in SHARDED_TABLES:
+        extra = []
+        if table is Like.__table__:
+            extra = [Column('message_timestamp', DateTime),
+                     Index('ix_likes_user_id_message_timestamp',
+                           'user_id', 'message_timestamp', 'message_id')]
+
+        Table(table.name, metadata,
+              *[Column(column.name, column.type,
+                       primary_key=column.primary_key,
+                       nullable=column.nullable,
+                       server_default=column.server_default and column.server_default.arg)
+                for column in table.columns],
+              *[Index(index.name, *[column.name for column in index.columns])
+                for index in table.indexes],
+              *extra)
+
+    return metadata
+
+
+# the shards' likes table, for statements on its extra column
+SHARD_LIKES = shard_metadata().tables['likes']
+
+
+def newest_first(row):
+    return (row.timestamp, row.id)
+
+
+def message_rows_query(message_ids):
+    """Select of SHARD_MESSAGE_COLUMNS for these message ids."""
+
+    return select(*SHARD_MESSAGE_COLUMNS).where(Message.id.in_(message_ids))
+
+
+def timeline_query(user_ids, limit, before=None):
+    """Select of the newest `limit` messages by `user_ids` on one shard."""
+
+    query = (select(*SHARD_MESSAGE_COLUMNS)
+             .where(Message.user_id.in_(user_ids))
+             .order_by(Message.timestamp.desc(), Message.id.desc()))
+
+    if before:
+        query = query.where(db.tuple_(Message.timestamp, Message.id) < before)
+
+    return query.limit(limit)
+
+
+def with_authors(rows):
+    """MessageRows from SHARD_MESSAGE_COLUMNS rows, authors read from the main DB.
+
+    Rows whose author no longer exists are dropped.
+    """
+
+    user_ids = {row.user_id for row in rows}
+    authors = {row.id: Author(*row) for row in db.session.execute(
+        select(User.id, User.username, User.image_url).where(User.id.in_(user_ids)))}
+
+    return [MessageRow(*row, authors[row.user_id]) for row in rows if row.user_id in authors]
+
+
+class ShardSet:
+    """The databases that messages and likes are spread over."""
+
+    def __init__(self, urls=()):
+        self.urls = list(urls)
+        self.engines = [create_engine(url) for url in self.urls]
+        self.sessions = [scoped_session(sessionmaker(bind=engine, query_cls=BaseQuery))
+                         for engine in self.engines]
+        self.pool = ThreadPoolExecutor(len(self.urls)) if len(self.urls) > 1 else None
+
+    def __len__(self):
+        return max(len(self.urls), 1)
+
+    @property
+    def sharded(self):
+        """Do messages and likes live outside the main database?"""
+
+        return bool(self.urls)
+
+    def shard_for(self, user_id):
+        """Index of the shard holding `user_id`'s messages and likes."""
+
+        return user_id % len(self)
+
+    def session(self, shard):
+        return self.sessions[shard] if self.sharded else db.session
+
+    def for_user(self, user_id):
+        """Session for `user_id`'s shard."""
+
+        return self.session(self.shard_for(user_id))
+
+    def shards_for_message(self, message_id):
+        """Shard indexes to look for a message on, most likely first."""
+
+        first = (message_id - 1) % len(self)
+        return [first] + [shard for shard in range(len(self)) if shard != first]
+
+    def by_shard(self, user_ids):
+        """{shard: [user ids on it]} for `user_ids`."""
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return groups
+
+    def commit(self):
+        """Commit every shard, then the main database."""
+
+        for session in self.sessions:
+            session.commit()
+        db.session.commit()
+
+    def rollback(self):
+        for session in self.sessions:
+            session.rollback()
+        db.session.rollback()
+
+    def remove(self):
+        """End this thread's shard sessions (at app context teardown)."""
+
+        for session in self.sessions:
+            session.remove()
+
+    ##########################################################################
+    # Setup
+
+    def create_tables(self):
+        """Create SHARDED_TABLES on every shard that doesn't have them."""
+
+        metadata = shard_metadata()
+        for engine in self.engines:
+            metadata.create_all(engine)
+            # shards created before likes kept their message's timestamp
+            with engine.begin() as conn:
+                conn.exec_driver_sql("ALTER TABLE likes ADD COLUMN IF NOT EXISTS "
+                                     "message_timestamp TIMESTAMP WITHOUT TIME ZONE")
+                conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS "
+                                     "ix_likes_user_id_message_timestamp "
+                                     "ON likes (user_id, message_timestamp, message_id)")
+
+    def release_message_foreign_keys(self, engine):
+        """Drop foreign keys to `messages` in `engine`'s database.
+
+        Likes and main-database rows (notifications, trending buckets...)
+        may refer to messages on any shard.
+        """
+
+        inspector = inspect(engine)
+
+        with engine.begin() as conn:
+            for table in inspector.get_table_names():
+                for fk in inspector.get_foreign_keys(table):
+                    if fk['referred_table'] == 'messages' and fk['name']:
+                        conn.exec_driver_sql(
+                            f'ALTER TABLE "{table}" DROP CONSTRAINT "{fk["name"]}"')
+
+    def move_from_main(self, batch_size=MOVE_BATCH_SIZE):
+        """Move the main database's messages and likes onto their shards.
+
+        A batch at a time: copied (skipping rows a shard already has),
+        committed on the shards, then deleted from the main database, so
+        an interrupted move can be re-run. Likes go first, to read their
+        messages' timestamps. Returns (messages, likes) moved.
+        """
+
+        likes = 0
+        while True:
+            rows = db.session.execute(
+                select(Like.user_id, Like.message_id, Like.created_at,
+                       Message.timestamp.label('message_timestamp'))
+                .outerjoin(Message, Message.id == Like.message_id)
+                .limit(batch_size)).all()
+            if not rows:
+                break
+
+            for shard, group in self._group(rows, lambda row: row.user_id):
+                self.session(shard).execute(insert(SHARD_LIKES)
+                                            .values([dict(row._mapping) for row in group])
+                                            .on_conflict_do_nothing())
+            self.commit()
+
+            db.session.execute(delete(Like).where(
+                db.tuple_(Like.user_id, Like.message_id)
+                .in_([(row.user_id, row.message_id) for row in rows])))
+            db.session.commit()
+            likes += len(rows)
+
+        messages = 0
+        while True:
+            rows = db.session.execute(select(Message.__table__).limit(batch_size)).all()
+            if not rows:
+                break
+
+            for shard, group in self._group(rows, lambda row: row.user_id):
+                self.session(shard).execute(insert(Message.__table__)
+                                            .values([dict(row._mapping) for row in group])
+                                            .on_conflict_do_nothing())
+            self.commit()
+
+            db.session.execute(delete(Message).where(Message.id.in_([row.id for row in rows])))
+            db.session.commit()
+            messages += len(rows)
+
+        return messages, likes
+
+    def fill_like_timestamps(self, batch_size=MOVE_BATCH_SIZE):
+        """Give shard likes from before message timestamps were kept theirs.
+
+        Likes of messages that no longer exist are deleted. Returns how
+        many likes were filled in.
+        """
+
+        filled = 0
+
+        for session in self.sessions:
+            while True:
+                message_ids = [id for (id,) in session.execute(
+                    select(SHARD_LIKES.c.message_id)
+                    .where(SHARD_LIKES.c.message_timestamp.is_(None))
+                    .distinct()
+                    .limit(batch_size))]
+                if not message_ids:
+                    break
+
+                statement = select(Message.id, Message.timestamp).where(Message.id.in_(message_ids))
+                timestamps = dict(chain.from_iterable(
+                    self.scatter({shard: statement for shard in range(len(self))}).values()))
+
+                for message_id in message_ids:
+                    likes = SHARD_LIKES.c.message_id == message_id
+                    if message_id in timestamps:
+                        filled += session.execute(
+                            update(SHARD_LIKES).where(likes)
+                            .values(message_timestamp=timestamps[message_id])).rowcount
+                    else:
+                        session.execute(delete(SHARD_LIKES).where(likes))
+                session.commit()
+
+        return filled
+
+    def _group(self, rows, user_id):
+        """(shard, rows) pairs, grouping `rows` by the shard of `user_id(row)`."""
+
+        shards = {}
+        for row in rows:
+            shards.setdefault(self.shard_for(user_id(row)), []).append(row)
+        return shards.items()
+
+    def interleave_ids(self):
+        """Make shard k hand out message ids k + 1, k + 1 + N, ... past any existing id."""
+
+        engines = [db.engine] + self.engines
+        top = max(self._max_message_id(engine) for engine in engines)
+        start = (top // len(self) + 1) * len(self)
+
+        for shard, engine in enumerate(self.engines):
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f"ALTER SEQUENCE messages_id_seq "
+                                     f"INCREMENT BY {len(self)} RESTART WITH {start + shard + 1}")
+
+    @staticmethod
+    def _max_message_id(engine):
+        if not inspect(engine).has_table(Message.__tablename__):
+            return 0
+
+        with engine.connect() as conn:
+            return conn.execute(select(func.coalesce(func.max(Message.id), 0))).scalar()
+
+    ##########################################################################
+    # Reads
+
+    def execute(self, shard, statement):
+        """Rows of `statement` run on `shard`, outside any session."""
+
+        if not self.sharded:
+            return db.session.execute(statement).all()
+
+        with self.engines[shard].connect() as conn:
+            return conn.execute(statement).all()
+
+    def scatter(self, statements):
+        """{shard: rows} for a {shard: statement} dict, run in parallel."""
+
+        if len(statements) < 2:
+            return {shard: self.execute(shard, statement)
+                    for shard, statement in statements.items()}
+
+        futures = {shard: self.pool.submit(self.execute, shard, statement)
+                   for shard, statement in statements.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def message_rows(self, message_ids):
+        """MessageRows for those of `message_ids` that exist, in no order."""
+
+        groups = {}
+        for message_id in set(message_ids):
+            groups.setdefault(self.shards_for_message(message_id)[0], []).append(message_id)
+
+        rows = list(chain.from_iterable(self.scatter(
+            {shard: message_rows_query(ids) for shard, ids in groups.items()}).values()))
+
+        missing = set(message_ids) - {row.id for row in rows}
+        if missing and len(self) > 1:
+            rows += chain.from_iterable(self.scatter(
+                {shard: message_rows_query(missing) for shard in range(len(self))}).values())
+
+        return with_authors(rows)
+
+    def get_message(self, message_id):
+        """MessageRow for `message_id`, or None."""
+
+        messages = self.message_rows([message_id])
+        return messages[0] if messages else None
+
+    def timeline(self, user_ids, limit, before=None):
+        """archive.timeline(), merged from every shard holding one of `user_ids`."""
+
+        if not self.sharded:
+            return timeline(user_ids, limit, before)
+
+        results = self.scatter({shard: timeline_query(ids, limit, before)
+                                for shard, ids in self.by_shard(user_ids).items()})
+        rows = list(islice(heapq.merge(*results.values(), key=newest_first, reverse=True), limit))
+
+        return with_archived(with_authors(rows), user_ids, limit, before)
+
+    def liked_messages(self, user_id, page=1, per_page=LIKES_PER_PAGE, order_by="liked"):
+        """A Pagination of messages `user_id` liked, newest first.
+
+        `order_by` is "liked" (when the like was made) or "posted"
+        (message timestamp).
+        """
+
+        if not self.sharded:
+            return (Message
+                    .liked_by_query(user_id, order_by)
+                    .paginate(page=page, per_page=per_page, error_out=False))
+
+        page = max(page, 1)
+        shard = self.shard_for(user_id)
+        total = self.count_likes(user_id)
+
+        if order_by == "liked":
+            message_ids = [id for (id,) in self.execute(shard, (
+                select(Like.message_id)
+                .where(Like.user_id == user_id)
+                .order_by(Like.created_at.desc(), Like.message_id.desc())
+                .offset((page - 1) * per_page)
+                .limit(per_page)))]
+            messages = {msg.id: msg for msg in self.message_rows(message_ids)}
+            items = [messages[id] for id in message_ids if id in messages]
+        else:
+            # the likes keep their messages' timestamps, so the page is
+            # found on the liker's shard alone
+            message_ids = [id for (id,) in self.execute(shard, (
+                select(SHARD_LIKES.c.message_id)
+                .where(SHARD_LIKES.c.user_id == user_id)
+                .order_by(SHARD_LIKES.c.message_timestamp.desc().nullslast(),
+                          SHARD_LIKES.c.message_id.desc())
+                .offset((page - 1) * per_page)
+                .limit(per_page)))]
+            messages = {msg.id: msg for msg in self.message_rows(message_ids)}
+            items = [messages[id] for id in message_ids if id in messages]
+
+        return Pagination(None, page, per_page, total, items)
+
+    def likers_page(self, message_id, before=None, per_page=LIKERS_PER_PAGE):
+        """Returns ([(user, liked_at)], next_before) for who liked a message.
+
+        Like Message.get_likers_page(), but gathers likes from every shard.
+        """
+
+        query = (select(Like.user_id, Like.created_at)
+                 .where(Like.message_id == message_id)
+                 .order_by(Like.created_at.desc(), Like.user_id.desc())
+                 .limit(per_page + 1))
+
+        if before:
+            query = query.where(db.tuple_(Like.created_at, Like.user_id) < before)
+
+        results = self.scatter({shard: query for shard in range(len(self))})
+        likes = list(islice(heapq.merge(*results.values(),
+                                        key=lambda like: (like.created_at, like.user_id),
+                                        reverse=True),
+                            per_page + 1))
+
+        users = {user.id: user for user in
+                 User.active().filter(User.id.in_([like.user_id for like in likes]))}
+        likers = [(users[like.user_id], like.created_at)
+                  for like in likes[:per_page] if like.user_id in users]
+
+        if len(likes) > per_page:
+            last = likes[per_page - 1]
+            return likers, (last.created_at, last.user_id)
+
+        return likers, None
+
+    def liked_message_ids(self, user_id, among=None):
+        """Ids of messages `user_id` likes; optionally only those in `among`."""
+
+        statement = select(Like.message_id).where(Like.user_id == user_id)
+        if among is not None:
+            statement = statement.where(Like.message_id.in_(among))
+
+        return [id for (id,) in self.execute(self.shard_for(user_id), statement)]
+
+    def message_ids(self, user_id):
+        """Ids of `user_id`'s messages, archived ones aside."""
+
+        return [id for (id,) in self.execute(
+            self.shard_for(user_id), select(Message.id).where(Message.user_id == user_id))]
+
+    def recent_messages(self, since):
+        """(id, user_id) of every message posted since `since`."""
+
+        statement = select(Message.id, Message.user_id).where(Message.timestamp >= since)
+        return list(chain.from_iterable(
+            self.scatter({shard: statement for shard in range(len(self))}).values()))
+
+    def count_likes(self, user_id):
+        return self.execute(self.shard_for(user_id),
+                            select(func.count()).where(Like.user_id == user_id))[0][0]
+
+    def count_messages(self, user_id):
+        """Messages by `user_id`, archived ones (in the main database) included."""
+
+        hot = self.execute(self.shard_for(user_id),
+                           select(func.count()).where(Message.user_id == user_id))[0][0]
+        archived = (db.session
+                    .query(func.coalesce(func.sum(MessageArchive.count), 0))
+                    .filter(MessageArchive.user_id == user_id)
+                    .scalar())
+
+        return hot + archived
+
+    ##########################################################################
+    # Writes (committed by commit())
+
+    def add_message(self, user_id, text):
+        """Add a message on its author's shard; returns it with its id."""
+
+        msg = Message(user_id=user_id, text=text)
+        session = self.for_user(user_id)
+        session.add(msg)
+        session.flush()
+        return msg
+
+    def delete_message(self, message_id):
+        """Delete a message and its likes. Returns its author's id, or None."""
+
+        for shard in self.shards_for_message(message_id):
+            author_id = self.session(shard).execute(
+                delete(Message)
+                .where(Message.id == message_id)
+                .returning(Message.user_id)).scalar()
+
+            if author_id is not None:
+                for session in self.sessions:
+                    session.execute(delete(Like).where(Like.message_id == message_id))
+                return author_id
+
+        return None
+
+    def like(self, user_id, message_id):
+        """Record a like and count it. Returns the message's author id.
+
+        Returns None, changing nothing, if there's no such message or
+        it's already liked.
+        """
+
+        for shard in self.shards_for_message(message_id):
+            message = self.session(shard).execute(
+                update(Message)
+                .where(Message.id == message_id)
+                .values(like_count=Message.like_count + 1)
+                .returning(Message.user_id, Message.timestamp)).first()
+
+            if message is not None:
+                break
+        else:
+            return None
+
+        author_id, timestamp = message
+        likes = SHARD_LIKES if self.sharded else Like.__table__
+        values = dict(user_id=user_id, message_id=message_id, created_at=datetime.utcnow())
+        if self.sharded:
+            values['message_timestamp'] = timestamp
+
+        added = self.for_user(user_id).execute(
+            insert(likes)
+            .values(**values)
+            .on_conflict_do_nothing()
+            .returning(likes.c.user_id)).scalar()
+
+        if added is None:
+            self.rollback()
+            return None
+
+        return author_id
+
+    def purge_user(self, user_id, batch_size):
+        """Delete `user_id`'s messages (and everyone's likes of them) and likes.
+
+        Commits after each batch. Like counts are only decremented for
+        likes this call deleted, so overlapping purges can't uncount twice.
+        """
+
+        session = self.for_user(user_id)
+
+        while True:
+            ids = [id for (id,) in session.execute(
+                select(Message.id).where(Message.user_id == user_id).limit(batch_size))]
+            if not ids:
+                break
+
+            for other in self.sessions:
+                other.execute(delete(Like).where(Like.message_id.in_(ids)))
+            session.execute(delete(Message).where(Message.id.in_(ids)))
+            self.commit()
+
+        while True:
+            batch = select(Like.message_id).where(Like.user_id == user_id).limit(batch_size)
+            liked = [id for (id,) in session.execute(
+                delete(Like)
+                .where(Like.user_id == user_id, Like.message_id.in_(batch.scalar_subquery()))
+                .returning(Like.message_id)
+                .execution_options(synchronize_session=False))]
+            if not liked:
+                break
+
+            for other in self.sessions:
+                other.execute(update(Message)
+                              .where(Message.id.in_(liked))
+                              .values(like_count=Message.like_count - 1))
+            self.commit()
+
+    def unlike(self, user_id, message_id):
+        """Remove a like and uncount it. Returns when it was made, or None."""
+
+        liked_at = self.for_user(user_id).execute(
+            delete(Like)
+            .where(Like.user_id == user_id, Like.message_id == message_id)
+            .returning(Like.created_at)).scalar()
+
+        if liked_at is not None:
+            for shard in self.shards_for_message(message_id):
+                if self.session(shard).execute(
+                        update(Message)
+                        .where(Message.id == message_id)
+                        .values(like_count=Message.like_count - 1)).rowcount:
+                    break
+
+        return liked_at
+
+
+def make_shards(urls):
+    """ShardSet for a comma-separated list of database URLs (none: unsharded)."""
+
+    return ShardSet([url.strip() for url in urls.split(',') if url.strip()])
@@ -0,0 +1,225 @@
+"""In-process cache of the follows graph for id-only follow queries.
+
+Each user's node holds who they follow and who follows them as sorted
+NumPy int64 arrays of user ids, so "ids I follow", "does A follow B"
+and "mutual follows" are answered with slices, binary searches and
+merges instead of ORM relationship loads. Only active users appear in
+the arrays.
+
+Nodes are loaded from `follows` on first use (or all at once with
+`warm()`), and the follow/unfollow routes update them in place. Every
+node remembers the user version (see sessions.py) it was loaded at; a
+node whose user has been bumped since -- possibly by another worker --
+is reloaded on its next use.
+"""
+
+import threading
+
+import numpy as np
+
+from models import db, Follows, User
+
+class Node:
+    """One user's follow edges."""
+
+    __slots__ = ('following', 'followers', 'version')
+
+    def __init__(self, following, followers, version):
+        self.following = following
+        self.followers = followers
+        self.version = version
+
+
+def _sorted_ids(ids):
+    """Sorted, de-duplicated int64 array of `ids`."""
+
+    return np.unique(np.fromiter(ids, dtype=np.int64))
+
+
+def _contains(ids, value):
+    """Is `value` in sorted array `ids`?"""
+
+    i = np.searchsorted(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+def _insert(ids, value):
+    """Sorted array `ids` with `value` added."""
+
+    i = np.searchsorted(ids, value)
+    if i < len(ids) and ids[i] == value:
+        return ids
+    return np.insert(ids, i, value)
+
+
+def _remove(ids, value):
+    """Sorted array `ids` with `value` taken out."""
+
+    i = np.searchsorted(ids, value)
+    if i < len(ids) and ids[i] == value:
+        return np.delete(ids, i)
+    return ids
+
+
+class SocialGraph:
+    """Follow edges per user, kept as sorted id arrays.
+
+    `version_of(user_id)` returns the user's current version; nodes
+    loaded at an older version are reloaded.
+    """
+
+    def __init__(self, version_of=lambda user_id: 0):
+        self.version_of = version_of
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def warm(self):
+        """Load every active user's node with one pass over `follows`."""
+
+        active = (db.session
+                  .query(User.id)
+                  .filter(User.deleted_at.is_(None))
+                  .order_by(User.id))
+        user_ids = np.fromiter((id for (id,) in active), dtype=np.int64)
+
+        edges = np.array(
+            db.session.query(Follows.user_following_id,
+                             Follows.user_being_followed_id).all(),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        edges = edges[np.isin(edges[:, 0], user_ids) & np.isin(edges[:, 1], user_ids)]
+
+        by_follower = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+        by_followed = edges[np.lexsort((edges[:, 0], edges[:, 1]))]
+
+        following = np.split(by_follower[:, 1],
+                             np.searchsorted(by_follower[:, 0], user_ids[1:]))
+        followers = np.split(by_followed[:, 0],
+                             np.searchsorted(by_followed[:, 1], user_ids[1:]))
+
+        nodes = {}
+        for user_id, followed, follower in zip(user_ids.tolist(), following, followers):
+            nodes[user_id] = Node(followed.copy(), follower.copy(),
+                                  self.version_of(user_id))
+
+        with self.lock:
+            self.nodes = nodes
+
+        return len(nodes)
+
+    def load(self, user_id):
+        """Read `user_id`'s node from the database."""
+
+        version = self.version_of(user_id)
+
+        following = (db.session
+                     .query(Follows.user_being_followed_id)
+                     .join(User, User.id == Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == user_id,
+                             User.deleted_at.is_(None)))
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .join(User, User.id == Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id,
+                             User.deleted_at.is_(None)))
+
+        return Node(_sorted_ids(id for (id,) in following),
+                    _sorted_ids(id for (id,) in followers),
+                    version)
+
+    def node(self, user_id):
+        """`user_id`'s node, (re)loading it if missing or out of date."""
+
+        node = self.nodes.get(user_id)
+
+        if node is None or node.version != self.version_of(user_id):
+            node = self.load(user_id)
+            with self.lock:
+                self.nodes[user_id] = node
+
+        return node
+
+    def forget(self, *user_ids):
+        """Drop cached nodes; they are reloaded on next use."""
+
+        with self.lock:
+            for user_id in user_ids:
+                self.nodes.pop(user_id, None)
+
+    def following(self, user_id):
+        """Sorted array of ids `user_id` follows."""
+
+        return self.node(user_id).following
+
+    def followers(self, user_id):
+        """Sorted array of ids following `user_id`."""
+
+        return self.node(user_id).followers
+
+    def following_ids(self, user_id, among=None):
+        """Set of ids `user_id` follows, optionally only those in `among`."""
+
+        following = self.following(user_id)
+
+        if among is not None:
+            following = np.intersect1d(following, _sorted_ids(among), assume_unique=True)
+
+        return set(following.tolist())
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        return bool(_contains(self.following(user_id), other_id))
+
+    def mutual_ids(self, user_id):
+        """Sorted array of ids that `user_id` follows and is followed by."""
+
+        node = self.node(user_id)
+        return np.intersect1d(node.following, node.followers, assume_unique=True)
+
+    def neighbour_ids(self, user_id):
+        """Sorted array of ids that `user_id` follows or is followed by."""
+
+        node = self.node(user_id)
+        return np.union1d(node.following, node.followers)
+
+    def follow(self, user_id, other_id):
+        """Record that `user_id` now follows `other_id`.
+
+        Call after the change is committed and the users' versions are
+        bumped, so cached nodes are updated rather than reloaded.
+        """
+
+        self._update(user_id, other_id, _insert)
+
+    def unfollow(self, user_id, other_id):
+        """Record that `user_id` no longer follows `other_id`."""
+
+        self._update(user_id, other_id, _remove)
+
+    def _update(self, user_id, other_id, change):
+        with self.lock:
+            node = self._patchable(user_id)
+            if node is not None:
+                node.following = change(node.following, other_id)
+                self.nodes[user_id] = node
+
+            node = self._patchable(other_id)
+            if node is not None:
+                node.followers = change(node.followers, user_id)
+                self.nodes[other_id] = node
+
+    def _patchable(self, user_id):
+        """Fresh copy of a cached node that missed only the latest bump.
+
+        Nodes further behind are dropped instead, to be reloaded.
+        """
+
+        node = self.nodes.get(user_id)
+        version = self.version_of(user_id)
+
+        if node is None or node.version != version - 1:
+            self.nodes.pop(user_id, None)
+            return None
+
+        return Node(node.following, node.followers, version)
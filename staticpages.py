@@ -0,0 +1,292 @@
+"""Pre-rendered profile and message pages for signed-out visitors.
+
+Every signed-out visitor -- most of them crawlers -- sees the same
+profile (first page) and the same single-message page, so `StaticPages`
+keeps those renders as HTML files and the app answers signed-out GETs
+from the file before any hook reads the database. Pages are rendered by
+calling the Flask view itself in a request context with no user, so a
+file is exactly what the view would have sent.
+
+`flask render-static-pages` renders the profiles of users who posted in
+the last ACTIVE_DAYS and those messages, and removes every other file.
+After that, writes keep the files fresh a page at a time: `refresh()`
+removes the pages a write changed at once, so a stale file is never
+served, and renders them again in a background thread. A page whose
+render is already under way is queued again, since that render may have
+read the database before the write. Pages without a file are left to
+the view until something creates them (a new message creates its own
+page and its author's profile).
+
+Other app processes (gunicorn workers) share the directory but not that
+queue, so each page also has a version file under VERSIONS that
+`remove()` bumps. A render notes the version before it reads the
+database and only replaces the file if the version is unchanged,
+holding the version file's lock; otherwise its HTML is thrown away.
+
+A user's message pages show their name and picture, so a profile edit
+refreshes all of them and a deleted account's are removed. Listing a
+user's messages costs O(messages), so that is left to the worker too
+(`refresh(authors=...)`, `remove_authors()`), using the `message_ids`
+function the app passes in.
+
+Changes made outside the app -- stats, archiving, purges -- reach the
+files on the next `render-static-pages` run.
+"""
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import g, send_file
+from werkzeug.exceptions import NotFound
+
+PROFILE = 'users_show'
+MESSAGE = 'messages_show'
+# endpoint: (folder, view argument)
+PAGES = {
+    PROFILE: ('users', 'user_id'),
+    MESSAGE: ('messages', 'message_id'),
+}
+ACTIVE_DAYS = 30
+# folder of per-page version files, bumped whenever a page is removed
+VERSIONS = 'versions'
+# worker tasks for every message page of a user: re-render, or remove
+AUTHOR = 'author'
+GONE_AUTHOR = 'gone_author'
+
+
+class StaticPages:
+    """Directory of pre-rendered signed-out pages, kept fresh as things change.
+
+    With no directory, nothing is stored or served.
+    """
+
+    def __init__(self, app, directory=None, message_ids=None):
+        self.app = app
+        self.directory = directory or None
+        # user id -> ids of their messages
+        self.message_ids = message_ids
+        self.pending = set()
+        # pages the worker is rendering right now
+        self.rendering = set()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def path(self, endpoint, key):
+        return os.path.join(self.directory, PAGES[endpoint][0], f"{key}.html")
+
+    @contextmanager
+    def _version(self, endpoint, key):
+        """Lock a page's version file; yields a function reading it and one bumping it."""
+
+        path = os.path.join(self.directory, VERSIONS, PAGES[endpoint][0], str(key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            def read():
+                return int(os.pread(fd, 32, 0) or 0)
+
+            def bump():
+                data = str(read() + 1).encode()
+                os.pwrite(fd, data, 0)
+                os.ftruncate(fd, len(data))
+
+            yield read, bump
+        finally:
+            os.close(fd)
+
+    def lookup(self, endpoint, view_args, args):
+        """File path for a signed-out request, or None if it isn't stored."""
+
+        # later pages of a profile aren't stored
+        if not self.enabled or endpoint not in PAGES or args:
+            return None
+
+        path = self.path(endpoint, view_args[PAGES[endpoint][1]])
+        return path if os.path.exists(path) else None
+
+    def response(self, path):
+        """Response sending a stored page, or None if it was just removed."""
+
+        try:
+            response = send_file(path, mimetype='text/html', conditional=True)
+        except FileNotFoundError:
+            return None
+
+        # crawlers can revalidate with If-Modified-Since / If-None-Match
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        return response
+
+    ##########################################################################
+    # Rendering
+
+    def render(self, endpoint, key):
+        """Write the file for one page, or remove it if the page is gone.
+
+        Returns whether it was written. A render that the page was
+        removed during, by any process, is thrown away.
+        """
+
+        folder, arg = PAGES[endpoint]
+
+        with self._version(endpoint, key) as (read, _):
+            version = read()
+
+        # a fresh app context: g and the database sessions are its own
+        with self.app.app_context(), self.app.test_request_context(f"/{folder}/{key}"):
+            g.user = None
+            try:
+                response = self.app.make_response(
+                    self.app.view_functions[endpoint](**{arg: key}))
+                html = response.get_data()
+            except NotFound:
+                html = None
+
+        path = self.path(endpoint, key)
+
+        if html is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(html)
+
+        with self._version(endpoint, key) as (read, _):
+            if read() != version:
+                # removed since the render read the database
+                if html is not None:
+                    self._remove(tmp_path)
+                return False
+
+            if html is None:
+                self._remove(path)
+                return False
+
+            os.replace(tmp_path, path)
+
+        return True
+
+    def generate(self, user_ids, message_ids):
+        """Render these profiles and messages and remove every other file.
+
+        Returns the number of pages written.
+        """
+
+        written = set()
+
+        for endpoint, keys in ((PROFILE, user_ids), (MESSAGE, message_ids)):
+            for key in keys:
+                if self.render(endpoint, key):
+                    written.add(self.path(endpoint, key))
+
+        for folder, _ in PAGES.values():
+            folder = os.path.join(self.directory, folder)
+            os.makedirs(folder, exist_ok=True)
+            for entry in os.scandir(folder):
+                if entry.path not in written:
+                    self._remove(entry.path)
+
+        return len(written)
+
+    ##########################################################################
+    # Keeping fresh
+
+    def refresh(self, users=(), messages=(), authors=(), create=False, in_background=True):
+        """Re-render these profiles and messages.
+
+        Only pages that have a file are rendered again, unless `create`.
+        Their files are removed right away either way. The message pages
+        of `authors` are refreshed the same way, but found and removed by
+        the worker. Renders run on a worker thread; without
+        `in_background` this waits for them.
+        """
+
+        if not self.enabled:
+            return
+
+        pages = {(PROFILE, key) for key in users} | {(MESSAGE, key) for key in messages}
+        stale = self.remove(pages)
+
+        with self.lock:
+            rendering = pages & self.rendering
+        self._queue((pages if create else stale | rendering) |
+                    {(AUTHOR, key) for key in authors}, in_background)
+
+    def remove_authors(self, user_ids, in_background=True):
+        """Remove the message pages of these users, on the worker thread."""
+
+        if self.enabled:
+            self._queue({(GONE_AUTHOR, key) for key in user_ids}, in_background)
+
+    def _queue(self, tasks, in_background):
+        with self.lock:
+            self.pending |= tasks
+            if self.pending and self.worker is None:
+                self.worker = threading.Thread(target=self._render_pending, daemon=True)
+                self.worker.start()
+            worker = self.worker
+
+        if worker is not None and not in_background:
+            worker.join()
+
+    def remove(self, pages):
+        """Remove the files of these (endpoint, key) pages; returns those that had one."""
+
+        if not self.enabled:
+            return set()
+
+        removed = set()
+        for endpoint, key in pages:
+            with self._version(endpoint, key) as (_, bump):
+                bump()
+                if self._remove(self.path(endpoint, key)):
+                    removed.add((endpoint, key))
+
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _render_pending(self):
+        while True:
+            with self.lock:
+                self.rendering = set()
+                if not self.pending:
+                    self.worker = None
+                    return
+                pages, self.pending = self.pending, set()
+                self.rendering = pages
+
+            for endpoint, key in pages:
+                try:
+                    if endpoint in (AUTHOR, GONE_AUTHOR):
+                        self._expand_author(key, rerender=endpoint == AUTHOR)
+                    else:
+                        self.render(endpoint, key)
+                except Exception:
+                    # the page was removed, so the view serves it meanwhile
+                    self.app.logger.exception("Could not render %s %s", endpoint, key)
+
+    def _expand_author(self, user_id, rerender):
+        """Remove `user_id`'s message pages; queue those that had a file to render again."""
+
+        with self.app.app_context():
+            message_ids = self.message_ids(user_id)
+
+        stale = self.remove({(MESSAGE, key) for key in message_ids})
+
+        if rerender:
+            with self.lock:
+                self.pending |= stale
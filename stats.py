@@ -0,0 +1,262 @@
+"""Per-user engagement statistics, computed offline.
+
+`compute_user_stats()` splits the users to update into partitions by id
+and hands each partition to a worker process. A worker streams the
+rows it needs over its own connection with server-side cursors -- its
+users' messages and like counts, archived message blocks, and incoming
+follows -- into NumPy arrays, aggregates them with vectorized group-bys
+and upserts one `user_stats` row per user in batches. The profile page
+reads a user's row with a primary key lookup.
+
+Runs are incremental: the `job_checkpoints` row records when the last
+run started, and the next run only recomputes users with new messages,
+likes or followers since then, plus users with no stats yet. Deleting a
+message or an unfollow doesn't mark a user, so run with full=True now
+and then to recompute everyone. Likes on archived messages aren't
+counted, as `likes` no longer holds them.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import any_, bindparam, create_engine, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from models import db, User, Message, Follows, Like, MessageArchive, UserStats, JobCheckpoint
+
+CHECKPOINT = 'user-stats'
+RECENT = timedelta(days=30)
+FETCH_SIZE = 10000
+UPSERT_BATCH_SIZE = 5000
+
+NO_TIME = np.datetime64('NaT', 'us')
+
+
+def changed_user_ids(since):
+    """Ids of active users whose stats may have changed since `since`."""
+
+    posted = (db.session
+              .query(Message.user_id)
+              .filter(Message.timestamp >= since))
+    liked = (db.session
+             .query(Message.user_id)
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.created_at >= since))
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.created_at >= since))
+    missing = (db.session
+               .query(User.id)
+               .outerjoin(UserStats, UserStats.user_id == User.id)
+               .filter(UserStats.user_id.is_(None)))
+
+    changed = posted.union(liked, followed, missing).subquery()
+
+    return [id for (id,) in (db.session
+                             .query(User.id)
+                             .filter(User.id.in_(select(changed)),
+                                     User.deleted_at.is_(None))
+                             .order_by(User.id))]
+
+
+def active_user_ids():
+    """Ids of every active user."""
+
+    return [id for (id,) in (db.session
+                             .query(User.id)
+                             .filter(User.deleted_at.is_(None))
+                             .order_by(User.id))]
+
+
+def _stream(conn, stmt, params, dtypes):
+    """Run `stmt` on a server-side cursor; one NumPy array per column."""
+
+    result = conn.execution_options(stream_results=True).execute(stmt, params)
+    chunks = [[] for _ in dtypes]
+
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+
+        for chunk, column, dtype in zip(chunks, zip(*rows), dtypes):
+            chunk.append(np.array(column, dtype=dtype))
+
+    return [np.concatenate(chunk) if chunk else np.empty(0, dtype=dtype)
+            for chunk, dtype in zip(chunks, dtypes)]
+
+
+def _first_per_group(groups, *sort_keys):
+    """(groups present, index of each group's first row by sort_keys)."""
+
+    order = np.lexsort(sort_keys[::-1] + (groups,))
+    present, starts = np.unique(groups[order], return_index=True)
+    return present, order[starts]
+
+
+def aggregate(user_ids, messages, archives, follows, now):
+    """`user_stats` rows for `user_ids` from streamed column arrays.
+
+    `messages` is (user_id, id, timestamp, like_count), `archives`
+    (user_id, count, period_start) and `follows` (followed user id,
+    created_at).
+    """
+
+    n = len(user_ids)
+    recent = np.datetime64(now - RECENT, 'us')
+    now = np.datetime64(now, 'us')
+
+    msg_user, msg_id, msg_time, msg_likes = messages
+    arc_user, arc_count, arc_start = archives
+    fol_user, fol_time = follows
+
+    msg_idx = np.searchsorted(user_ids, msg_user)
+    arc_idx = np.searchsorted(user_ids, arc_user)
+    fol_idx = np.searchsorted(user_ids, fol_user)
+
+    counts = (np.bincount(msg_idx, minlength=n)
+              + np.bincount(arc_idx, weights=arc_count, minlength=n).astype(np.int64))
+    recent_posts = np.bincount(msg_idx[msg_time >= recent], minlength=n)
+    likes_received = np.bincount(msg_idx, weights=msg_likes, minlength=n).astype(np.int64)
+    followers = np.bincount(fol_idx, minlength=n)
+    recent_followers = np.bincount(fol_idx[fol_time >= recent], minlength=n)
+
+    first = np.full(n, NO_TIME)
+    all_idx = np.concatenate([msg_idx, arc_idx])
+    all_time = np.concatenate([msg_time, arc_start])
+    present, rows = _first_per_group(all_idx, all_time)
+    first[present] = all_time[rows]
+
+    days = (now - first) / np.timedelta64(1, 'D')
+    per_day = np.where(np.isnat(first), 0.0, counts / np.maximum(days, 1.0))
+
+    # most liked message, earliest id on ties; only if it has any likes
+    top_id = np.full(n, -1)
+    top_likes = np.zeros(n, dtype=np.int64)
+    present, rows = _first_per_group(msg_idx, -msg_likes, msg_id)
+    top_id[present] = msg_id[rows]
+    top_likes[present] = msg_likes[rows]
+
+    computed_at = now.item()
+
+    for i in range(n):
+        yield {
+            'user_id': int(user_ids[i]),
+            'messages': int(counts[i]),
+            'first_message_at': None if np.isnat(first[i]) else first[i].item(),
+            'posts_per_day': float(per_day[i]),
+            'recent_posts': int(recent_posts[i]),
+            'likes_received': int(likes_received[i]),
+            'top_message_id': int(top_id[i]) if top_likes[i] else None,
+            'top_message_likes': int(top_likes[i]),
+            'followers': int(followers[i]),
+            'recent_followers': int(recent_followers[i]),
+            'computed_at': computed_at,
+        }
+
+
+def compute_partition(database_url, user_ids, now):
+    """Compute and upsert stats for `user_ids`. Runs in a worker process.
+
+    Returns the number of rows written.
+    """
+
+    engine = create_engine(database_url)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    params = {'ids': user_ids.tolist()}
+    ids = bindparam('ids', type_=ARRAY(db.Integer))
+
+    messages = (select(Message.user_id, Message.id, Message.timestamp, Message.like_count)
+                .where(Message.user_id == any_(ids)))
+    archives = (select(MessageArchive.user_id, MessageArchive.count, MessageArchive.period_start)
+                .where(MessageArchive.user_id == any_(ids)))
+    follows = (select(Follows.user_being_followed_id, Follows.created_at)
+               .join(User, User.id == Follows.user_following_id)
+               .where(Follows.user_being_followed_id == any_(ids),
+                      User.deleted_at.is_(None)))
+
+    try:
+        with engine.connect() as conn:
+            rows = aggregate(
+                user_ids,
+                _stream(conn, messages, params,
+                        (np.int64, np.int64, 'datetime64[us]', np.int64)),
+                _stream(conn, archives, params,
+                        (np.int64, np.int64, 'datetime64[us]')),
+                _stream(conn, follows, params,
+                        (np.int64, 'datetime64[us]')),
+                now,
+            )
+
+            written = 0
+            batch = []
+
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= UPSERT_BATCH_SIZE:
+                    written += _upsert(conn, batch)
+                    batch = []
+
+            if batch:
+                written += _upsert(conn, batch)
+
+        return written
+    finally:
+        engine.dispose()
+
+
+def _upsert(conn, rows):
+    """Insert or replace `rows` in user_stats, in one transaction."""
+
+    stmt = insert(UserStats.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={name: stmt.excluded[name] for name in rows[0] if name != 'user_id'},
+    )
+
+    with conn.begin():
+        conn.execute(stmt, rows)
+
+    return len(rows)
+
+
+def compute_user_stats(full=False, processes=None, now=None):
+    """Bring `user_stats` up to date. Returns the number of rows written.
+
+    Only users changed since the last run are recomputed unless `full`.
+    Work is spread over `processes` worker processes (default: one per
+    CPU); with processes=1 it runs in this process.
+    """
+
+    now = now or datetime.utcnow()
+    checkpoint = JobCheckpoint.query.get(CHECKPOINT)
+
+    if full or checkpoint is None:
+        user_ids = active_user_ids()
+    else:
+        user_ids = changed_user_ids(checkpoint.started_at)
+
+    database_url = db.engine.url.render_as_string(hide_password=False)
+
+    if not user_ids:
+        written = 0
+    elif processes == 1 or len(user_ids) == 1:
+        written = compute_partition(database_url, user_ids, now)
+    else:
+        processes = min(processes or os.cpu_count() or 1, len(user_ids))
+        partitions = [user_ids[part::processes] for part in range(processes)]
+        context = multiprocessing.get_context('spawn')
+
+        with ProcessPoolExecutor(processes, mp_context=context) as pool:
+            written = sum(pool.map(compute_partition,
+                                   [database_url] * processes,
+                                   partitions,
+                                   [now] * processes))
+
+    db.session.merge(JobCheckpoint(name=CHECKPOINT, started_at=now))
+    db.session.commit()
+
+    return written
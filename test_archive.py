@@ -0,0 +1,105 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like, MessageArchive
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from archive import archive_messages, archived_timeline, timeline
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving messages to the archive and reading them back."""
+
+    def setUp(self):
+        """Create a user with a year of messages, one a day."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        MessageArchive.query.delete()
+
+        user = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        fan = User(email="fan@test.com", username="fan", password="HASHED_PASSWORD")
+        db.session.add_all([user, fan])
+        db.session.commit()
+
+        self.now = datetime.utcnow()
+        messages = [Message(text=f"day {i}", user_id=user.id, timestamp=self.now - timedelta(days=i))
+                    for i in range(365)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        db.session.add(Like(user_id=fan.id, message_id=messages[300].id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.fan_id = fan.id
+
+    def test_archive_messages(self):
+        """Are old messages moved into compressed blocks"""
+
+        count = archive_messages(self.now - timedelta(days=99, hours=12), batch_size=50)
+
+        self.assertEqual(count, 265)
+        self.assertEqual(Message.query.count(), 100)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(db.session.query(db.func.sum(MessageArchive.count)).scalar(), 265)
+        self.assertEqual(User.query.get(self.user_id).count_messages(), 365)
+
+        archived = [msg for block in MessageArchive.query for msg in block.unpack()]
+        liked = [msg for msg in archived if msg.text == "day 300"]
+        self.assertEqual(liked[0].liker_ids, [self.fan_id])
+
+    def test_timeline_falls_back_to_archive(self):
+        """Does paging past the hot table continue into the archive"""
+
+        archive_messages(self.now - timedelta(days=99, hours=12))
+
+        page = timeline([self.user_id], 40)
+        self.assertEqual([m.text for m in page], [f"day {i}" for i in range(40)])
+
+        before = (page[-1].timestamp, page[-1].id)
+        page = timeline([self.user_id], 100, before=before)
+        self.assertEqual([m.text for m in page], [f"day {i}" for i in range(40, 140)])
+        self.assertFalse(page[59].archived)
+        self.assertTrue(page[60].archived)
+
+        before = (page[-1].timestamp, page[-1].id)
+        page = timeline([self.user_id], 1000, before=before)
+        self.assertEqual(len(page), 225)
+        self.assertEqual(page[-1].text, "day 364")
+
+    def test_archived_page_stops_early(self):
+        """Does a page of archived messages only unpack the blocks it needs"""
+
+        archive_messages(self.now - timedelta(days=99, hours=12))
+
+        unpacked = []
+        unpack = MessageArchive.unpack
+
+        def counting_unpack(block):
+            unpacked.append(block.id)
+            return unpack(block)
+
+        MessageArchive.unpack = counting_unpack
+        try:
+            page = archived_timeline([self.user_id], 10)
+        finally:
+            MessageArchive.unpack = unpack
+
+        self.assertEqual([m.text for m in page], [f"day {i}" for i in range(100, 110)])
+        self.assertLessEqual(len(unpacked), 2)
+        self.assertGreater(MessageArchive.query.count(), 8)
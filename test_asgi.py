@@ -0,0 +1,135 @@
+"""Async read path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, session_store, CURR_USER_KEY
+import asgi
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def call(method, path, query="", sid=None, serve_only=True):
+    """Run one request through the ASGI app; returns (served, status, body)."""
+
+    headers = [(b'host', b'localhost')]
+    if sid:
+        headers.append((b'cookie', f"session={sid}".encode('latin1')))
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'root_path': '', 'query_string': query.encode('latin1'),
+             'headers': headers, 'client': ('127.0.0.1', 1234), 'server': ('localhost', 80)}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        try:
+            if serve_only:
+                return await asgi.serve(scope, send)
+            await asgi.application(scope, receive, send)
+            return None
+        finally:
+            await asgi.engine.dispose()
+
+    served = asyncio.run(run())
+    if not sent:
+        return served, None, None
+
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return served, sent[0]['status'], body.decode('UTF-8')
+
+
+class AsgiTestCase(TestCase):
+    """Test which requests the async path serves, and what it renders."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.me = User.signup("me", "me@test.com", "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        self.msg = Message(text="hello from other", user_id=self.other.id)
+        db.session.add_all([self.msg, Follows(user_following_id=self.me.id,
+                                              user_being_followed_id=self.other.id)])
+        db.session.commit()
+
+        self.me_id, self.other_id, self.msg_id = self.me.id, self.other.id, self.msg.id
+
+    def login(self):
+        """Session id of a logged-in session with a current snapshot."""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.me_id
+        client.get('/messages/new')
+
+        return next(c.value for c in client.cookie_jar if c.name == 'session')
+
+    def test_anonymous_pages(self):
+        """Are anonymous views served without Flask"""
+
+        served, status, body = call('GET', '/')
+        self.assertTrue(served)
+        self.assertEqual(status, 200)
+
+        served, status, body = call('GET', f'/messages/{self.msg_id}')
+        self.assertTrue(served)
+        self.assertIn("hello from other", body)
+
+        served, status, body = call('GET', f'/users/{self.other_id}')
+        self.assertTrue(served)
+        self.assertIn("@other", body)
+
+    def test_logged_in_pages(self):
+        """Do logged-in views render the timeline and follow state"""
+
+        sid = self.login()
+
+        served, status, body = call('GET', '/', sid=sid)
+        self.assertTrue(served)
+        self.assertIn("hello from other", body)
+
+        served, status, body = call('GET', f'/users/{self.other_id}', sid=sid)
+        self.assertTrue(served)
+        self.assertIn("Unfollow", body)
+
+        served, status, body = call('GET', '/users', query="q=oth", sid=sid)
+        self.assertTrue(served)
+        self.assertIn("@other", body)
+        self.assertNotIn("@me<", body)
+
+    def test_falls_back_to_flask(self):
+        """Are requests the async path can't finish left to Flask"""
+
+        sid = self.login()
+        session_store.bump_user_version(self.me_id)
+
+        self.assertFalse(call('GET', '/', sid=sid)[0])
+        self.assertFalse(call('GET', '/messages/999999')[0])
+        self.assertFalse(call('GET', '/users')[0])
+        self.assertFalse(call('GET', '/login')[0])
+
+        served, status, body = call('GET', '/login', serve_only=False)
+        self.assertEqual(status, 200)
+        self.assertIn("Welcome back", body)
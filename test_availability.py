@@ -0,0 +1,180 @@
+"""Username/e-mail availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, bcrypt, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as warbler
+from app import app
+from availability import REBUILD_EVERY, CountingBloomFilter, TakenNames
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CountingBloomFilterTestCase(TestCase):
+    """Test the filter on its own."""
+
+    def test_membership(self):
+        """Are added keys always found, others rarely, and removals undone"""
+
+        bloom = CountingBloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+        bloom.add("twice")
+        bloom.add("twice")
+        bloom.remove("twice")
+        self.assertIn("twice", bloom)
+        bloom.remove("twice")
+        self.assertNotIn("twice", bloom)
+        self.assertEqual(len(bloom), 1000)
+
+
+class TakenNamesTestCase(TestCase):
+    """Test availability checks against the users table."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+
+        User.signup("alice", "alice@test.com", "password", None)
+        db.session.commit()
+
+        self.names = TakenNames()
+        self.statements = []
+
+    def record(self, *args):
+        self.statements.append(args[2])
+
+    def count_queries(self, check):
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+        try:
+            return check()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def test_taken(self):
+        """Are taken names found, and free ones answered without a query"""
+
+        self.names.load()
+
+        self.assertEqual(self.names.taken(username="alice", email="alice@test.com"),
+                         ['username', 'email'])
+        self.assertEqual(self.count_queries(
+            lambda: self.names.taken(username="bob", email="bob@test.com")), [])
+        self.assertEqual(self.statements, [])
+
+    def test_kept_in_step(self):
+        """Do adds, renames and removals show up"""
+
+        self.names.load()
+        self.names.add("bob", "bob@test.com")
+        self.assertTrue(self.names.might_be_taken('username', "bob"))
+
+        self.names.replace(("bob", "bob@test.com"), ("robert", "bob@test.com"))
+        self.assertFalse(self.names.might_be_taken('username', "bob"))
+        self.assertTrue(self.names.might_be_taken('username', "robert"))
+        self.assertTrue(self.names.might_be_taken('email', "bob@test.com"))
+
+        self.names.remove("robert", "bob@test.com")
+        self.assertFalse(self.names.might_be_taken('email', "bob@test.com"))
+
+    def test_remove_only_added(self):
+        """Are names this process didn't add left in the filter"""
+
+        self.names.load()
+        counters = self.names.filter.counters.copy()
+
+        self.names.remove("alice", "alice@test.com")
+        self.names.remove("stranger", "stranger@test.com")
+
+        self.assertTrue(self.names.might_be_taken('username', "alice"))
+        self.assertEqual(self.names.filter.counters.tolist(), counters.tolist())
+
+    def test_rebuilt_when_old(self):
+        """Is the filter rebuilt once it is REBUILD_EVERY old"""
+
+        self.names.load()
+        User.signup("dave", "dave@test.com", "password", None)
+        db.session.commit()
+
+        self.assertFalse(self.names.might_be_taken('username', "dave"))
+        self.names.loaded_at -= REBUILD_EVERY + 1
+        self.assertTrue(self.names.might_be_taken('username', "dave"))
+
+
+class SignupAvailabilityTestCase(TestCase):
+    """Test the signup route and the availability endpoint."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+
+        User.signup("alice", "alice@test.com", "password", None)
+        db.session.commit()
+
+        warbler.taken_names.load()
+        self.client = app.test_client()
+        app.config['RATELIMIT_ENABLED'] = False
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = True
+
+    def test_taken_before_hashing(self):
+        """Is a taken username rejected without hashing the password"""
+
+        hashed = []
+        generate = bcrypt.generate_password_hash
+
+        def record(password, *args):
+            hashed.append(password)
+            return generate(password, *args)
+
+        bcrypt.generate_password_hash = record
+        try:
+            resp = self.client.post('/signup', data={'username': "alice",
+                                                     'email': "new@test.com",
+                                                     'password': "secret123"})
+            self.assertIn("Username already taken", resp.get_data(as_text=True))
+            self.assertEqual(hashed, [])
+
+            resp = self.client.post('/signup', data={'username': "carol",
+                                                     'email': "carol@test.com",
+                                                     'password': "secret123"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(hashed, ["secret123"])
+        finally:
+            bcrypt.generate_password_hash = generate
+
+        self.assertTrue(warbler.taken_names.might_be_taken('username', "carol"))
+
+    def test_username_available(self):
+        """Does the endpoint report taken and free usernames"""
+
+        self.assertEqual(self.client.get('/api/username-available?username=alice').json,
+                         {'username': "alice", 'available': False})
+        self.assertEqual(self.client.get('/api/username-available?username=bob').json,
+                         {'username': "bob", 'available': True})
+        self.assertFalse(self.client.get('/api/username-available').json['available'])
+
+        # signed up through another worker: not in this one's filter yet
+        User.signup("erin", "erin@test.com", "password", None)
+        db.session.commit()
+        self.assertFalse(self.client.get('/api/username-available?username=erin')
+                         .json['available'])
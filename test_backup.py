@@ -0,0 +1,89 @@
+"""Export and import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_backup.py
+
+
+import io
+import json
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from backup import export_ndjson, import_ndjson
+
+db.create_all()
+
+
+class BackupTestCase(TestCase):
+    """Test streaming exports and bulk imports."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        user = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        other = User(email="other@test.com", username="other", password="HASHED_PASSWORD")
+        db.session.add_all([user, other])
+        db.session.commit()
+
+        messages = [Message(text=f"msg {i}", user_id=user.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.add(Follows(user_being_followed_id=other.id, user_following_id=user.id))
+        db.session.commit()
+
+        db.session.add(Like(user_id=other.id, message_id=messages[0].id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.client = app.test_client()
+
+    def test_user_export(self):
+        """Does a user's export stream their rows without the password"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}/export")
+            records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+            self.assertEqual([r['table'] for r in records],
+                             ['users', 'messages', 'messages', 'messages', 'follows'])
+            self.assertNotIn('password', records[0]['row'])
+
+            resp = c.get(f"/users/{self.user_id}/export?format=csv&table=messages")
+            lines = resp.get_data(as_text=True).splitlines()
+
+            self.assertEqual(resp.mimetype, "text/csv")
+            self.assertEqual(lines[0], "id,text,timestamp,user_id,like_count")
+            self.assertEqual(len(lines), 4)
+
+    def test_round_trip(self):
+        """Does an NDJSON export import back into an empty database"""
+
+        dump = io.StringIO()
+        export_ndjson(dump)
+
+        User.query.delete()
+        db.session.commit()
+        self.assertEqual(Message.query.count(), 0)
+
+        dump.seek(0)
+        self.assertEqual(import_ndjson(dump, batch_size=2), 7)
+
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(User.query.get(self.user_id).password, "HASHED_PASSWORD")
+
+        # sequences moved past the imported ids
+        db.session.add(User(email="new@test.com", username="new", password="HASHED_PASSWORD"))
+        db.session.commit()
@@ -0,0 +1,120 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+from unittest import TestCase, skipIf
+
+from jinja2 import Environment
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import compression
+from compression import WhitespaceStripper, choose_encoding
+
+db.create_all()
+
+
+class ChooseEncodingTestCase(TestCase):
+    """Test Accept-Encoding negotiation."""
+
+    def test_choose(self):
+        """Is brotli preferred, and refused or missing codings skipped"""
+
+        self.assertEqual(choose_encoding(""), None)
+        self.assertEqual(choose_encoding("gzip, deflate"), 'gzip')
+        self.assertEqual(choose_encoding("gzip;q=0, identity"), None)
+        self.assertEqual(choose_encoding("*"), 'br' if compression.brotli else 'gzip')
+
+        brotli, compression.brotli = compression.brotli, None
+        try:
+            self.assertEqual(choose_encoding("br, gzip;q=0.5"), 'gzip')
+        finally:
+            compression.brotli = brotli
+
+    @skipIf(compression.brotli is None, "needs brotli")
+    def test_brotli(self):
+        """Is brotli picked when it is accepted"""
+
+        self.assertEqual(choose_encoding("gzip, deflate, br"), 'br')
+        self.assertEqual(choose_encoding("br;q=0.5, gzip"), 'gzip')
+
+
+class CompressionTestCase(TestCase):
+    """Test compressing responses from the app."""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+
+        for i in range(30):
+            User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['COMPRESS_MIN_SIZE'] = compression.MIN_SIZE
+
+    def get(self, path, encoding="gzip"):
+        return self.client.get(path, headers={'Accept-Encoding': encoding})
+
+    def test_streamed_page(self):
+        """Is a streamed listing gzipped and still the same page"""
+
+        plain = self.client.get('/users')
+        resp = self.get('/users')
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gzip.decompress(resp.get_data()), plain.get_data())
+        self.assertLess(len(resp.get_data()), len(plain.get_data()) / 3)
+
+    @skipIf(compression.brotli is None, "needs brotli")
+    def test_brotli_page(self):
+        """Is a page brotli-compressed when the client accepts it"""
+
+        resp = self.get('/signup', encoding="gzip, br")
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertIn(b"<form", compression.brotli.decompress(resp.get_data()))
+
+    def test_threshold(self):
+        """Are responses under the size threshold sent as they are"""
+
+        app.config['COMPRESS_MIN_SIZE'] = 1024 * 1024
+        resp = self.get('/signup')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertIn(b"<form", resp.get_data())
+
+    def test_skipped(self):
+        """Are other content types, redirects and plain clients left alone"""
+
+        self.assertNotIn('Content-Encoding', self.client.get('/signup').headers)
+        self.assertNotIn('Content-Encoding', self.get('/logout').headers)
+        self.assertNotIn('Content-Encoding', self.get('/static/stylesheets/style.css').headers)
+
+
+class WhitespaceStripperTestCase(TestCase):
+    """Test stripping whitespace from template source."""
+
+    def test_strip(self):
+        """Are indentation and blank lines dropped, and newlines kept"""
+
+        env = Environment(extensions=[WhitespaceStripper],
+                          trim_blocks=True, lstrip_blocks=True)
+        template = env.from_string("<ul>\n\n    {% for i in items %}\n"
+                                   "    <li>{{ i }}</li>\n    {% endfor %}\n</ul>\n")
+
+        self.assertEqual(template.render(items=[1, 2]), "<ul>\n<li>1</li>\n<li>2</li>\n</ul>")
@@ -0,0 +1,125 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, session_store, CURR_USER_KEY
+from deletion import purge_deleted_users, purge_user
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['PURGE_DELETED_USERS_IN_BACKGROUND'] = False
+
+
+class DeletionTestCase(TestCase):
+    """Test marking accounts deleted and purging them in batches."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        doomed = User.signup("doomed", "doomed@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        messages = [Message(text=f"msg {i}", user_id=doomed.id) for i in range(5)]
+        kept = Message(text="kept", user_id=other.id, like_count=1)
+        db.session.add_all(messages + [kept])
+        db.session.add_all([
+            Follows(user_being_followed_id=doomed.id, user_following_id=other.id),
+            Follows(user_being_followed_id=other.id, user_following_id=doomed.id),
+        ])
+        db.session.commit()
+
+        db.session.add_all([Like(user_id=other.id, message_id=messages[0].id),
+                            Like(user_id=doomed.id, message_id=kept.id)])
+        db.session.commit()
+
+        self.doomed_id = doomed.id
+        self.other_id = other.id
+        self.client = app.test_client()
+
+    def test_delete_and_purge(self):
+        """Is a deleted account hidden at once and purged in batches later"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.doomed_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(c.get(f"/users/{self.doomed_id}").status_code, 404)
+            self.assertFalse(User.authenticate("doomed", "password"))
+            self.assertEqual(Message.query.count(), 6)
+
+        self.assertEqual(purge_deleted_users(batch_size=2), 1)
+
+        self.assertIsNone(User.query.get(self.doomed_id))
+        self.assertEqual([(m.text, m.like_count) for m in Message.query.all()], [("kept", 0)])
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertTrue(User.authenticate("other", "password"))
+
+    def test_overlapping_purges(self):
+        """Does a second purge wait for the running one instead of racing it"""
+
+        User.query.get(self.doomed_id).mark_deleted()
+        db.session.commit()
+
+        second = []
+
+        def run_second():
+            with app.app_context():
+                second.append(purge_deleted_users())
+
+        def start_second(username, email):
+            thread = threading.Thread(target=run_second)
+            thread.start()
+            thread.join(0.5)
+            second.append(thread.is_alive())
+            self.thread = thread
+
+        self.assertEqual(purge_deleted_users(on_purge=start_second), 1)
+        self.thread.join()
+
+        self.assertEqual(second, [True, 0])
+        self.assertEqual([m.like_count for m in Message.query.all()], [0])
+
+    def test_on_purge_once(self):
+        """Does only the purge that deletes the user row report it"""
+
+        User.query.get(self.doomed_id).mark_deleted()
+        db.session.commit()
+
+        self.assertTrue(purge_user(self.doomed_id))
+        self.assertFalse(purge_user(self.doomed_id))
+
+    def test_neighbours_told_by_purge(self):
+        """Are followers and followees reported by the purge, not the request"""
+
+        version = session_store.user_version(self.other_id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.doomed_id
+            c.post("/users/delete")
+
+        self.assertEqual(session_store.user_version(self.other_id), version)
+
+        unfollowed = []
+        purge_deleted_users(on_unfollow=unfollowed.extend)
+        self.assertEqual(unfollowed, [self.other_id, self.other_id])
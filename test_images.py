@@ -0,0 +1,173 @@
+"""Image thumbnail tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import images
+from images import ThumbnailCache, ImageSourceError, make_thumbnail, thumb_url
+
+db.create_all()
+
+
+class ImageThumbnailTestCase(TestCase):
+    """Test resizing, caching and eviction with local files only."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+        app.config['IMAGE_FETCH_REMOTE'] = False
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def url(self, src, size):
+        with app.app_context():
+            return thumb_url(src, size)
+
+    def test_thumb_url(self):
+        """Does the template filter point at the image endpoint, signed"""
+
+        self.assertRegex(self.url("/static/images/default-pic.png", "card"),
+                         r"^/images/card\?src=%2Fstatic%2Fimages%2Fdefault-pic.png&sig=\w{32}$")
+        self.assertIsNone(self.url(None, "card"))
+
+    def test_image_endpoint(self):
+        """Are thumbnails resized and served from the cache"""
+
+        url = self.url("/static/images/warbler-hero.jpg", "hero")
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (1280, 360))
+        self.assertIn("max-age", resp.headers["Cache-Control"])
+
+        cached = [f for _, _, files in os.walk(self.cache_dir) for f in files]
+        self.assertEqual(len(cached), 1)
+
+        self.assertEqual(self.client.get(url).data, resp.data)
+
+    def test_internal_addresses_refused(self):
+        """Are remote sources on loopback, private or link-local addresses refused"""
+
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            cache = ThumbnailCache(self.cache_dir, 10 ** 9, app.static_folder, allow_remote=True)
+            with self.assertRaises(ImageSourceError):
+                cache.read_source(f"http://127.0.0.1:{server.server_port}/a.png")
+            with self.assertRaises(ImageSourceError):
+                cache.read_source(f"http://localhost:{server.server_port}/a.png")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(requests, [])
+        for address in ["10.0.0.1", "169.254.169.254", "::1", "::ffff:192.168.0.1"]:
+            self.assertFalse(images.is_public_address(address), address)
+        self.assertTrue(images.is_public_address("93.184.216.34"))
+
+    def test_bad_sources(self):
+        """Are unknown sizes, remote URLs and paths outside /static refused"""
+
+        for src in ["http://example.com/a.png",
+                    "/static/../app.py",
+                    "/static/stylesheets/style.css"]:
+            url = self.url(src, "card")
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+        url = self.url("/static/images/default-pic.png", "card")
+        self.assertEqual(self.client.get(url.replace("card", "huge", 1)).status_code, 404)
+
+    def test_unsigned(self):
+        """Are URLs without a valid signature refused"""
+
+        app.config['IMAGE_FETCH_REMOTE'] = True
+        url = self.url("/static/images/default-pic.png", "card")
+
+        for bad in [url.split("&sig=")[0],
+                    url[:-4] + "0000",
+                    url.replace("card", "timeline", 1),
+                    "/images/card?src=http://169.254.169.254/latest/meta-data/&sig=x"]:
+            self.assertEqual(self.client.get(bad).status_code, 404, bad)
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_decompression_bomb(self):
+        """Are images with too many pixels refused, by us or by PIL"""
+
+        out = io.BytesIO()
+        Image.new('1', (14000, 14000)).save(out, 'PNG')
+
+        with self.assertRaises(ImageSourceError):
+            make_thumbnail(out.getvalue(), (96, 96))
+
+        pixels, images.MAX_SOURCE_PIXELS = images.MAX_SOURCE_PIXELS, 10 ** 9
+        try:
+            with self.assertRaises(ImageSourceError):
+                make_thumbnail(out.getvalue(), (96, 96))
+        finally:
+            images.MAX_SOURCE_PIXELS = pixels
+
+    def test_eviction(self):
+        """Does the cache drop least recently used files past its budget"""
+
+        cache = ThumbnailCache(self.cache_dir, 10 ** 9, app.static_folder, allow_remote=False)
+        first = cache.get("card", "/static/images/default-pic.png")
+        second = cache.get("card", "/static/images/warbler-hero.jpg")
+        os.utime(first, (0, 0))
+
+        cache.max_bytes = os.path.getsize(second)
+        cache.evict()
+
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+        with self.assertRaises(ImageSourceError):
+            cache.get("card", "/etc/passwd")
+
+    def test_running_total(self):
+        """Is the cache size counted once, then kept up without scanning"""
+
+        cache = ThumbnailCache(self.cache_dir, 10 ** 9, app.static_folder, allow_remote=False)
+        first = cache.get("card", "/static/images/default-pic.png")
+        self.assertEqual(cache.total, os.path.getsize(first))
+
+        cache.entries = None
+        second = cache.get("profile", "/static/images/default-pic.png")
+        self.assertEqual(cache.total, os.path.getsize(first) + os.path.getsize(second))
+        del cache.entries
+
+        cache.max_bytes = cache.total - 1
+        cache.get("timeline", "/static/images/default-pic.png")
+        self.assertLessEqual(cache.total, cache.max_bytes * images.EVICT_TO)
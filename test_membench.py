@@ -0,0 +1,77 @@
+"""Memory benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_membench.py
+
+
+import os
+import tracemalloc
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from membench import Route, OTHER, category, measure, over_budget
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
+
+
+class MembenchTestCase(TestCase):
+    """Test measuring and attributing a request's allocations."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+
+        user = User.signup("membench", "membench@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(text="hello", user_id=user.id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.message_id = Message.query.first().id
+
+    def test_category(self):
+        """Is an allocation attributed to its innermost known frame"""
+
+        def traceback(*filenames):
+            return tracemalloc.Traceback(tuple((filename, 1) for filename in reversed(filenames)))
+
+        self.assertEqual(category(traceback('/app.py', '/site-packages/jinja2/runtime.py',
+                                            '/site-packages/sqlalchemy/orm/loading.py')),
+                         'orm')
+        self.assertEqual(category(traceback('/app.py', '/package/templates/base.html')),
+                         'template')
+        self.assertEqual(category(traceback('/app.py', '/site-packages/wtforms/form.py')),
+                         'form')
+        self.assertEqual(category(traceback('/app.py')), OTHER)
+
+    def test_measure(self):
+        """Are a request's peak and its breakdown measured"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        peak, at_peak, kept, retained = measure(client, Route('messages_show', 'GET',
+                                                              '/messages/{message}'),
+                                                self.user_id, self.message_id)
+
+        self.assertGreater(peak, 0)
+        self.assertGreater(sum(at_peak.values()), 0)
+        self.assertLess(kept, peak)
+        self.assertEqual(set(retained), {'orm', 'template', 'form', OTHER})
+
+    def test_over_budget(self):
+        """Are only routes with a budget, and over it, reported"""
+
+        self.assertEqual(over_budget({'a': 10.0, 'b': 30.0, 'c': 99.0}, {'a': 20, 'b': 20}),
+                         [('b', 30.0, 20)])
+
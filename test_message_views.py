@@ -30,6 +30,7 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
 
 
 class MessageViewTestCase(TestCase):
@@ -105,14 +106,34 @@ class MessageViewTestCase(TestCase):
 
             self.assertIn("far fa-heart", html)
 
+    def test_like_counts_and_likers(self):
+        """Are like counts kept up to date and likers listed"""
 
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        author_id = author.id
+        user_id = User.query.filter_by(username="testuser").one().id
 
-    
+        msg = Message(text="Popular", user_id=author_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
 
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
 
+            c.post(f"/messages/{msg_id}/like", headers={"Referer": "/"})
+            self.assertEqual(Message.query.get(msg_id).like_count, 1)
 
-        
+            html = c.get(f"/messages/{msg_id}").get_data(as_text=True)
+            self.assertIn("1 like", html)
 
+            html = c.get(f"/messages/{msg_id}/likes").get_data(as_text=True)
+            self.assertIn("@testuser", html)
 
+            c.post(f"/messages/{msg_id}/unlike", headers={"Referer": "/"})
+            self.assertEqual(Message.query.get(msg_id).like_count, 0)
 
-    
+            html = c.get(f"/messages/{msg_id}/likes").get_data(as_text=True)
+            self.assertIn("No likes yet", html)
@@ -0,0 +1,118 @@
+"""Notification inbox tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like, Notification, NotificationEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from notifications import coalesce_notifications
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
+
+
+class NotificationsTestCase(TestCase):
+    """Test recording, coalescing and reading notifications."""
+
+    def setUp(self):
+        db.session.rollback()
+        NotificationEvent.query.delete()
+        Notification.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        users = [User.signup(name, f"{name}@test.com", "password", None)
+                 for name in ("author", "fan1", "fan2", "fan3", "fan4")]
+        db.session.commit()
+        self.author_id, *self.fan_ids = [u.id for u in users]
+
+        msg = Message(text="hello", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        self.client = app.test_client()
+
+    def as_user(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def like(self, user_id):
+        self.as_user(user_id)
+        self.client.post(f"/messages/{self.msg_id}/like", headers={'Referer': '/'})
+
+    def test_likes_are_coalesced(self):
+        """Do many likes of one message become one notification"""
+
+        for fan_id in self.fan_ids:
+            self.like(fan_id)
+        self.like(self.author_id)
+
+        self.assertEqual(NotificationEvent.query.count(), 4)
+        self.assertEqual(coalesce_notifications(batch_size=3), {self.author_id})
+        self.assertEqual(NotificationEvent.query.count(), 0)
+
+        notification = Notification.query.one()
+        self.assertEqual(notification.kind, 'like')
+        self.assertEqual(notification.actor_count, 4)
+        self.assertEqual(notification.actor_ids, self.fan_ids[:0:-1])
+
+    def test_relike_counted_once(self):
+        """Is a fan who unlikes and likes again counted once"""
+
+        self.like(self.fan_ids[0])
+        coalesce_notifications()
+        for fan_id in self.fan_ids[1:]:
+            self.like(fan_id)
+        coalesce_notifications()
+
+        # fan1 has dropped out of the recent actors
+        self.as_user(self.fan_ids[0])
+        self.client.post(f"/messages/{self.msg_id}/unlike", headers={'Referer': '/'})
+        self.like(self.fan_ids[0])
+        coalesce_notifications()
+
+        notification = Notification.query.one()
+        self.assertEqual(notification.actor_count, 4)
+        self.assertEqual(notification.actor_ids[0], self.fan_ids[0])
+
+    def test_follow_and_mention(self):
+        """Are follows and @-mentions delivered"""
+
+        self.as_user(self.fan_ids[0])
+        self.client.post(f"/users/follow/{self.author_id}")
+        self.client.post("/messages/new", data={'text': "hi @author and @nobody"})
+
+        coalesce_notifications()
+
+        kinds = sorted(n.kind for n in Notification.query.filter_by(user_id=self.author_id))
+        self.assertEqual(kinds, ['follow', 'mention'])
+
+    def test_badge_and_inbox(self):
+        """Is the unread badge shown until the inbox is opened"""
+
+        self.like(self.fan_ids[0])
+        self.like(self.fan_ids[1])
+        coalesce_notifications()
+
+        self.as_user(self.author_id)
+        html = self.client.get("/messages/new").get_data(as_text=True)
+        self.assertIn('badge-primary">1</span>', html)
+
+        html = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan2", html)
+        self.assertIn("liked your", html)
+
+        html = self.client.get("/messages/new").get_data(as_text=True)
+        self.assertNotIn('badge-primary', html)
@@ -0,0 +1,119 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as warbler
+from app import app
+from ratelimit import Limit, MemoryStore, RateLimiter, SQLiteStore
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
+
+
+class RateLimiterTestCase(TestCase):
+    """Test token buckets and the request hook."""
+
+    def test_token_bucket(self):
+        """Do buckets empty, report a wait, and refill over time"""
+
+        limiter = RateLimiter(MemoryStore(), {'login': [Limit('ip', 2, 10)]})
+        keys = {'ip': '1.2.3.4'}
+
+        self.assertEqual(limiter.check('login', keys, now=0), 0)
+        self.assertEqual(limiter.check('login', keys, now=0), 0)
+        self.assertAlmostEqual(limiter.check('login', keys, now=0), 5)
+        self.assertEqual(limiter.check('login', {'ip': '5.6.7.8'}, now=0), 0)
+        self.assertEqual(limiter.check('login', keys, now=5), 0)
+        self.assertEqual(limiter.check('signup', keys, now=5), 0)
+
+    def test_full_buckets_pruned(self):
+        """Are buckets dropped once they have had time to refill"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for store in (MemoryStore(), SQLiteStore(os.path.join(tmp, "buckets.sqlite3"))):
+                limiter = RateLimiter(store, {'login': [Limit('ip', 2, 10)],
+                                              'signup': [Limit('ip', 1, 100)]})
+                limiter.pruned_at = 0
+
+                limiter.check('login', {'ip': '1.2.3.4'}, now=0)
+                limiter.check('signup', {'ip': '1.2.3.4'}, now=50)
+                limiter.check('login', {'ip': '5.6.7.8'}, now=59)
+
+                self.assertEqual(store.prune(0), 0)
+                limiter.check('login', {'ip': '5.6.7.8'}, now=120)
+                # the check dropped 1.2.3.4's login bucket; only signup's is older
+                self.assertEqual(store.prune(120), 1)
+
+    def test_sqlite_store_is_shared(self):
+        """Do two stores on one file (like two workers) share buckets"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "buckets.sqlite3")
+            limits = {'like_message': [Limit('user', 1, 60)]}
+            worker1 = RateLimiter(SQLiteStore(path), limits)
+            worker2 = RateLimiter(SQLiteStore(path), limits)
+
+            self.assertEqual(worker1.check('like_message', {'user': 1}, now=0), 0)
+            self.assertGreater(worker2.check('like_message', {'user': 1}, now=1), 0)
+
+    def test_sqlite_store_locked(self):
+        """Does a check fail open while another process holds the file locked"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "buckets.sqlite3")
+            store = SQLiteStore(path)
+            limiter = RateLimiter(store, {'like_message': [Limit('user', 1, 60)]})
+
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            with self.assertLogs('ratelimit', 'WARNING'):
+                self.assertEqual(limiter.check('like_message', {'user': 1}, now=0), 0)
+            other.execute("ROLLBACK")
+            other.close()
+
+            # nothing was left open, so the bucket still works
+            self.assertFalse(store.connect().in_transaction)
+            self.assertEqual(limiter.check('like_message', {'user': 1}, now=1), 0)
+            self.assertGreater(limiter.check('like_message', {'user': 1}, now=2), 0)
+
+    def test_rejected_before_db(self):
+        """Are limited POSTs turned away with a 429 and no queries"""
+
+        old_limiter = warbler.rate_limiter
+        warbler.rate_limiter = RateLimiter(MemoryStore(), {'login': [Limit('username', 1, 60)]})
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        try:
+            client = app.test_client()
+            client.post('/login', data={'username': 'nobody', 'password': 'password'})
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            resp = client.post('/login', data={'username': 'nobody', 'password': 'password'})
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn('Retry-After', resp.headers)
+            self.assertEqual(statements, [])
+
+            self.assertEqual(client.get('/login').status_code, 200)
+        finally:
+            warbler.rate_limiter = old_limiter
@@ -0,0 +1,60 @@
+"""Projection row tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from readmodels import MessageRow, UserCard, message_query, message_rows, user_cards
+
+db.create_all()
+
+
+class ReadModelsTestCase(TestCase):
+    """Test building rows from column queries."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add_all([Message(text=f"msg {i}", user_id=self.alice.id) for i in range(3)])
+        db.session.commit()
+
+    def test_message_rows(self):
+        """Are messages read into immutable rows sharing one author"""
+
+        rows = message_rows(db.session.execute(message_query().order_by(Message.id)))
+
+        self.assertEqual([row.text for row in rows], ["msg 0", "msg 1", "msg 2"])
+        self.assertIsInstance(rows[0], MessageRow)
+        self.assertIs(rows[0].user, rows[2].user)
+        self.assertEqual(rows[0].user.username, "alice")
+        self.assertFalse(rows[0].archived)
+
+        with self.assertRaises(AttributeError):
+            rows[0].text = "changed"
+
+    def test_user_cards(self):
+        """Are deleted users left out and searches applied"""
+
+        self.bob.mark_deleted()
+        db.session.commit()
+
+        cards = list(user_cards())
+        self.assertEqual([card.username for card in cards], ["alice"])
+        self.assertIsInstance(cards[0], UserCard)
+        self.assertEqual(list(user_cards("zzz")), [])
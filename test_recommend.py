@@ -0,0 +1,110 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommend.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, FollowSuggestion
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from recommend import FollowGraph, recommend_follows
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test scoring on a small in-memory graph."""
+
+    def setUp(self):
+        """0 follows 1 and 2; both follow 3; 2 also follows 4; 3 follows 5."""
+
+        edges = [(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (3, 5)]
+        sources, targets = zip(*edges)
+        self.graph = FollowGraph([10, 11, 12, 13, 14, 15], sources, targets)
+
+    def test_csr_layout(self):
+        """Are adjacency rows sliced out of the CSR arrays"""
+
+        self.assertEqual(self.graph.following(0).tolist(), [1, 2])
+        self.assertEqual(self.graph.following(2).tolist(), [3, 4])
+        self.assertEqual(self.graph.following(5).tolist(), [])
+        self.assertEqual(self.graph.in_degree.tolist(), [0, 1, 1, 2, 1, 1])
+
+    def test_friends_of_friends(self):
+        """Are friends-of-friends ranked by shared followees"""
+
+        self.assertEqual(self.graph.suggest(0, k=2), [(3, 2.0), (4, 1.0)])
+
+    def test_friends_of_friends_scores(self):
+        """Are only the nodes reached scored"""
+
+        nodes, scores = self.graph.friends_of_friends(0)
+        self.assertEqual(nodes.tolist(), [3, 4])
+        self.assertEqual(scores.tolist(), [2.0, 1.0])
+
+    def test_personalized_pagerank(self):
+        """Does PageRank reach past friends-of-friends"""
+
+        suggested = [node for node, _ in self.graph.suggest(0, k=3, method="ppr")]
+        self.assertEqual(suggested, [3, 5, 4])
+
+    def test_popular_fallback(self):
+        """Are users with no candidates given popular accounts"""
+
+        suggested = [node for node, _ in self.graph.suggest(5, k=2)]
+        self.assertEqual(suggested, [3, 1])
+
+
+class RecommendFollowsTestCase(TestCase):
+    """Test the batch job against the database."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}", password="HASHED_PASSWORD")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_following_id=users[0].id, user_being_followed_id=users[1].id),
+            Follows(user_following_id=users[1].id, user_being_followed_id=users[2].id),
+        ])
+        db.session.commit()
+
+        self.ids = [user.id for user in users]
+
+    def test_recommend_follows(self):
+        """Are top suggestions stored and read back in rank order"""
+
+        recommend_follows(k=2)
+
+        user = User.query.get(self.ids[0])
+        suggestions = user.get_follow_suggestions()
+
+        self.assertEqual([s.suggested_user.id for s in suggestions], [self.ids[2]])
+
+        # testuser2 follows nobody, so gets the most-followed account
+        fallback = FollowSuggestion.query.filter_by(user_id=self.ids[2]).all()
+        self.assertEqual([s.suggested_user_id for s in fallback], [self.ids[1]])
+
+    def test_deleted_users_not_suggested(self):
+        """Are deleted accounts left out of suggestions"""
+
+        User.query.get(self.ids[2]).mark_deleted()
+        db.session.commit()
+
+        recommend_follows(k=2)
+
+        suggested = [s.suggested_user_id for s in FollowSuggestion.query.all()]
+        self.assertNotIn(self.ids[2], suggested)
+        self.assertEqual(FollowSuggestion.query.filter_by(user_id=self.ids[2]).count(), 0)
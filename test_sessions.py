@@ -0,0 +1,115 @@
+"""Server-side session and user snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, session_store, CURR_USER_KEY, USER_SNAPSHOT_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SessionTestCase(TestCase):
+    """Test server-side sessions and cached user hydration."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.client = app.test_client()
+
+    def count_queries(self, path):
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(self.client.get(path).status_code, 200)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return len(statements)
+
+    def test_cookie_holds_only_session_id(self):
+        """Is session data kept in the store rather than the cookie"""
+
+        self.client.post('/login', data={'username': 'testuser', 'password': 'password'})
+        sid = next(c.value for c in self.client.cookie_jar if c.name == 'session')
+
+        self.assertIn(str(self.user_id), session_store.load(sid, 0) or "")
+        self.assertNotIn("testuser", sid)
+
+    def test_snapshot_avoids_user_queries(self):
+        """Does a cached snapshot hydrate g.user without the database"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertGreater(self.count_queries('/messages/new'), 0)
+        self.assertEqual(self.count_queries('/messages/new'), 0)
+
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess[USER_SNAPSHOT_KEY]['username'], 'testuser')
+
+    def test_profile_edit_invalidates_snapshot(self):
+        """Is the snapshot rebuilt after the profile changes"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get('/messages/new')
+        self.client.post('/users/profile', data={
+            'username': 'renamed',
+            'email': 'test@test.com',
+            'password': 'password',
+        })
+
+        html = self.client.get('/messages/new').get_data(as_text=True)
+        self.assertIn('alt="renamed"', html)
+
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess[USER_SNAPSHOT_KEY]['username'], 'renamed')
+
+    def test_likes_read_per_page(self):
+        """Does the snapshot keep only a like count, with likes read for the page"""
+
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        liked = Message(text="liked warble", user_id=author.id)
+        other = Message(text="other warble", user_id=author.id)
+        db.session.add_all([liked, other])
+        db.session.commit()
+        db.session.add(Like(user_id=self.user_id, message_id=liked.id))
+        db.session.commit()
+        author_id, liked_id, other_id = author.id, liked.id, other.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = self.client.get(f"/users/{author_id}").get_data(as_text=True)
+        self.assertIn(f'action="/messages/{liked_id}/unlike"', html)
+        self.assertIn(f'action="/messages/{other_id}/like"', html)
+
+        with self.client.session_transaction() as sess:
+            self.assertNotIn('liked_ids', sess[USER_SNAPSHOT_KEY])
+            self.assertEqual(sess[USER_SNAPSHOT_KEY]['counts']['likes'], 1)
@@ -0,0 +1,328 @@
+"""Message and like sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+#
+# they need two extra databases:
+#
+#    createdb warbler-test-shard0
+#    createdb warbler-test-shard1
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import SkipTest, TestCase
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from models import (db, User, Message, Like, Follows, MessageLikeBucket, Notification,
+                    NotificationEvent)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from backup import dataset_rows, user_rows
+from deletion import purge_deleted_users
+from notifications import LIKE, coalesce_notifications, inbox_page, notify
+from shards import SHARD_LIKES, ShardSet, shard_metadata
+from trending import clear_cache, record_like, trending_messages
+
+db.create_all()
+
+SHARD_URLS = ["postgresql:///warbler-test-shard0", "postgresql:///warbler-test-shard1"]
+
+
+class ShardsTestCase(TestCase):
+    """Test routing, scatter-gather reads and cross-shard writes."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shards = ShardSet(SHARD_URLS)
+
+        try:
+            for engine in cls.shards.engines:
+                shard_metadata().drop_all(engine)
+        except OperationalError:
+            raise SkipTest("needs databases " + ", ".join(SHARD_URLS))
+
+        cls.shards.create_tables()
+        cls.shards.interleave_ids()
+
+    @classmethod
+    def tearDownClass(cls):
+        for engine in cls.shards.engines:
+            engine.dispose()
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Notification.query.delete()
+        NotificationEvent.query.delete()
+        MessageLikeBucket.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for session in self.shards.sessions:
+            session.execute(Like.__table__.delete())
+            session.execute(Message.__table__.delete())
+            session.commit()
+
+        # consecutive ids, so two users land on each shard
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                 for i in range(4)]
+        db.session.commit()
+        self.users = sorted(user.id for user in users)
+
+        self.now = datetime(2021, 6, 1)
+
+    def tearDown(self):
+        self.shards.rollback()
+        self.shards.remove()
+
+    def post(self, user_id, minutes_ago):
+        msg = self.shards.add_message(user_id, f"{user_id} at -{minutes_ago}")
+        msg.timestamp = self.now - timedelta(minutes=minutes_ago)
+        self.shards.commit()
+        return msg.id
+
+    def rows(self, shard, model):
+        return self.shards.sessions[shard].query(model).all()
+
+    def test_routing(self):
+        """Do messages go to their author's shard, with ids naming it"""
+
+        for user_id in self.users:
+            message_id = self.post(user_id, 0)
+            shard = self.shards.shard_for(user_id)
+
+            self.assertEqual([msg.id for msg in self.rows(shard, Message)
+                              if msg.user_id == user_id], [message_id])
+            self.assertEqual(self.shards.shards_for_message(message_id)[0], shard)
+            self.assertEqual(self.shards.get_message(message_id).user.id, user_id)
+
+        self.assertIsNone(self.shards.get_message(1))
+
+    def test_timeline(self):
+        """Are messages from several shards merged newest first"""
+
+        for minutes_ago, user_id in enumerate(self.users * 3):
+            self.post(user_id, minutes_ago)
+
+        messages = self.shards.timeline(self.users, 5)
+
+        self.assertEqual([msg.timestamp for msg in messages],
+                         [self.now - timedelta(minutes=m) for m in range(5)])
+        self.assertEqual(len({self.shards.shard_for(msg.user_id) for msg in messages}), 2)
+
+        older = self.shards.timeline(self.users, 20,
+                                     before=(messages[-1].timestamp, messages[-1].id))
+
+        self.assertEqual(len(older), 7)
+        self.assertLess(older[0].timestamp, messages[-1].timestamp)
+
+    def test_like_and_unlike(self):
+        """Do likes live on the liker's shard and count on the message's"""
+
+        author, liker = self.users[0], self.users[1]
+        self.assertNotEqual(self.shards.shard_for(author), self.shards.shard_for(liker))
+        message_id = self.post(author, 0)
+
+        self.assertEqual(self.shards.like(liker, message_id), author)
+        self.shards.commit()
+        self.assertIsNone(self.shards.like(liker, message_id))
+        self.assertIsNone(self.shards.like(liker, message_id + 1000))
+
+        self.assertEqual(len(self.rows(self.shards.shard_for(liker), Like)), 1)
+        self.assertEqual(self.shards.get_message(message_id).like_count, 1)
+        self.assertEqual(self.shards.liked_message_ids(liker), [message_id])
+        self.assertEqual(self.shards.count_likes(liker), 1)
+
+        self.assertIsNotNone(self.shards.unlike(liker, message_id))
+        self.shards.commit()
+
+        self.assertEqual(self.shards.get_message(message_id).like_count, 0)
+        self.assertEqual(self.shards.count_likes(liker), 0)
+
+    def test_liked_messages(self):
+        """Are liked messages from several shards paged in either order"""
+
+        liker = self.users[0]
+        posted = [self.post(user_id, minutes_ago)
+                  for minutes_ago, user_id in enumerate(self.users[1:] * 2)]
+
+        for message_id in posted:
+            self.shards.like(liker, message_id)
+            self.shards.commit()
+
+        by_post = self.shards.liked_messages(liker, page=1, per_page=4, order_by="posted")
+        self.assertEqual([msg.id for msg in by_post.items], posted[:4])
+        self.assertEqual(by_post.total, 6)
+        self.assertTrue(by_post.has_next)
+
+        last = self.shards.liked_messages(liker, page=2, per_page=4, order_by="posted")
+        self.assertEqual([msg.id for msg in last.items], posted[4:])
+
+        by_like = self.shards.liked_messages(liker, page=1, per_page=6)
+        self.assertEqual(sorted(msg.id for msg in by_like.items), sorted(posted))
+
+    def test_likers_and_delete(self):
+        """Are likers gathered from every shard, and likes deleted with the message"""
+
+        author = self.users[0]
+        message_id = self.post(author, 0)
+
+        for liker in self.users[1:]:
+            self.shards.like(liker, message_id)
+            self.shards.commit()
+
+        likers, next_before = self.shards.likers_page(message_id, per_page=2)
+        self.assertEqual(len(likers), 2)
+        rest, last = self.shards.likers_page(message_id, before=next_before, per_page=2)
+        self.assertEqual({user.id for user, _ in likers + rest}, set(self.users[1:]))
+        self.assertIsNone(last)
+
+        self.assertEqual(self.shards.delete_message(message_id), author)
+        self.shards.commit()
+
+        self.assertIsNone(self.shards.get_message(message_id))
+        self.assertEqual(self.rows(0, Like) + self.rows(1, Like), [])
+
+    def test_homepage(self):
+        """Does the homepage show followed users' messages from every shard"""
+
+        me, other = self.users[0], self.users[1]
+        db.session.add(Follows(user_following_id=me, user_being_followed_id=other))
+        db.session.commit()
+        app_module.social_graph.forget(me)
+
+        self.post(me, 1)
+        self.post(other, 0)
+
+        app_module.shards, shards = self.shards, app_module.shards
+        try:
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = client.get('/').get_data(as_text=True)
+        finally:
+            app_module.shards = shards
+
+        self.assertLess(html.index(f"{other} at -0"), html.index(f"{me} at -1"))
+
+    def test_profile_counts(self):
+        """Do the follow and like pages count messages and likes on the shards"""
+
+        me, other = self.users[0], self.users[1]
+        self.post(me, 0)
+        self.post(me, 1)
+        self.shards.like(me, self.post(other, 2))
+        self.shards.commit()
+
+        app_module.shards, shards = self.shards, app_module.shards
+        try:
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other
+
+            pages = [client.get(f"/users/{me}{page}").get_data(as_text=True)
+                     for page in ("/following", "/followers", "/likes")]
+        finally:
+            app_module.shards = shards
+
+        for html in pages:
+            self.assertIn(f'<a href="/users/{me}">2</a>', html)
+            self.assertIn(f'<a href="/users/{me}/likes">1</a>', html)
+        self.assertIn(f"{other} at -2", pages[2])
+
+    def test_move_from_main(self):
+        """Are messages and likes from before sharding moved onto their shards"""
+
+        author, liker = self.users[0], self.users[1]
+        msg = Message(text="before sharding", user_id=author, timestamp=self.now)
+        db.session.add(msg)
+        db.session.commit()
+        message_id = msg.id
+        db.session.add(Like(user_id=liker, message_id=message_id))
+        db.session.commit()
+
+        self.assertEqual(self.shards.move_from_main(batch_size=1), (1, 1))
+        self.assertEqual(self.shards.move_from_main(), (0, 0))
+
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(self.shards.get_message(message_id).text, "before sharding")
+        self.assertEqual(self.shards.liked_message_ids(liker), [message_id])
+
+        page = self.shards.liked_messages(liker, order_by="posted")
+        self.assertEqual([msg.id for msg in page.items], [message_id])
+
+        # likes from before the timestamp was kept get it filled in
+        session = self.shards.for_user(liker)
+        session.execute(SHARD_LIKES.update().values(message_timestamp=None))
+        session.commit()
+        self.assertEqual(self.shards.fill_like_timestamps(), 1)
+        self.assertEqual(session.execute(select(SHARD_LIKES.c.message_timestamp)).scalar(),
+                         self.now)
+
+    def test_purge(self):
+        """Are a purged user's messages, likes of them, and likes gone from the shards"""
+
+        doomed, other = self.users[0], self.users[1]
+        doomed_msg = self.post(doomed, 0)
+        other_msg = self.post(other, 1)
+
+        self.shards.like(other, doomed_msg)
+        self.shards.like(doomed, other_msg)
+        self.shards.commit()
+
+        User.query.get(doomed).mark_deleted()
+        db.session.commit()
+
+        self.assertEqual(purge_deleted_users(batch_size=1, shards=self.shards), 1)
+
+        self.assertIsNone(User.query.get(doomed))
+        self.assertIsNone(self.shards.get_message(doomed_msg))
+        self.assertEqual(self.rows(0, Like) + self.rows(1, Like), [])
+        self.assertEqual(self.shards.get_message(other_msg).like_count, 0)
+
+    def test_export(self):
+        """Does a user's export include their messages and likes from the shards"""
+
+        author, liker = self.users[0], self.users[1]
+        message_id = self.post(author, 0)
+        self.shards.like(liker, message_id)
+        self.shards.commit()
+
+        self.assertEqual([row['id'] for table, row in user_rows(author, shards=self.shards)
+                          if table == 'messages'], [message_id])
+        self.assertEqual([row['message_id'] for table, row in user_rows(liker, shards=self.shards)
+                          if table == 'likes'], [message_id])
+
+        tables = [table for table, _ in dataset_rows(self.shards)]
+        self.assertEqual((tables.count('messages'), tables.count('likes')), (1, 1))
+
+    def test_trending_and_inbox(self):
+        """Are trending messages and notification texts read from the shards"""
+
+        author, liker = self.users[0], self.users[1]
+        message_id = self.post(author, 0)
+        # the main test database keeps its foreign keys to messages
+        db.session.add(Message(id=message_id, text="main copy", user_id=author))
+        db.session.commit()
+
+        self.shards.like(liker, message_id)
+        record_like(message_id)
+        notify(author, LIKE, liker, message_id)
+        self.shards.commit()
+        coalesce_notifications()
+        clear_cache()
+
+        self.assertEqual([(msg.id, likes) for msg, likes in trending_messages(shards=self.shards)],
+                         [(message_id, 1)])
+
+        _, entries = inbox_page(author, shards=self.shards)
+        self.assertEqual([message.text for _, _, message in entries], [f"{author} at -0"])
@@ -0,0 +1,104 @@
+"""In-memory follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_socialgraph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from socialgraph import SocialGraph
+
+db.create_all()
+
+
+class SocialGraphTestCase(TestCase):
+    """Test loading, querying and updating graph nodes."""
+
+    def setUp(self):
+        """a follows b and c; b follows a; c is deleted."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        users = [User.signup(name, f"{name}@test.com", "password", None)
+                 for name in ("a", "b", "c", "d")]
+        db.session.commit()
+        self.a, self.b, self.c, self.d = [u.id for u in users]
+
+        db.session.add_all([
+            Follows(user_following_id=self.a, user_being_followed_id=self.b),
+            Follows(user_following_id=self.a, user_being_followed_id=self.c),
+            Follows(user_following_id=self.b, user_being_followed_id=self.a),
+        ])
+        users[2].mark_deleted()
+        db.session.commit()
+
+        self.versions = {}
+        self.graph = SocialGraph(lambda id: self.versions.get(id, 0))
+
+    def bump(self, *ids):
+        for id in ids:
+            self.versions[id] = self.versions.get(id, 0) + 1
+
+    def test_queries(self):
+        """Are follow queries answered from sorted arrays of active ids"""
+
+        self.assertEqual(self.graph.following(self.a).tolist(), [self.b])
+        self.assertEqual(self.graph.followers(self.a).tolist(), [self.b])
+        self.assertTrue(self.graph.is_following(self.a, self.b))
+        self.assertFalse(self.graph.is_following(self.b, self.d))
+        self.assertEqual(self.graph.mutual_ids(self.a).tolist(), [self.b])
+        self.assertEqual(self.graph.following_ids(self.a, among=[self.d]), set())
+
+    def test_warm_matches_load(self):
+        """Does warming build the same nodes as loading one at a time"""
+
+        self.assertEqual(self.graph.warm(), 3)
+
+        for id in (self.a, self.b, self.d):
+            node = self.graph.load(id)
+            self.assertEqual(self.graph.nodes[id].following.tolist(), node.following.tolist())
+            self.assertEqual(self.graph.nodes[id].followers.tolist(), node.followers.tolist())
+
+    def test_follow_patches_nodes(self):
+        """Are cached nodes updated in place after a follow"""
+
+        self.graph.warm()
+
+        db.session.add(Follows(user_following_id=self.d, user_being_followed_id=self.a))
+        db.session.commit()
+        self.bump(self.d, self.a)
+
+        Follows.query.delete()
+        db.session.commit()
+
+        self.graph.follow(self.d, self.a)
+
+        # answered from the patched nodes, not the (now empty) table
+        self.assertEqual(self.graph.following(self.d).tolist(), [self.a])
+        self.assertEqual(self.graph.followers(self.a).tolist(), [self.b, self.d])
+
+        self.bump(self.d, self.a)
+        self.graph.unfollow(self.d, self.a)
+        self.assertEqual(self.graph.following(self.d).tolist(), [])
+
+    def test_stale_nodes_reload(self):
+        """Is a node reloaded once its user's version moves on"""
+
+        self.assertTrue(self.graph.is_following(self.a, self.b))
+
+        Follows.query.filter_by(user_following_id=self.a).delete()
+        db.session.commit()
+        self.assertTrue(self.graph.is_following(self.a, self.b))
+
+        self.bump(self.a)
+        self.assertFalse(self.graph.is_following(self.a, self.b))
@@ -0,0 +1,251 @@
+"""Pre-rendered signed-out page tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_staticpages.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Like, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from staticpages import MESSAGE, PROFILE, StaticPages
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
+app.config['PURGE_DELETED_USERS_IN_BACKGROUND'] = False
+
+
+class StaticPagesTestCase(TestCase):
+    """Test rendering, serving and refreshing signed-out pages."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        self.author_id, self.reader_id = self.author.id, self.reader.id
+
+        msg = Message(text="first warble", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        self.directory = tempfile.mkdtemp()
+        self.pages = StaticPages(app, self.directory, message_ids=app_module.shards.message_ids)
+        app_module.static_pages, self.saved = self.pages, app_module.static_pages
+
+        app.config['STATIC_PAGES_IN_BACKGROUND'] = False
+        app.config['RATELIMIT_ENABLED'] = False
+
+    def tearDown(self):
+        app_module.static_pages = self.saved
+        app.config['STATIC_PAGES_IN_BACKGROUND'] = True
+        app.config['RATELIMIT_ENABLED'] = True
+        shutil.rmtree(self.directory)
+
+    def read(self, endpoint, key):
+        path = self.pages.path(endpoint, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='UTF-8') as f:
+            return f.read()
+
+    def signed_in(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_generate(self):
+        """Are active profiles and their messages rendered, and others removed"""
+
+        stale = self.pages.path(MESSAGE, 999999)
+        os.makedirs(os.path.dirname(stale))
+        open(stale, 'w').close()
+
+        result = app.test_cli_runner().invoke(args=['render-static-pages'])
+
+        self.assertIn("Rendered 2 pages", result.output)
+        self.assertIn("@author", self.read(PROFILE, self.author_id))
+        self.assertIn("first warble", self.read(MESSAGE, self.message_id))
+        self.assertIsNone(self.read(PROFILE, self.reader_id))
+        self.assertFalse(os.path.exists(stale))
+
+        self.assertEqual(self.pages.generate([self.author_id + 1000], []), 0)
+        self.assertIsNone(self.read(PROFILE, self.author_id + 1000))
+
+    def test_served_without_database(self):
+        """Are signed-out views answered from the file, with no query"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+        Message.query.filter_by(id=self.message_id).update({'text': "changed behind its back"})
+        db.session.commit()
+
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        client = app.test_client()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = client.get(f"/messages/{self.message_id}")
+            profile = client.get(f"/users/{self.author_id}")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements, [])
+        self.assertIn("first warble", resp.get_data(as_text=True))
+        self.assertIn("first warble", profile.get_data(as_text=True))
+
+        self.assertEqual(client.get(f"/messages/{self.message_id}",
+                                    headers={'If-Modified-Since': resp.headers['Last-Modified']})
+                         .status_code, 304)
+
+        # signed-in views and later pages are rendered as usual
+        html = self.signed_in(self.reader_id).get(f"/messages/{self.message_id}")
+        self.assertIn("changed behind its back", html.get_data(as_text=True))
+        older = client.get(f"/users/{self.author_id}?before=2100-01-01T00:00:00&before_id=1")
+        self.assertIn("changed behind its back", older.get_data(as_text=True))
+
+    def test_refreshed_on_add_and_delete(self):
+        """Do new messages create pages, and deletions remove them"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+        client = self.signed_in(self.author_id)
+
+        client.post('/messages/new', data={'text': "second warble"})
+        msg = Message.query.filter_by(text="second warble").one()
+
+        self.assertIn("second warble", self.read(MESSAGE, msg.id))
+        self.assertIn("second warble", self.read(PROFILE, self.author_id))
+
+        client.post(f"/messages/{self.message_id}/delete")
+
+        self.assertIsNone(self.read(MESSAGE, self.message_id))
+        self.assertNotIn("first warble", self.read(PROFILE, self.author_id))
+
+    def test_refreshed_on_like(self):
+        """Does liking update the message's page, but not create the liker's"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+        client = self.signed_in(self.reader_id)
+
+        client.post(f"/messages/{self.message_id}/like", headers={'Referer': "/"})
+        self.assertIn("1 like\n", self.read(MESSAGE, self.message_id))
+        self.assertIsNone(self.read(PROFILE, self.reader_id))
+
+        client.post(f"/messages/{self.message_id}/unlike", headers={'Referer': "/"})
+        self.assertIn("0 likes", self.read(MESSAGE, self.message_id))
+
+    def test_background(self):
+        """Are refreshed pages removed at once and rendered by the worker"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+
+        self.pages.refresh(users=[self.author_id], messages=[self.message_id])
+        worker = self.pages.worker
+        if worker is not None:
+            worker.join()
+
+        self.assertIsNotNone(self.read(PROFILE, self.author_id))
+        self.assertIsNotNone(self.read(MESSAGE, self.message_id))
+        self.assertIsNone(self.pages.worker)
+
+        self.pages.refresh(users=[self.reader_id])
+        self.assertIsNone(self.read(PROFILE, self.reader_id))
+
+    def test_refresh_during_render(self):
+        """Is a page queued again when it changes while it is being rendered"""
+
+        started, finish = threading.Event(), threading.Event()
+        renders = []
+        render = self.pages.render
+
+        def slow_render(endpoint, key):
+            renders.append((endpoint, key))
+            if len(renders) == 1:
+                started.set()
+                finish.wait(5)
+            return render(endpoint, key)
+
+        self.pages.render = slow_render
+        self.pages.refresh(messages=[self.message_id], create=True)
+        started.wait(5)
+
+        # the file isn't written yet, but the render in flight may be stale
+        self.pages.refresh(messages=[self.message_id])
+        finish.set()
+        worker = self.pages.worker
+        if worker is not None:
+            worker.join()
+
+        self.assertEqual(renders, [(MESSAGE, self.message_id)] * 2)
+
+    def test_compressed(self):
+        """Does a gzipped page get a weak ETag and no byte ranges"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+        client = app.test_client()
+
+        plain = client.get(f"/users/{self.author_id}")
+        resp = client.get(f"/users/{self.author_id}", headers={'Accept-Encoding': "gzip"})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['ETag'], f"W/{plain.headers['ETag']}")
+        self.assertNotIn('Accept-Ranges', resp.headers)
+
+        self.assertEqual(client.get(f"/users/{self.author_id}",
+                                    headers={'Accept-Encoding': "gzip",
+                                             'If-None-Match': resp.headers['ETag']})
+                         .status_code, 304)
+
+    def test_author_pages(self):
+        """Are an author's message pages refreshed on edit and removed on delete"""
+
+        self.pages.generate([self.author_id], [self.message_id])
+
+        self.pages.refresh(authors=[self.author_id], in_background=False)
+        self.assertIn("first warble", self.read(MESSAGE, self.message_id))
+
+        User.query.get(self.author_id).mark_deleted()
+        db.session.commit()
+        self.pages.remove_authors([self.author_id], in_background=False)
+        self.assertIsNone(self.read(MESSAGE, self.message_id))
+
+    def test_removed_by_other_process(self):
+        """Is a render thrown away when another process removes the page meanwhile"""
+
+        other = StaticPages(app, self.directory)
+        make_response = app.make_response
+
+        def removed_meanwhile(rv):
+            other.remove({(MESSAGE, self.message_id)})
+            return make_response(rv)
+
+        app.make_response = removed_meanwhile
+        try:
+            self.assertFalse(self.pages.render(MESSAGE, self.message_id))
+        finally:
+            del app.make_response
+
+        self.assertIsNone(self.read(MESSAGE, self.message_id))
+        self.assertTrue(self.pages.render(MESSAGE, self.message_id))
@@ -0,0 +1,123 @@
+"""Per-user statistics job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_stats.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Message, Follows, Like, UserStats, JobCheckpoint
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from stats import aggregate, compute_user_stats
+
+db.create_all()
+
+NOW = datetime(2021, 6, 1)
+
+
+class AggregateTestCase(TestCase):
+    """Test the vectorized group-bys on hand-built arrays."""
+
+    def test_aggregate(self):
+        """Are counts, rates and top messages computed per user"""
+
+        day = np.timedelta64(1, 'D')
+        now = np.datetime64(NOW, 'us')
+
+        messages = (np.array([1, 1, 1, 3]),
+                    np.array([10, 11, 12, 13]),
+                    np.array([now - 40 * day, now - 5 * day, now - day, now - day]),
+                    np.array([2, 5, 5, 0]))
+        archives = (np.array([1]), np.array([7]), np.array([now - 100 * day]))
+        follows = (np.array([1, 2, 2]), np.array([now - day, now - 60 * day, now - day]))
+
+        rows = {row['user_id']: row for row in
+                aggregate(np.array([1, 2, 3]), messages, archives, follows, NOW)}
+
+        self.assertEqual(rows[1]['messages'], 10)
+        self.assertEqual(rows[1]['first_message_at'], NOW - timedelta(days=100))
+        self.assertAlmostEqual(rows[1]['posts_per_day'], 0.1)
+        self.assertEqual(rows[1]['recent_posts'], 2)
+        self.assertEqual(rows[1]['likes_received'], 12)
+        self.assertEqual((rows[1]['top_message_id'], rows[1]['top_message_likes']), (11, 5))
+        self.assertEqual((rows[1]['followers'], rows[1]['recent_followers']), (1, 1))
+
+        self.assertEqual(rows[2]['messages'], 0)
+        self.assertIsNone(rows[2]['first_message_at'])
+        self.assertEqual(rows[2]['posts_per_day'], 0)
+        self.assertEqual((rows[2]['followers'], rows[2]['recent_followers']), (2, 1))
+
+        self.assertIsNone(rows[3]['top_message_id'])
+
+
+class ComputeUserStatsTestCase(TestCase):
+    """Test the job against the database."""
+
+    def setUp(self):
+        db.session.rollback()
+        JobCheckpoint.query.delete()
+        UserStats.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                      for i in range(3)]
+        db.session.commit()
+
+        msg = Message(text="hello", user_id=self.users[0].id, like_count=1)
+        db.session.add(msg)
+        db.session.commit()
+
+        db.session.add_all([
+            Like(user_id=self.users[1].id, message_id=msg.id),
+            Follows(user_being_followed_id=self.users[0].id,
+                    user_following_id=self.users[1].id),
+        ])
+        db.session.commit()
+
+        self.msg_id = msg.id
+
+    def test_full_run(self):
+        """Are stats written for every user, in worker processes"""
+
+        self.assertEqual(compute_user_stats(processes=2), 3)
+
+        stats = UserStats.query.get(self.users[0].id)
+        self.assertEqual(stats.messages, 1)
+        self.assertEqual(stats.likes_received, 1)
+        self.assertEqual(stats.top_message_id, self.msg_id)
+        self.assertEqual(stats.followers, 1)
+
+    def test_incremental_run(self):
+        """Are only users changed since the checkpoint recomputed"""
+
+        start = datetime.utcnow()
+        compute_user_stats(processes=1, now=start)
+        self.assertEqual(compute_user_stats(processes=1), 0)
+
+        db.session.add(Follows(user_being_followed_id=self.users[2].id,
+                               user_following_id=self.users[1].id))
+        db.session.commit()
+
+        self.assertEqual(compute_user_stats(processes=1), 1)
+        self.assertEqual(UserStats.query.get(self.users[2].id).followers, 1)
+
+    def test_profile_shows_stats(self):
+        """Does the profile page show the user's stats"""
+
+        compute_user_stats(processes=1)
+
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.users[0].id}").get_data(as_text=True)
+
+        self.assertIn("1 likes received", html)
+        self.assertIn(f'href="/messages/{self.msg_id}"', html)
@@ -0,0 +1,88 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, MessageLikeBucket, HashtagBucket
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import trending
+
+db.create_all()
+
+
+class TrendingTestCase(TestCase):
+    """Test bucketed like/post counts and the trending lists."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        HashtagBucket.query.delete()
+        db.session.commit()
+        trending.clear_cache()
+
+        user = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+
+        self.messages = [Message(text=f"msg {i}", user_id=user.id) for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_bucket_for(self):
+        """Are times floored to the start of their bucket"""
+
+        self.assertEqual(trending.bucket_for(datetime(2021, 3, 4, 5, 59, 59)),
+                         datetime(2021, 3, 4, 5))
+
+    def test_trending_messages(self):
+        """Are messages ranked by likes inside the window only"""
+
+        first, second, third = self.messages
+        now = datetime.utcnow()
+
+        trending.record_like(second.id)
+        trending.record_like(second.id)
+        trending.record_like(first.id)
+        trending.record_like(third.id, when=now - timedelta(days=2), delta=5)
+        db.session.commit()
+
+        self.assertEqual(MessageLikeBucket.query.filter_by(message_id=second.id).one().count, 2)
+        self.assertEqual([(m.id, n) for m, n in trending.trending_messages()],
+                         [(second.id, 2), (first.id, 1)])
+
+        trending.record_like(second.id, delta=-1)
+        trending.record_like(second.id, delta=-1)
+        db.session.commit()
+        trending.clear_cache()
+
+        self.assertEqual([m.id for m, _ in trending.trending_messages()], [first.id])
+
+        self.assertEqual(trending.prune_buckets(), 1)
+
+    def test_trending_hashtags(self):
+        """Are hashtags counted once per message, case-insensitively"""
+
+        trending.record_post("#Flask and #flask and #python")
+        trending.record_post("more #python")
+        db.session.commit()
+
+        self.assertEqual(trending.trending_hashtags(), [("python", 2), ("flask", 1)])
+
+        resp = self.client.get("/trending")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("#python", html)
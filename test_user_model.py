@@ -8,9 +8,10 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Like
 
 import sqlalchemy
+from datetime import datetime, timedelta
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -125,8 +126,54 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate(temp_user.username, 'djhfdjfhj'))
         self.assertFalse(User.authenticate('bad_user', 'password'))
 
+    def test_sorted_liked_messages(self):
+        """Are liked messages paged and ordered by like time in the DB"""
 
+        now = datetime.utcnow()
+        messages = [Message(text=f"msg {i}", user_id=self.user3.id, timestamp=now - timedelta(days=i))
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        # like the oldest message most recently
+        for i, msg in enumerate(messages):
+            db.session.add(Like(user_id=self.user2.id, message_id=msg.id,
+                                created_at=now + timedelta(minutes=i)))
+        db.session.commit()
+
+        by_like = self.user2.get_sorted_liked_messages(per_page=2)
+        self.assertEqual([m.text for m in by_like.items], ["msg 2", "msg 1"])
+        self.assertEqual(by_like.total, 3)
+        self.assertTrue(by_like.has_next)
+
+        by_post = self.user2.get_sorted_liked_messages(order_by="posted")
+        self.assertEqual([m.text for m in by_post.items], ["msg 0", "msg 1", "msg 2"])
+        self.assertEqual(self.user2.count_likes(), 3)
+        self.assertEqual(self.user3.count_likes(), 0)
 
+    def test_follows_pages(self):
+        """Are followers paged by user id with follow state looked up in bulk"""
+
+        fans = [User(email=f"fan{i}@test.com", username=f"fan{i}", password="HASHED_PASSWORD")
+                for i in range(5)]
+        db.session.add_all(fans)
+        db.session.commit()
+
+        fan_ids = sorted(fan.id for fan in fans)
+        db.session.add_all([Follows(user_being_followed_id=self.user2.id, user_following_id=id)
+                            for id in fan_ids])
+        db.session.add(Follows(user_being_followed_id=fan_ids[1], user_following_id=self.user3.id))
+        db.session.commit()
 
+        page, after = self.user2.get_followers_page(per_page=3)
+        self.assertEqual([u.id for u in page], fan_ids[:3])
+        self.assertEqual(after, fan_ids[2])
 
+        page, after = self.user2.get_followers_page(after=after, per_page=3)
+        self.assertEqual([u.id for u in page], fan_ids[3:])
+        self.assertIsNone(after)
 
+        self.assertEqual(self.user2.count_followers(), 5)
+        self.assertEqual(self.user3.following_ids(among=fan_ids[:3]), {fan_ids[1]})
+        self.assertTrue(self.user3.is_following(fans[fan_ids.index(fan_ids[1])]))
+        self.assertFalse(self.user2.is_following(self.user3))
@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -30,6 +32,7 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['NOTIFICATIONS_IN_BACKGROUND'] = False
 
 
 
@@ -107,6 +110,71 @@ class UserViewTestCase(TestCase):
 
             self.assertIn("Access unauthorized", html)
 
+    def test_streamed_user_list(self):
+        """Are long listings streamed, with flashes shown only once"""
+
+        user_id = User.query.filter_by(username="testuser").one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+                sess['_flashes'] = [("success", "Flashed once")]
+
+            resp = c.get('/users')
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("@testuser", html)
+            self.assertIn("Flashed once", html)
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertNotIn("Flashed once", html)
+
+            html = c.get(f'/users/{user_id}/followers').get_data(as_text=True)
+            self.assertIn("@testuser", html)
+
+    def test_followers_page_query_count(self):
+        """Does a followers page cost the same number of queries at any size"""
+
+        user_id = User.query.filter_by(username="testuser").one().id
+
+        def count_queries(path):
+            statements = []
+
+            def record(*args):
+                statements.append(args[2])
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.assertEqual(c.get(path).status_code, 200)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            return len(statements)
+
+        def add_followers(count, start):
+            fans = [User(email=f"fan{i}@test.com", username=f"fan{i}", password="x")
+                    for i in range(start, start + count)]
+            db.session.add_all(fans)
+            db.session.commit()
+            db.session.add_all([Follows(user_being_followed_id=user_id, user_following_id=fan.id)
+                                for fan in fans])
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            # build the session's user snapshot first
+            c.get(f"/users/{user_id}/followers")
+
+            add_followers(2, 0)
+            small = count_queries(f"/users/{user_id}/followers")
+
+            add_followers(60, 2)
+            large = count_queries(f"/users/{user_id}/followers")
+
+            self.assertEqual(small, large)
+
 
 """
 When you’re logged in, are you prohibiting from adding a message as another user?
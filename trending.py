@@ -0,0 +1,144 @@
+"""Trending messages and hashtags.
+
+Likes per message and posts per hashtag are counted into hourly buckets
+as they happen (`record_like()` / `record_post()`), in the same
+transaction as the like or message itself. Trending lists sum the
+buckets inside a sliding WINDOW, so their cost depends on how many
+messages and tags were active recently, not on the size of `likes`.
+The top N of each list is cached per process for CACHE_TTL.
+"""
+
+import re
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Message, MessageLikeBucket, HashtagBucket
+
+BUCKET_SIZE = timedelta(hours=1)
+WINDOW = timedelta(hours=24)
+TOP_N = 10
+CACHE_TTL = 60
+
+HASHTAG_RE = re.compile(r"#(\w+)")
+
+_cache = {}
+
+
+def bucket_for(when):
+    """Start of the bucket that `when` falls in."""
+
+    return datetime.min + (when - datetime.min) // BUCKET_SIZE * BUCKET_SIZE
+
+
+def hashtags(text):
+    """Distinct lower-cased hashtags in `text`."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def _increment(model, values, delta):
+    """Add `delta` to the bucket row identified by `values`."""
+
+    stmt = insert(model).values(count=delta, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(values),
+        set_={'count': model.count + delta},
+    )
+    db.session.execute(stmt)
+
+
+def record_like(message_id, when=None, delta=1):
+    """Count a like (or, with delta=-1, an unlike) of `message_id`.
+
+    `when` is the time of the like being counted; for an unlike, pass
+    the original like's time so the right bucket is decremented.
+    """
+
+    bucket = bucket_for(when or datetime.utcnow())
+    _increment(MessageLikeBucket, {'message_id': message_id, 'bucket': bucket}, delta)
+
+
+def record_post(text, when=None):
+    """Count the hashtags used in a new message."""
+
+    bucket = bucket_for(when or datetime.utcnow())
+    for tag in hashtags(text):
+        _increment(HashtagBucket, {'tag': tag, 'bucket': bucket}, 1)
+
+
+def _cached(key, compute):
+    """Return the cached value for `key`, recomputing it after CACHE_TTL."""
+
+    now = time.monotonic()
+    hit = _cache.get(key)
+
+    if hit and hit[0] > now:
+        return hit[1]
+
+    value = compute()
+    _cache[key] = (now + CACHE_TTL, value)
+    return value
+
+
+def clear_cache():
+    """Forget cached trending lists."""
+
+    _cache.clear()
+
+
+def _window_totals(key_col, model, n):
+    """Top `n` (key, total) pairs summed over the current window."""
+
+    since = bucket_for(datetime.utcnow() - WINDOW)
+    total = db.func.sum(model.count)
+
+    return [tuple(row) for row in (db.session
+                                   .query(key_col, total)
+                                   .filter(model.bucket >= since)
+                                   .group_by(key_col)
+                                   .having(total > 0)
+                                   .order_by(total.desc(), key_col)
+                                   .limit(n))]
+
+
+def trending_messages(n=TOP_N, shards=None):
+    """Most-liked messages in the window, as (message, likes) pairs.
+
+    Messages are MessageRows read through `shards` when it's sharded,
+    else Message objects.
+    """
+
+    totals = _cached(('messages', n), lambda: _window_totals(
+        MessageLikeBucket.message_id, MessageLikeBucket, n))
+    ids = [id for id, _ in totals]
+
+    if shards is not None and shards.sharded:
+        messages = {msg.id: msg for msg in shards.message_rows(ids)}
+    else:
+        messages = {msg.id: msg for msg in (Message
+                                            .query
+                                            .filter(Message.id.in_(ids))
+                                            .options(db.joinedload(Message.user)))}
+
+    return [(messages[id], likes) for id, likes in totals if id in messages]
+
+
+def trending_hashtags(n=TOP_N):
+    """Most-used hashtags in the window, as (tag, posts) pairs."""
+
+    return _cached(('hashtags', n), lambda: _window_totals(
+        HashtagBucket.tag, HashtagBucket, n))
+
+
+def prune_buckets(before=None):
+    """Delete buckets that have slid out of the window."""
+
+    before = before or bucket_for(datetime.utcnow() - WINDOW)
+
+    deleted = MessageLikeBucket.query.filter(MessageLikeBucket.bucket < before).delete()
+    deleted += HashtagBucket.query.filter(HashtagBucket.bucket < before).delete()
+    db.session.commit()
+
+    return deleted